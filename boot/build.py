@@ -6,5 +6,5 @@ files = "@RELOC:0x200 init.asm main.kl graphics.kl device.kl keyboard.kl utils.k
 
 files = " ".join(map(lambda file: file + ".out" if file.endswith(".kl") else file, files.split(" ")))
 
-os.system("../tools/kl.py *.kl --comment")
-os.system(f"../tools/assembler.py {files} -o boot.bin")
\ No newline at end of file
+os.system("../tools/kl.py *.kl --comment -g")
+os.system(f"../tools/assembler.py {files} -o boot.bin -g")
\ No newline at end of file
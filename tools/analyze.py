@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+import json
+import click
+
+from emulator import decode_instruction, CpuException, BOOT_ADDRESS
+from debuginfo import DebugInfo
+
+# Instructions that move the stack pointer by a fixed amount
+PUSHES = {"push", "pushi"}
+CALLS = {"call", "calli", "bal", "bali"}
+# Jumps with an immediate target, the emulator already made relative ones absolute
+DIRECT_JUMPS = {"ji": False, "bi": False, "jti": True, "jfi": True, "bti": True, "bfi": True}
+INDIRECT_JUMPS = {"j": False, "b": False, "jt": True, "jf": True, "bt": True, "bf": True}
+# Instructions writing a register, see emulator.WRITES_A. Instructions with an immediate and a
+# register have the register first, addi and subi are handled on their own
+WRITES_A = {"andi", "ori", "xori", "shli", "shri", "ldbi", "ldwi", "lddi", "movi", "pop"}
+WRITES_B = {"add", "sub", "and", "or", "xor", "shl", "shr", "ldb", "ldw", "ldd", "mov"}
+
+class Function:
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.instructions = {} # Address -> (name, a, b, next)
+        self.edges = [] # (from, to) inside the function
+        self.calls = [] # (address, stack depth, target address or None if indirect)
+        self.frame = 0 # Deepest stack use of the function itself, in bytes
+        self.stack = None # Deepest stack use including called functions, None if unbounded
+        self.notes = set() # Things that make the analysis incomplete
+        self.loops = []
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+def find_functions(memory, debug_info):
+    # Functions from .func directives, and global symbols called from code that isn't in one
+    functions = [Function(*function) for function in debug_info.functions]
+    starts = sorted({function.start for function in functions} | set(debug_info.symbols.values()))
+
+    def end_of(address):
+        later = [start for start in starts if start > address]
+        return later[0] if later else len(memory)
+
+    known = {function.start for function in functions}
+    pending = list(functions)
+    while pending:
+        function = pending.pop()
+        analyze_function(memory, function)
+        for _, _, target in function.calls:
+            if target == None or target in known or debug_info.function(target) != None:
+                continue
+            symbol = debug_info.symbol(target)
+            name = symbol[0] if symbol != None and symbol[1] == target else f"0x{target:X}"
+            known.add(target)
+            new = Function(name, target, end_of(target))
+            functions.append(new)
+            pending.append(new)
+    return sorted(functions, key=lambda function: function.start)
+
+def analyze_function(memory, function):
+    # Follows every path from the start of the function, tracking how deep the stack is compared
+    # to the entry (after the return address was pushed)
+    depths = {} # Address -> deepest stack depth seen there
+    pending = [(function.start, 0, None)] # (address, depth, depth when the frame pointer was set)
+    while pending:
+        address, depth, frame = pending.pop()
+        if address in depths:
+            if depths[address] != depth:
+                function.notes.add("unbalanced stack")
+            continue
+        depths[address] = depth
+        function.frame = max(function.frame, depth)
+
+        try:
+            instruction = decode_instruction(memory, address)
+        except CpuException:
+            function.notes.add(f"invalid instruction at 0x{address:X}")
+            continue
+        function.instructions[address] = instruction
+        name, a, b, next = instruction
+        successors = [next]
+
+        if name in PUSHES:
+            depth += 4
+        elif name == "pop":
+            depth -= 4
+            if a == 15:
+                function.notes.add("sets the stack pointer")
+                continue
+        elif name == "subi" and a == 15:
+            depth += b
+        elif name == "addi" and a == 15:
+            depth -= b
+        elif name == "mov" and (a, b) == (15, 12):
+            frame = depth
+        elif name == "mov" and (a, b) == (12, 15):
+            if frame == None:
+                function.notes.add("restores an unknown frame")
+                continue
+            depth = frame
+        elif (name in WRITES_B and b == 15) or (name in WRITES_A and a == 15):
+            function.notes.add("sets the stack pointer")
+            continue
+        elif name in CALLS:
+            function.calls.append((address, depth, a if name in ("calli", "bali") else None))
+        elif name in ("ret", "iret"):
+            successors = []
+        elif name in DIRECT_JUMPS:
+            # A jump to itself is how programs halt
+            successors = [a] + ([next] if DIRECT_JUMPS[name] else [])
+            successors = [target for target in successors if target != address]
+        elif name in INDIRECT_JUMPS:
+            function.notes.add("indirect jump")
+            successors = [next] if INDIRECT_JUMPS[name] else []
+
+        for target in successors:
+            if not function.start <= target < function.end:
+                function.notes.add(f"leaves the function at 0x{address:X} for 0x{target:X}")
+                continue
+            function.edges.append((address, target))
+            pending.append((target, depth, frame))
+
+    function.loops = find_loops(function)
+
+def find_loops(function):
+    # Natural loops of the jumps going backwards, with the fewest and most instructions run by one
+    # iteration and the size of the loop. Inner loops are counted once, they are listed on their own
+    predecessors = {}
+    successors = {}
+    for source, target in function.edges:
+        predecessors.setdefault(target, []).append(source)
+        successors.setdefault(source, []).append(target)
+
+    loops = []
+    for latch, header in function.edges:
+        if header > latch:
+            continue
+        body = {header}
+        pending = [latch]
+        while pending:
+            address = pending.pop()
+            if address not in body:
+                body.add(address)
+                pending += predecessors.get(address, [])
+
+        # Forward edges only, so addresses are already in topological order
+        shortest, longest = {header: 1}, {header: 1}
+        for address in sorted(body):
+            if address not in shortest:
+                continue
+            for target in successors.get(address, []):
+                if target not in body or target <= address:
+                    continue
+                shortest[target] = min(shortest.get(target, shortest[address] + 1), shortest[address] + 1)
+                longest[target] = max(longest.get(target, 0), longest[address] + 1)
+        if latch not in shortest:
+            continue
+
+        calls = sorted({target for address, _, target in function.calls if address in body}, key=lambda target: target or 0)
+        loops.append({
+            "header": header,
+            "latch": latch,
+            "min_instructions": shortest[latch],
+            "max_instructions": longest[latch],
+            "bytes": sum(function.instructions[address][3] - address for address in body),
+            "calls": calls,
+        })
+    return loops
+
+def find_cycles(functions):
+    # Strongly connected components of the call graph with a cycle, each a list of functions
+    by_start = {function.start: function for function in functions}
+    graph = {function: [by_start[target] for _, _, target in function.calls if target in by_start] for function in functions}
+    index = {}
+    lowlink = {}
+    stack = []
+    cycles = []
+
+    for root in functions:
+        if root in index:
+            continue
+        # Iterative Tarjan's algorithm, call chains can be deeper than Python's recursion limit
+        work = [(root, 0)]
+        while work:
+            function, i = work.pop()
+            if i == 0:
+                index[function] = lowlink[function] = len(index)
+                stack.append(function)
+            if i < len(graph[function]):
+                work.append((function, i + 1))
+                callee = graph[function][i]
+                if callee not in index:
+                    work.append((callee, 0))
+                elif callee in stack:
+                    lowlink[function] = min(lowlink[function], index[callee])
+                continue
+            if lowlink[function] == index[function]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    component.append(member)
+                    if member == function:
+                        break
+                if len(component) > 1 or function in graph[function]:
+                    cycles.append(component[::-1])
+            if work:
+                caller = work[-1][0]
+                lowlink[caller] = min(lowlink[caller], lowlink[function])
+    return cycles
+
+def compute_stacks(functions, cycles):
+    # Deepest stack use of each function and everything it calls, None for recursive functions
+    # and functions calling them or calling through registers
+    by_start = {function.start: function for function in functions}
+    recursive = {function for cycle in cycles for function in cycle}
+    done = set()
+
+    for root in functions:
+        work = [(root, False)]
+        while work:
+            function, expanded = work.pop()
+            if function in done:
+                continue
+            callees = [by_start.get(target) for _, _, target in function.calls]
+            if not expanded:
+                work.append((function, True))
+                work += [(callee, False) for callee in callees if callee != None and callee not in done and callee not in recursive]
+                continue
+            done.add(function)
+            if function in recursive or any(callee == None or callee.stack == None for callee in callees):
+                function.stack = None
+                continue
+            stack = function.frame
+            for (_, depth, _), callee in zip(function.calls, callees):
+                # The call pushes the return address
+                stack = max(stack, depth + 4 + callee.stack)
+            function.stack = stack
+
+def analyze(memory, debug_info):
+    functions = find_functions(memory, debug_info)
+    cycles = find_cycles(functions)
+    compute_stacks(functions, cycles)
+    return functions, cycles
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--sort", "-s", type=click.Choice(["address", "name", "size", "frame", "stack"]), default="address", help="Order of the functions.")
+@click.option("--loops/--no-loops", "show_loops", default=True, help="Lists the loops of each function.")
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes the results to a JSON file.")
+def run(file, sort, show_loops, output):
+    """Prints the size, stack use and calls of every function of an image built with -g, and
+    estimates the instructions of one iteration of every loop."""
+    debug_info = DebugInfo.find(file)
+    if debug_info == None:
+        click.echo(f"ERROR: no debug info found for {file}, build it with -g", err=True)
+        exit(1)
+
+    with open(file, "rb") as f:
+        data = f.read()
+    memory = bytearray(BOOT_ADDRESS) + data
+    functions, cycles = analyze(memory, debug_info)
+    by_start = {function.start: function for function in functions}
+
+    def callee_name(target):
+        return by_start[target].name if target in by_start else "<indirect>" if target == None else f"0x{target:X}"
+
+    keys = {
+        "address": lambda function: function.start,
+        "name": lambda function: function.name,
+        "size": lambda function: -function.size,
+        "frame": lambda function: -function.frame,
+        "stack": lambda function: -(function.stack if function.stack != None else float("inf")),
+    }
+    click.echo(f"{'function':<32} {'address':>10} {'size':>6} {'frame':>6} {'stack':>6}  calls")
+    for function in sorted(functions, key=keys[sort]):
+        stack = function.stack if function.stack != None else "-"
+        callees = sorted({callee_name(target) for _, _, target in function.calls})
+        click.echo(f"{function.name:<32} 0x{function.start:08X} {function.size:>6} {function.frame:>6} {stack:>6}  {', '.join(callees)}")
+        for note in sorted(function.notes):
+            click.echo(f"  warning: {note}")
+        if show_loops:
+            for loop in function.loops:
+                line = debug_info.line(loop["header"])
+                location = f" ({line[0]}:{line[1]})" if line != None else ""
+                count = loop["min_instructions"] if loop["min_instructions"] == loop["max_instructions"] else f"{loop['min_instructions']}-{loop['max_instructions']}"
+                calls = f", calls {', '.join(callee_name(target) for target in loop['calls'])}" if loop["calls"] else ""
+                click.echo(f"  loop at 0x{loop['header']:X}{location}: {count} instructions, {loop['bytes']} bytes{calls}")
+
+    for cycle in cycles:
+        click.echo(f"recursion: {' -> '.join(function.name for function in cycle + cycle[:1])}")
+
+    roots = [function for function in functions if not any(function.start == target for other in functions for _, _, target in other.calls)]
+    bounded = [function for function in roots if function.stack != None]
+    if bounded:
+        deepest = max(bounded, key=lambda function: function.stack)
+        click.echo(f"deepest stack: {deepest.stack} bytes from {deepest.name}")
+    unbounded = [function.name for function in roots if function.stack == None]
+    if unbounded:
+        click.echo(f"unbounded stack from: {', '.join(unbounded)}")
+
+    if output != None:
+        results = {
+            "functions": [{
+                "name": function.name,
+                "start": function.start,
+                "size": function.size,
+                "frame": function.frame,
+                "stack": function.stack,
+                "calls": sorted({callee_name(target) for _, _, target in function.calls}),
+                "notes": sorted(function.notes),
+                "loops": [dict(loop, calls=[callee_name(target) for target in loop["calls"]]) for loop in function.loops],
+            } for function in functions],
+            "recursion": [[function.name for function in cycle] for cycle in cycles],
+        }
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == "__main__":
+    run()
@@ -2,8 +2,12 @@
 
 import lark
 import click
+import codecs
 import struct
 from pathlib import Path
+from debuginfo import DebugInfo, EXTENSION
+import icf
+from timings import Timings, NO_TIMINGS, finish
 
 INSTRUCTIONS = {
     "nop":     {"operands": "",   "opcode": b"\x00"},
@@ -97,30 +101,44 @@ class Assembler:
         self.code = bytearray()
         self.global_symbols_def = {}
         self.global_symbols_use = {}
+        self.rodata = {} # Read-only constants, placed after the code when linking: symbol -> bytes
+        self.rodata_alignment = {} # Symbol -> alignment of the read-only constants that need one
+        self.padding = 0 # Bytes added by .align directives and aligned constants
+        self.alignments = [] # (position, bytes of padding, alignment) of every aligned address
+        self.relocations = {} # Position in the code -> address stored there by the linker
+        self.instructions = [] # Position of every instruction, in order
+        self.rodata_start = None # Position of the first read-only constant once placed
+        self.folding = None # icf.Report when identical code was folded
+        self.debug_lines = [] # (address, file, line, column) from .loc directives
+        self.debug_functions = [] # (name, start, end) from .func and .endfunc directives
+        self.function = None # (name, start) of the function being assembled
 
         self.symbols_def = {}
         self.symbols_use = {}
-        self.to_import = []
-        self.to_export = []
+        self.to_import = set()
+        self.to_export = set()
 
         self.pos_offset = 0
 
     def preprocess(self, ast):
         self.symbols_def = {}
         self.symbols_use = {}
-        self.to_import = []
-        self.to_export = []
+        self.to_import = set()
+        self.to_export = set()
         definitions = {}
         for node in ast.children:
             if node.data == "d_export":
-                self.to_export.append(node[0][0])
+                self.to_export.add(node[0][0])
             elif node.data == "d_import":
-                self.to_import.append(node[0][0])
+                self.to_import.add(node[0][0])
             elif node.data == "d_define":
                 definitions[node[0][0].value] = node[1]
+        # Walking the whole tree is most of the time spent assembling, and it only replaces words
+        if not definitions:
+            return ast
         return Transfromer(definitions).transform(ast)
 
-    def read_imm(self, node):
+    def read_imm(self, node, offset=0):
         if node.data == "number":
             return int(node[0])
         elif node.data == "hex_number":
@@ -131,18 +149,74 @@ class Assembler:
             return ord(node[0][1])
         elif node.data == "label":
             # Keep track of this so we can fix the address later
-            self.symbols_use[len(self.code)] = {
-                "pos": len(self.code) + self.pos_offset,
+            # `offset` is the distance from the end of the code to where the value will be stored
+            self.symbols_use[len(self.code) + offset] = {
+                "pos": len(self.code) + offset + self.pos_offset,
                 "symbol": node[0],
             }
             # Set a temporary value
             return 0xFFFFFFFF
 
+    def align(self, alignment):
+        padding = -(len(self.code) + self.pos_offset) % alignment
+        self.alignments.append((len(self.code), padding, alignment))
+        self.code += bytes(padding)
+        self.padding += padding
+
+    def read_alignment(self, node):
+        # Alignment of an .align directive, None if it isn't a power of two
+        if node.data == "label":
+            click.echo(f"ERROR: alignment can't be a label", err=True)
+            return None
+        alignment = self.read_imm(node)
+        if alignment < 1 or alignment & (alignment - 1):
+            click.echo(f"ERROR: alignment must be a power of two, not {alignment}", err=True)
+            return None
+        return alignment
+
+    def read_data(self, node):
+        # Data directives take a list of values followed by an optional repeat count.
+        # Strings and hex blobs can only be used to define bytes
+        format = {"d_byte": "B", "d_word": "H", "d_dword": "I"}[node.data]
+        items = node.children
+        amount = 1
+        if items[-1].data == "count":
+            if items[-1][0].data == "label":
+                click.echo(f"ERROR: repeat count can't be a label", err=True)
+                return bytearray()
+            amount = self.read_imm(items[-1][0])
+            items = items[:-1]
+
+        data = bytearray()
+        uses = len(self.symbols_use)
+        for item in items:
+            if item.data in ("string", "blob"):
+                if format != "B":
+                    click.echo(f"ERROR: {item.data} can only be used with .byte", err=True)
+                elif item.data == "string":
+                    data += codecs.escape_decode(item[0][1:-1].encode())[0]
+                else:
+                    data += bytes.fromhex(item[0][2:-1])
+            else:
+                data += struct.pack("<" + format, self.read_imm(item, offset=len(data)))
+
+        # Labels have to be fixed in every copy
+        if amount > 1 and len(self.symbols_use) != uses:
+            for real_pos, symbol_use in list(self.symbols_use.items())[uses:]:
+                for i in range(1, amount):
+                    self.symbols_use[real_pos + i * len(data)] = {
+                        "pos": symbol_use["pos"] + i * len(data),
+                        "symbol": symbol_use["symbol"],
+                    }
+
+        return data * amount
+
     def assemble(self, ast):
         for node in ast.children:
             # If node is instruction
             if node.data.startswith("i_"):
                 instruction = INSTRUCTIONS[node.data[2:]]
+                self.instructions.append(len(self.code))
                 self.code += instruction["opcode"]
                 if instruction["operands"] == "rr":
                     # Encode both registers in a byte
@@ -169,7 +243,7 @@ class Assembler:
                     self.code += struct.pack("<I", imm)
                 elif instruction["operands"] == "ii":
                     imm1 = self.read_imm(node[0])
-                    imm2 = self.read_imm(node[1])
+                    imm2 = self.read_imm(node[1], offset=4)
                     self.code += struct.pack("<I", imm1) + struct.pack("<I", imm2)
             elif node.data == "label_line":
                 if node[0][0] in self.symbols_def.keys():
@@ -178,22 +252,120 @@ class Assembler:
                 else:
                     self.symbols_def[node[0][0]] = len(self.code) + self.pos_offset
             elif node.data in ("d_byte", "d_word", "d_dword"):
-                format = {"d_byte": "B", "d_word": "H", "d_dword": "I"}[node.data]
-                if len(node.children) == 2:
-                    amount = int(node[1][0])
+                self.code += self.read_data(node)
+            elif node.data == "d_align":
+                alignment = self.read_alignment(node[0])
+                if alignment != None:
+                    self.align(alignment)
+            elif node.data == "d_rodata":
+                symbol = node[0][0]
+                if len(node.children) > 2:
+                    alignment = self.read_alignment(node[1][0])
+                    if alignment != None and alignment > 1:
+                        self.rodata_alignment[symbol] = max(self.rodata_alignment.get(symbol, 1), alignment)
+                uses = len(self.symbols_use)
+                data = bytes(self.read_data(node.children[-1]))
+                if len(self.symbols_use) != uses:
+                    click.echo(f"ERROR: read-only constant '{symbol}' can't contain labels", err=True)
+                    for real_pos in list(self.symbols_use.keys())[uses:]:
+                        del self.symbols_use[real_pos]
+                elif self.rodata.get(symbol, data) != data:
+                    click.echo(f"ERROR: duplicate symbol '{symbol}'", err=True)
                 else:
-                    amount = 1
-                self.code += struct.pack("<" + format, self.read_imm(node[0])) * amount
+                    self.rodata[symbol] = data
+            elif node.data == "d_loc":
+                file = codecs.escape_decode(node[0][0][1:-1].encode())[0].decode()
+                column = int(node[2][0]) if len(node.children) > 2 else 0
+                self.debug_lines.append((len(self.code) + self.pos_offset, file, int(node[1][0]), column))
+            elif node.data == "d_func":
+                if self.function != None:
+                    click.echo(f"ERROR: missing .endfunc for '{self.function[0]}'", err=True)
+                self.function = (str(node[0][0]), len(self.code) + self.pos_offset)
+            elif node.data == "d_endfunc":
+                if self.function == None:
+                    click.echo(f"ERROR: .endfunc without .func", err=True)
+                else:
+                    self.debug_functions.append((*self.function, len(self.code) + self.pos_offset))
+                    self.function = None
+
+        # Lines don't continue into the next file
+        if self.debug_lines and self.debug_lines[-1][1] != None:
+            self.debug_lines.append((len(self.code) + self.pos_offset, None, None, None))
+
+    def debug_info(self):
+        return DebugInfo.from_entries(self.debug_lines, self.debug_functions, self.global_symbols_def)
+
+    def memory_map(self):
+        # Text listing of where everything ended up, and what identical code folding saved
+        start = self.pos_offset
+        rodata = self.rodata_start if self.rodata_start != None else len(self.code)
+        lines = [
+            f"code     0x{start:08X}-0x{start + rodata:08X} {rodata:>8} bytes",
+            f"rodata   0x{start + rodata:08X}-0x{start + len(self.code):08X} {len(self.code) - rodata:>8} bytes",
+            f"padding  {self.padding:>31} bytes",
+            "",
+            "functions",
+        ]
+        for name, first, end in sorted(self.debug_functions, key=lambda function: function[1]):
+            lines.append(f"  0x{first:08X} {end - first:>8}  {name}")
+        lines += ["", "symbols"]
+        for symbol, address in sorted(self.global_symbols_def.items(), key=lambda item: (item[1], item[0])):
+            lines.append(f"  0x{address:08X}  {symbol}")
+
+        if self.folding != None:
+            lines += ["", "identical code folding"]
+            for name, kept, size in self.folding.folded:
+                lines.append(f"  {name} -> {kept} ({size} bytes)")
+            lines += ["", "tail merging"]
+            for name, (count, saved) in self.folding.tails.items():
+                lines.append(f"  {name}: {count} tails, {saved} bytes")
+            folded = sum(size for _, _, size in self.folding.folded)
+            merged = sum(saved for _, saved in self.folding.tails.values())
+            lines += [
+                "",
+                f"saved {self.folding.saved} bytes ({self.folding.size} -> {len(self.code)}): {folded} from "
+                f"{len(self.folding.folded)} folded functions, {merged} from {sum(count for count, _ in self.folding.tails.values())} merged tails",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def place_rodata(self):
+        # Identical constants are only stored once, and constants that are a suffix of another
+        # one point inside it when the address fits their alignment. Sorting by reversed contents
+        # puts every constant right after the constants it's a suffix of
+        alignments = {}
+        for symbol, data in self.rodata.items():
+            alignments[data] = max(alignments.get(data, 1), self.rodata_alignment.get(symbol, 1))
+
+        addresses = {}
+        last = None
+        self.rodata_start = len(self.code)
+        for data in sorted(set(self.rodata.values()), key=lambda data: data[::-1], reverse=True):
+            alignment = alignments[data]
+            if last != None and last.endswith(data) and (addresses[last] + len(last) - len(data)) % alignment == 0:
+                addresses[data] = addresses[last] + len(last) - len(data)
+            else:
+                if alignment > 1:
+                    self.align(alignment)
+                addresses[data] = len(self.code) + self.pos_offset
+                self.code += data
+                last = data
+
+        for symbol, data in self.rodata.items():
+            if symbol in self.global_symbols_def:
+                click.echo(f"ERROR: duplicate symbol '{symbol}'", err=True)
+            else:
+                self.global_symbols_def[symbol] = addresses[data]
 
     def link(self, final=False):
         if final:
+            self.place_rodata()
             self.symbols_def = self.global_symbols_def
             self.symbols_use = self.global_symbols_use
 
         for real_pos, symbol_use in self.symbols_use.items():
             if symbol_use["symbol"] in self.symbols_def:
                 pos_def = self.symbols_def[symbol_use["symbol"]]
-            elif symbol_use["symbol"] in self.to_import and not final:
+            elif (symbol_use["symbol"] in self.to_import or symbol_use["symbol"] in self.rodata) and not final:
                 self.global_symbols_use[real_pos] = symbol_use
                 continue
             else:
@@ -201,6 +373,7 @@ class Assembler:
                 continue
 
             self.code[real_pos:real_pos+4] = struct.pack("<i", pos_def)
+            self.relocations[real_pos] = pos_def
         
         if not final:
             for symbol, pos_def in self.symbols_def.items():
@@ -211,26 +384,83 @@ class Assembler:
                     else:
                         self.global_symbols_def[symbol] = pos_def
 
-@click.command()
-@click.argument("files", required=True, nargs=-1)
-@click.option("--output", "-o", type=click.File("wb"), required=True, help="Output binary to write to.")
-def run(files, output):
+def parse_file(file):
+    with open(file, "r") as f:
+        return parser.parse(f.read())
+
+def build(files, parse=parse_file, verbose=True, timings=NO_TIMINGS, fold=False):
+    # `parse` maps a file name to its syntax tree, so callers can cache parsed files. `fold` folds
+    # identical functions and merges tails with icf.py after linking
     assembler = Assembler()
+    offsets = set()
     for file in files:
         if file[0] == "@":
             if file.startswith("@RELOC"):
                 assembler.pos_offset = int(file.split(":")[1], 0) - len(assembler.code)
-                print(f"Relocating following files to {file.split(':')[1]}")
+                if verbose:
+                    print(f"Relocating following files to {file.split(':')[1]}")
         else:
-            print(f"Assembling {file}")
-            with open(file, "r") as f:
-                ast = parser.parse(f.read())
-            ast = assembler.preprocess(ast)
-            assembler.assemble(ast)
-            assembler.link()
-    assembler.link(final=True)
+            if verbose:
+                print(f"Assembling {file}")
+            with timings.phase("parse"):
+                ast = parse(file)
+            with timings.phase("preprocess"):
+                ast = assembler.preprocess(ast)
+            offsets.add(assembler.pos_offset)
+            with timings.phase("assemble"):
+                assembler.assemble(ast)
+            if timings.enabled:
+                timings.count("files")
+                timings.count("instructions", sum(node.data.startswith("i_") for node in ast.children))
+                timings.count("relocations", len(assembler.symbols_use))
+            with timings.phase("link"):
+                assembler.link()
+    with timings.phase("link"):
+        assembler.link(final=True)
+    if fold:
+        # Code is moved around, which only works when positions and addresses differ by a constant
+        if len(offsets) > 1:
+            click.echo(f"ERROR: identical code folding only works with a single @RELOC before every file", err=True)
+        else:
+            with timings.phase("icf"):
+                assembler.folding = icf.fold(assembler)
+            timings.count("functions folded", len(assembler.folding.folded))
+            timings.count("tails merged", sum(count for count, _ in assembler.folding.tails.values()))
+    timings.count("symbols", len(assembler.global_symbols_def))
+    timings.count("rodata constants", len(assembler.rodata))
+    timings.count("alignment padding", assembler.padding)
+    timings.count("bytes", len(assembler.code))
+
+    return assembler
+
+@click.command()
+@click.argument("files", required=True, nargs=-1)
+@click.option("--output", "-o", type=click.File("wb"), required=True, help="Output binary to write to.")
+@click.option("--debug", "-g", is_flag=True, default=False, help=f"Writes debug info from .loc and .func directives to <output>{EXTENSION}.")
+@click.option("--icf", is_flag=True, default=False, help="Folds identical functions and merges identical tails of paths in functions.")
+@click.option("--map", "map_file", type=click.Path(), default=None, help="Writes the address of every function and symbol, and what --icf saved, to a file.")
+@click.option("--timings", "show_timings", is_flag=True, default=False, help="Prints the time spent in each phase and counters of the work done.")
+@click.option("--timings-json", type=click.Path(), default=None, help="Writes the timings and counters to a JSON file.")
+def run(files, output, debug, icf, map_file, show_timings, timings_json):
+    timings = Timings(enabled=show_timings or timings_json != None)
+    assembler = build(files, timings=timings, fold=icf)
+    if (icf or map_file != None) and not assembler.debug_functions:
+        click.echo("WARNING: no .func directives, build with kl.py -g or --func-directives to fold and map functions", err=True)
+
+    with timings.phase("write"):
+        output.write(assembler.code)
+
+        if debug:
+            if output.name == "-":
+                click.echo("ERROR: can't write debug info when writing to standard output", err=True)
+            else:
+                assembler.debug_info().save(output.name + EXTENSION)
+
+        if map_file != None:
+            with open(map_file, "w") as f:
+                f.write(assembler.memory_map())
 
-    output.write(assembler.code)
+    finish(timings, "assembler.py", show_timings, timings_json)
 
 if __name__ == "__main__":
-    run(None, None)
\ No newline at end of file
+    run(None, None)
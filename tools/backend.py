@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+import re
+import click
+
+import peephole
+from peephole import Line, is_register
+
+# Both front ends generate code for a stack machine: every expression leaves its value in $r,
+# temporaries are pushed and popped, locals live in the frame pointed to by $12. This module
+# has the helpers used to emit that code and the passes that optimize it, working on basic
+# blocks of the assembly text
+
+PROLOGUE = "push $12\nmov $15 $12\n"
+EPILOGUE = "mov $12 $15\npop $12\nret\n"
+
+# Code for `left = left <op> right`, results of comparisons are in the flag
+BINARY_OPS = {
+    "+": "add {right} {left}\n",
+    "-": "sub {right} {left}\n",
+    "*": "mul {right} {left}\nmov $13 {left}\n",
+    "/": "div {right} {left}\nmov $14 {left}\n",
+    "%": "div {right} {left}\nmov $13 {left}\n",
+    # TODO: clt and cgt don't work for signed ints
+    "<": "clt {left} {right}\n",
+    ">": "cgt {left} {right}\n",
+    "<=": "cltq {left} {right}\n",
+    ">=": "cgtq {left} {right}\n",
+    "==": "ceq {left} {right}\n",
+    "!=": "cnq {left} {right}\n",
+    "&": "and {right} {left}\n",
+    "|": "or {right} {left}\n",
+    "^": "xor {right} {left}\n",
+    "<<": "shl {right} {left}\n",
+    ">>": "shr {right} {left}\n",
+}
+
+SIZE_SUFFIXES = {1: "b", 2: "w", 4: "d"}
+
+def binary(op, left, right):
+    return BINARY_OPS[op].format(left=f"${left}", right=f"${right}")
+
+def frame_address(offset, register):
+    # Address of the variable at `offset` from the frame pointer
+    if offset < 0:
+        return f"mov $12 ${register}\nsub {-offset} ${register}\n"
+    return f"mov $12 ${register}\nadd {offset} ${register}\n"
+
+def load(size, address, register):
+    return f"ld{SIZE_SUFFIXES[size]} ${address} ${register}\n"
+
+def store(size, value, address):
+    return f"st{SIZE_SUFFIXES[size]} ${value} ${address}\n"
+
+def label(name):
+    return f"#{name}:\n"
+
+# Registers that are never renamed or used for temporaries: zero, frame pointer, results of
+# mul/div and stack pointer
+RESERVED = {"$0", "$12", "$13", "$14", "$15"}
+
+ALL = {f"${i}" for i in range(1, 16)}
+
+# Live when a function returns: the return value, the frame pointer and stack pointer of the caller.
+# Functions of both front ends overwrite every other register they use
+RETURN_LIVE = {"$1", "$12", "$15"}
+
+# Registers temporaries can be kept in instead of the stack, when the code doesn't use them
+SCRATCH = [f"${i}" for i in range(11, 2, -1)]
+
+ALU = {"add", "sub", "and", "or", "xor", "shl", "shr"}
+MUL_DIV = {"mul", "div"}
+COMPARES = {"cgtq", "cltq", "ceq", "cnq", "cgt", "clt"}
+SWAPPED = {"cgtq": "cltq", "cltq": "cgtq", "ceq": "ceq", "cnq": "cnq", "cgt": "clt", "clt": "cgt"}
+LOADS = {"ldb", "ldw", "ldd"}
+STORES = {"stb", "stw", "std"}
+JUMPS = {"j", "jt", "jf"}
+KNOWN = ALU | MUL_DIV | COMPARES | LOADS | STORES | JUMPS | {"mov", "push", "pop", "nop"}
+
+REGISTER = re.compile(r"\$\d+")
+
+def effects(line):
+    # Registers read and written by an instruction. Anything the passes don't know about reads
+    # every register
+    key = (line.op, *line.args)
+    result = effects_cache.get(key)
+    if result == None:
+        result = effects_cache[key] = instruction_effects(line.op, line.args)
+    return result
+
+def instruction_effects(op, args):
+    registers = [arg for arg in args if is_register(arg)]
+    if op in ALU and len(args) == 2:
+        reads, writes = set(registers), {args[1]}
+    elif op in MUL_DIV and len(args) == 2:
+        reads, writes = set(registers), {"$13", "$14"}
+    elif op in COMPARES or op in STORES or op in JUMPS:
+        reads, writes = set(registers), set()
+    elif (op == "mov" or op in LOADS) and len(args) == 2:
+        reads, writes = set(registers[:-1]) if is_register(args[0]) else set(), {args[1]}
+    elif op == "push":
+        reads, writes = set(registers) | {"$15"}, {"$15"}
+    elif op == "pop":
+        reads, writes = {"$15"}, {args[0], "$15"}
+    elif op == "ret":
+        reads, writes = set(RETURN_LIVE), set()
+    elif op in ("nop", "cli", "sti"):
+        reads, writes = set(), set()
+    else:
+        reads, writes = set(ALL), set()
+    reads.discard("$0")
+    writes.discard("$0")
+    return frozenset(reads), frozenset(writes)
+
+effects_cache = {}
+
+def is_barrier(line):
+    # Instructions the passes can't move values across, like calls that overwrite registers
+    return line.op not in KNOWN
+
+def rename(line, old, new):
+    line.replace(line.op, *[new if arg == old else arg for arg in line.args])
+
+class Block:
+    def __init__(self):
+        self.labels = []
+        self.lines = []
+        self.successors = [] # Labels the block jumps to
+        self.fallthrough = False # Runs into the next block
+        self.unknown = False # Can continue anywhere, like an indirect jump
+        self.live_in = set()
+        self.live_out = set()
+
+def split_blocks(lines):
+    # Basic blocks of the instructions, inline assembly and data lines end blocks and are treated
+    # as code that reads every register
+    blocks = [Block()]
+    for line in lines:
+        block = blocks[-1]
+        if line.deleted or line.kind in ("comment", "silent"):
+            continue
+        if line.kind == "label":
+            if block.lines or block.labels:
+                block.fallthrough = True
+                block = Block()
+                blocks.append(block)
+            block.labels.append(line.op)
+        elif line.kind == "instruction":
+            block.lines.append(line)
+            if line.op in JUMPS or line.op in ("ret", "iret"):
+                if line.op in JUMPS and line.args[0][0] == "#":
+                    block.successors.append(line.args[0])
+                else:
+                    block.unknown = line.op != "ret"
+                block.fallthrough = line.op in ("jt", "jf")
+                blocks.append(Block())
+        else:
+            block.unknown = True
+            blocks.append(Block())
+    return blocks
+
+def compute_liveness(blocks):
+    labels = {name: block for block in blocks for name in block.labels}
+    for block in blocks:
+        block.uses = set()
+        block.defs = set()
+        for line in block.lines:
+            reads, writes = effects(line)
+            block.uses |= reads - block.defs
+            block.defs |= writes
+        block.live_in = set()
+
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(blocks))):
+            block = blocks[i]
+            live = set(ALL) if block.unknown else set()
+            if block.fallthrough:
+                live |= blocks[i + 1].live_in if i + 1 < len(blocks) else ALL
+            for name in block.successors:
+                target = labels.get(name)
+                live |= target.live_in if target != None else ALL
+            block.live_out = live
+            live_in = block.uses | (live - block.defs)
+            if live_in != block.live_in:
+                block.live_in = live_in
+                changed = True
+
+def live_after(block):
+    # Registers live after each line of a block
+    live = set(block.live_out)
+    result = [None] * len(block.lines)
+    for i in reversed(range(len(block.lines))):
+        result[i] = set(live)
+        reads, writes = effects(block.lines[i])
+        live = (live - writes) | reads
+    return result
+
+def delete(block, line):
+    line.delete()
+    block.lines.remove(line)
+
+# Passes take a block and return how many changes they made. Liveness of other blocks stays
+# valid, since the passes never make a register live at the start of a block
+
+def pass_constants(block, unit):
+    # mov K $a / push $a / ... / pop $b / add $b $c -> ... / add K $c, and the same for every
+    # instruction with an immediate form, when $b isn't used afterwards
+    changes = 0
+    live = live_after(block)
+    constants = {} # Register -> (value, push line, pop line)
+    stack = [] # Values of the pushed registers, None if unknown
+    for i, line in enumerate(list(block.lines)):
+        if line.deleted:
+            continue
+        op, args = line.op, line.args
+        reads, writes = effects(line)
+        replacement = None
+        source = None
+        if len(args) == 2 and is_register(args[0]) and args[0] in constants and args[0] != args[1] and args[0] not in live[i]:
+            source = args[0]
+            value = constants[source][0]
+            if op in ALU | MUL_DIV or op == "mov" or op in LOADS:
+                replacement = (op, value, args[1])
+            elif op in COMPARES and is_register(args[1]):
+                replacement = (SWAPPED[op], args[1], value)
+            elif op in STORES:
+                source = None
+        if replacement == None and len(args) == 2 and op in COMPARES | STORES and is_register(args[1]) \
+                and args[1] in constants and args[0] != args[1] and args[1] not in live[i] \
+                and (op in STORES or is_register(args[0])):
+            source = args[1]
+            replacement = (op, args[0], constants[source][0])
+        if replacement == None and op == "push" and args[0] in constants and args[0] not in live[i]:
+            source = args[0]
+            replacement = ("push", constants[source][0])
+
+        if replacement != None:
+            _, push, pop = constants[source]
+            line.replace(*replacement)
+            if push != None:
+                delete(block, push)
+                delete(block, pop)
+            constants.pop(source)
+            changes += 1
+            reads, writes = effects(line)
+
+        if op == "pop" and line.op == "pop":
+            entry = stack.pop() if stack else None
+            for register in writes:
+                constants.pop(register, None)
+            if entry != None and args[0] not in RESERVED:
+                constants[args[0]] = (entry[0], entry[1], line)
+            continue
+        if line.op == "push":
+            value = line.args[0] if not is_register(line.args[0]) else constants.get(line.args[0], (None,))[0]
+            # Values that were popped already can't be pushed again without the first push
+            if value != None and is_register(line.args[0]) and constants[line.args[0]][1] != None:
+                value = None
+            stack.append((value, line) if value != None else None)
+            continue
+        if "$15" in reads | writes or is_barrier(line):
+            # Anything else using the stack pointer makes the pushed values unknown
+            stack = [None] * len(stack) if line.op in ("call", "calli") else []
+            constants = {}
+            continue
+        for register in writes:
+            constants.pop(register, None)
+        if line.op == "mov" and line.args[1] not in RESERVED and (not is_register(line.args[0]) or line.args[0] == "$0"):
+            constants[line.args[1]] = (line.args[0], None, None)
+    return changes
+
+def pass_dead(block, unit):
+    # Removes instructions that only write registers that aren't used afterwards. Loads are only
+    # removed when they read the stack or a label, reading device memory can have side effects
+    safe = set() # Registers holding an address on the stack or of a label
+    safe_loads = set()
+    for line in block.lines:
+        op, args = line.op, line.args
+        if op in LOADS and (args[0] in safe or args[0][0] == "#"):
+            safe_loads.add(line)
+        reads, writes = effects(line)
+        if op == "mov" and (args[0] in ("$12", "$15") or args[0][0] == "#"):
+            safe.add(args[1])
+        elif op in ("add", "sub") and not is_register(args[0]) and args[1] in safe:
+            pass
+        else:
+            safe -= writes
+
+    changes = 0
+    live = set(block.live_out)
+    for line in reversed(list(block.lines)):
+        reads, writes = effects(line)
+        pure = (line.op in ALU or line.op == "mov" or line.op == "mul" or line in safe_loads) and len(line.args) == 2
+        if pure and writes and not writes & live and not (line.op == "mov" and "$15" in writes):
+            delete(block, line)
+            changes += 1
+            continue
+        live = (live - writes) | reads
+    return changes
+
+def pass_registers(block, unit):
+    # push $a / ... / pop $b -> mov $a $s / ... / mov $s $b, with a scratch register that isn't
+    # used anywhere in the unit. Pairs around calls or other uses of the stack pointer are kept
+    changes = 0
+    free = [register for register in SCRATCH if register not in unit.mentioned]
+    if not free:
+        return 0
+    stack = [] # [push line, scratch registers used inside, usable]
+    for line in list(block.lines):
+        if line.op == "push":
+            stack.append([line, set(), True])
+            continue
+        if line.op == "pop":
+            if not stack:
+                continue
+            push, used, usable = stack.pop()
+            dest = line.args[0]
+            available = [register for register in free if register not in used]
+            if usable and available and dest not in ("$0", "$15") and push.args[0] != "$15":
+                scratch = available[0]
+                push.replace("mov", push.args[0], scratch)
+                line.replace("mov", scratch, dest)
+                used.add(scratch)
+                changes += 1
+            if stack:
+                stack[-1][1].update(used)
+            continue
+        reads, writes = effects(line)
+        if "$15" in reads | writes or is_barrier(line):
+            for entry in stack:
+                entry[2] = False
+    return changes
+
+def pass_copies(block, unit):
+    # mov $s $d / <reads of $d> -> <reads of $s>, and <writes of $a> / mov $a $s -> <writes of $s>,
+    # when the renamed register isn't used afterwards
+    changes = 0
+    i = 0
+    live = live_after(block)
+    while i < len(block.lines):
+        line = block.lines[i]
+        if not (line.op == "mov" and len(line.args) == 2 and is_register(line.args[0])):
+            i += 1
+            continue
+        source, dest = line.args
+        if source in RESERVED or dest in RESERVED or source == dest:
+            i += 1
+            continue
+
+        # Forward: every read of $d until it dies reads $s instead
+        end = None
+        for j in range(i + 1, len(block.lines)):
+            other = block.lines[j]
+            reads, writes = effects(other)
+            if is_barrier(other) or source in writes:
+                break
+            if dest in writes:
+                break
+            if dest in reads and dest not in live[j]:
+                end = j
+                break
+        if end != None:
+            for other in block.lines[i + 1:end + 1]:
+                if dest in other.args:
+                    rename(other, dest, source)
+            delete(block, line)
+            del live[i]
+            # Only the renamed lines can have different registers live after them
+            for j in reversed(range(i, end - 1)):
+                reads, writes = effects(block.lines[j + 1])
+                live[j] = (live[j + 1] - writes) | reads
+            changes += 1
+            continue
+
+        # Backward: the code computing $s writes $d directly
+        if source not in live[i]:
+            start = None
+            for j in reversed(range(i)):
+                other = block.lines[j]
+                reads, writes = effects(other)
+                if is_barrier(other) or dest in reads | writes:
+                    break
+                if source in writes and source not in reads:
+                    start = j
+                    break
+            if start != None and all(not is_barrier(other) for other in block.lines[start:i]):
+                for other in block.lines[start:i]:
+                    if source in other.args:
+                        rename(other, source, dest)
+                delete(block, line)
+                # Lines before aren't looked at again
+                del live[i]
+                changes += 1
+                continue
+        i += 1
+    return changes
+
+PASSES = {
+    "constants": pass_constants,
+    "dead": pass_dead,
+    "registers": pass_registers,
+    "copies": pass_copies,
+}
+
+class Unit:
+    # Assembly of a module being optimized
+    def __init__(self, code):
+        self.lines = peephole.Peephole.split(code)
+        # Registers used anywhere, including inline assembly
+        self.mentioned = set(REGISTER.findall(code))
+
+    def text(self):
+        return "\n".join([line.text for line in self.lines if not line.deleted])
+
+class Optimizer:
+    # Runs the passes and the peephole rules until nothing changes. Same interface as
+    # peephole.Peephole, so it can replace it anywhere
+    def __init__(self, passes=None, peephole_rules=None):
+        self.passes = {name: PASSES[name] for name in (PASSES.keys() if passes == None else passes)}
+        self.peephole = peephole.Peephole(peephole_rules)
+        self.stats = {name: 0 for name in self.passes}
+
+    def run_passes(self, code):
+        unit = Unit(code)
+        changed = False
+        # Liveness can only get smaller while the passes run, so it's computed once for all of them
+        blocks = split_blocks(unit.lines)
+        compute_liveness(blocks)
+        for name, function in self.passes.items():
+            for block in blocks:
+                count = function(block, unit)
+                self.stats[name] += count
+                changed = changed or count > 0
+        return unit.text(), changed
+
+    def optimize(self, code):
+        # The peephole rules run until nothing changes, so they only need to run again when the
+        # passes changed something
+        changed = True
+        while changed:
+            code = self.peephole.optimize(code)
+            code, changed = self.run_passes(code)
+        return code
+
+    def report(self):
+        lines = [f"{name:<13} {count}" for name, count in self.stats.items()]
+        return "\n".join(lines) + "\n" + self.peephole.report()
+
+def parse_passes(passes, disable):
+    names = list(PASSES.keys()) if passes == None else [name for name in passes.split(",") if name]
+    if disable != None:
+        names = [name for name in names if name not in disable.split(",")]
+    for name in names:
+        if name not in PASSES:
+            raise click.BadParameter(f"unknown pass '{name}', available passes: {', '.join(PASSES.keys())}")
+    return names
+
+@click.command()
+@click.argument("file", type=click.File("r"), required=True)
+@click.option("--output", "-o", type=click.File("w"), default="-", help="Output file to write to.")
+@click.option("--passes", default=None, help="Comma separated list of passes to run (default: all).")
+@click.option("--disable", default=None, help="Comma separated list of passes to skip.")
+@click.option("--stats", is_flag=True, default=False, help="Prints how many times each pass and peephole rule changed the code.")
+def run(file, output, passes, disable, stats):
+    """Optimizes assembly generated by kl.py or compiler.py."""
+    optimizer = Optimizer(parse_passes(passes, disable))
+    output.write(optimizer.optimize(file.read()))
+
+    if stats:
+        click.echo(optimizer.report(), err=True)
+
+if __name__ == "__main__":
+    run()
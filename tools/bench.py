@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import glob
+import time
+import click
+import lark
+
+import kl
+import assembler
+import backend
+import emulator
+
+VERSION = 1
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Programs in the suite, relative to the root of the repository. Each one has a `main` function
+# and is linked with the modules it imports
+SUITE = ["bench/*.kl", "boot/main.kl", "tools/example.kl"]
+
+# Runs are stopped after this many instructions, so a program that never halts still gets a count
+MAX_INSTRUCTIONS = 5000000
+
+# Times smaller than this are too noisy to be flagged, in seconds
+MIN_TIME_CHANGE = 0.005
+
+def find_benchmarks(names=()):
+    # Benchmark name (path without extension) -> path, both relative to the root
+    benchmarks = {}
+    for pattern in SUITE:
+        for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            path = os.path.relpath(path, ROOT)
+            benchmarks[os.path.splitext(path)[0]] = path
+    if names:
+        unknown = [name for name in names if name not in benchmarks]
+        if unknown:
+            raise click.UsageError(f"unknown benchmarks: {', '.join(unknown)}")
+        benchmarks = {name: benchmarks[name] for name in names}
+    return benchmarks
+
+def compile_modules(file, optimize):
+    # Compiles a program and everything it imports, returns path -> assembly in link order. Paths
+    # are relative to the working directory like the imports themselves
+    modules = {}
+    pending = [file]
+    while pending:
+        path = os.path.normpath(pending.pop(0))
+        if path in modules:
+            continue
+        compiler = kl.compile_file(path)
+        code = compiler.code
+        if optimize:
+            code = backend.Optimizer().optimize(code)
+        modules[path] = code
+        pending += compiler.imports
+    return modules
+
+def build(path, optimize=False, repeat=1):
+    # Builds a program like boot/build.py, returns the image and the best compile and assemble times
+    directory, file = os.path.split(os.path.join(ROOT, path))
+    # Programs without their own init.asm use the freestanding one of the tools
+    init = os.path.join(directory, "init.asm")
+    if not os.path.exists(init):
+        init = os.path.join(ROOT, "tools", "init.asm")
+
+    old_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        compile_time = assemble_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            modules = compile_modules(file, optimize)
+            elapsed = time.perf_counter() - start
+            compile_time = elapsed if compile_time == None else min(compile_time, elapsed)
+
+            def parse(unit):
+                if unit.endswith(".kl.out"):
+                    return assembler.parser.parse(modules[unit[:-4]])
+                return assembler.parse_file(unit)
+
+            units = ["@RELOC:0x200", init] + [module + ".out" for module in modules]
+            start = time.perf_counter()
+            code = assembler.build(units, parse=parse, verbose=False).code
+            elapsed = time.perf_counter() - start
+            assemble_time = elapsed if assemble_time == None else min(assemble_time, elapsed)
+    finally:
+        os.chdir(old_directory)
+
+    return bytes(code), compile_time, assemble_time
+
+def measure(path, optimize=False, repeat=1, max_instructions=MAX_INSTRUCTIONS):
+    try:
+        code, compile_time, assemble_time = build(path, optimize, repeat)
+    except kl.CompileError as e:
+        return {"path": path, "error": kl.format_error(e)}
+    except (lark.exceptions.LarkError, OSError) as e:
+        return {"path": path, "error": f"ERROR: {e}"}
+
+    machine = emulator.Emulator()
+    machine.load(code)
+    try:
+        machine.run(max_instructions)
+        state = "halted" if machine.halted else "limit"
+    except emulator.CpuException as e:
+        state = f"{type(e).__name__} at 0x{e.ip:X}"
+
+    return {
+        "path": path,
+        "compile_time": compile_time,
+        "assemble_time": assemble_time,
+        "bytes": len(code),
+        "instructions": machine.instructions,
+        "state": state,
+    }
+
+def compare(baseline, results, time_threshold):
+    # Lines describing every difference, and whether any of them is a regression
+    lines = []
+    regressed = False
+    old_benchmarks = baseline["benchmarks"]
+    new_benchmarks = results["benchmarks"]
+
+    if baseline.get("options") != results.get("options"):
+        lines.append(f"warning: options differ ({baseline.get('options')} -> {results.get('options')})")
+
+    for name in sorted(set(old_benchmarks) | set(new_benchmarks)):
+        old = old_benchmarks.get(name)
+        new = new_benchmarks.get(name)
+        if old == None or new == None:
+            lines.append(f"{name}: {'new benchmark' if old == None else 'missing'}")
+            continue
+        if "error" in new:
+            if "error" not in old:
+                lines.append(f"{name}: REGRESSION, fails to build: {new['error'].splitlines()[0]}")
+                regressed = True
+            continue
+        if "error" in old:
+            lines.append(f"{name}: builds again")
+            continue
+
+        changes = []
+        if new["state"] != old["state"]:
+            changes.append(f"REGRESSION state {old['state']} -> {new['state']}")
+            regressed = True
+        for key in ("instructions", "bytes"):
+            if new[key] != old[key]:
+                change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0
+                flag = "REGRESSION " if new[key] > old[key] else ""
+                changes.append(f"{flag}{key} {old[key]} -> {new[key]} ({change:+.2f}%)")
+                regressed = regressed or new[key] > old[key]
+        for key in ("compile_time", "assemble_time"):
+            difference = new[key] - old[key]
+            if abs(difference) < MIN_TIME_CHANGE or abs(difference) < old[key] * time_threshold:
+                continue
+            flag = "REGRESSION " if difference > 0 else ""
+            changes.append(f"{flag}{key} {old[key] * 1000:.1f}ms -> {new[key] * 1000:.1f}ms ({difference / old[key] * 100:+.1f}%)")
+            regressed = regressed or difference > 0
+        if changes:
+            lines.append(f"{name}: " + ", ".join(changes))
+
+    return lines, regressed
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.argument("names", nargs=-1)
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes the results to a JSON file.")
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Runs the optimizer of backend.py on compiled modules.")
+@click.option("--repeat", "-r", type=int, default=3, help="Builds each program this many times and keeps the best times.")
+@click.option("--max-instructions", "-n", type=int, default=MAX_INSTRUCTIONS, help="Stops each run after this many instructions.")
+def run(names, output, optimize, repeat, max_instructions):
+    """Builds and runs the benchmarks named NAMES (like 'bench/loop' or 'boot/main'), or all of them."""
+    if repeat < 1:
+        click.echo("ERROR: repeat must be at least 1", err=True)
+        exit(1)
+
+    results = {
+        "version": VERSION,
+        "options": {"optimize": optimize, "max_instructions": max_instructions},
+        "benchmarks": {},
+    }
+    for name, path in find_benchmarks(names).items():
+        result = measure(path, optimize, repeat, max_instructions)
+        results["benchmarks"][name] = result
+        if "error" in result:
+            click.echo(f"{name:<16} {result['error'].splitlines()[0]}")
+        else:
+            click.echo(f"{name:<16} compile {result['compile_time'] * 1000:7.1f}ms  assemble {result['assemble_time'] * 1000:7.1f}ms  "
+                       f"{result['bytes']:>6} bytes  {result['instructions']:>9} instructions ({result['state']})")
+
+    if output != None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+@cli.command("compare")
+@click.argument("baseline", type=click.Path(exists=True), required=True)
+@click.argument("results", type=click.Path(exists=True), required=True)
+@click.option("--time-threshold", "-t", type=float, default=0.1, help="Relative increase of a time flagged as a regression (default 0.1).")
+def compare_command(baseline, results, time_threshold):
+    """Compares RESULTS with BASELINE, both written by `run`, and fails if anything got worse."""
+    files = []
+    for path in (baseline, results):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            click.echo(f"ERROR: unsupported results version {data.get('version')} in {path}", err=True)
+            exit(1)
+        files.append(data)
+
+    lines, regressed = compare(*files, time_threshold)
+    for line in lines:
+        click.echo(line)
+    if not lines:
+        click.echo("no changes")
+    if regressed:
+        exit(1)
+
+if __name__ == "__main__":
+    cli()
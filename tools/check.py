@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import click
+
+import kl
+import assembler
+import disassembler
+import peephole
+import backend
+import icf
+import harness
+from emulator import CpuException
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (kind, rule or pass, before, after). Every rule and pass needs at least one case, cases whose
+# `after` is the same as `before` check that the rule leaves the code alone
+CASES = [
+    ("peephole", "push-pop", "push $1\npop $2\n", "mov $1 $2\n"),
+    ("peephole", "push-pop", "push $3\npop $3\n", "\n"),
+    ("peephole", "push-pop", "push $15\npop $2\n", "push $15\npop $2\n"),
+    ("peephole", "push-mov-pop", "push $1\nmov 5 $3\npop $2\n", "mov $1 $2\nmov 5 $3\n"),
+    ("peephole", "push-mov-pop", "push $1\nmov $2 $3\npop $2\n", "push $1\nmov $2 $3\npop $2\n"),
+    ("peephole", "self-mov", "mov $3 $3\nret\n", "ret\n"),
+    ("peephole", "dead-mov", "mov 4 $2\nmov 5 $2\n", "mov 5 $2\n"),
+    ("peephole", "dead-mov", "mov 4 $2\nmov $2 $2\n", "mov 4 $2\nmov $2 $2\n"),
+    ("peephole", "mov-back", "mov $1 $2\nmov $2 $1\n", "mov $1 $2\n"),
+    ("peephole", "identity", "add 0 $3\nshl $0 $4\nret\n", "ret\n"),
+    ("peephole", "identity", "add 1 $3\n", "add 1 $3\n"),
+    ("peephole", "jump-next", "jt #next\n; comment\n#next:\nret\n", "; comment\n#next:\nret\n"),
+    ("peephole", "jump-next", "j #other\n#next:\n#other:\n", "#next:\n#other:\n"),
+    ("peephole", "pop-chain", "pop $0\npop $0\npop $0\nret\n", "add 12 $15\nret\n"),
+    ("peephole", "pop-chain", "pop $0\npop $0\nret\n", "pop $0\npop $0\nret\n"),
+    ("peephole", "unreachable", "ret\nmov 1 $1\npush $1\n#next:\nret\n", "ret\n#next:\nret\n"),
+    ("peephole", "unreachable", "; begin asm\nret\nmov 1 $1\n; end asm\n", "; begin asm\nret\nmov 1 $1\n; end asm\n"),
+    ("backend", "constants", "mov 5 $2\npush $2\nmov 1 $1\npop $2\nadd $2 $1\nret\n", "mov 5 $2\nmov 1 $1\nadd 5 $1\nret\n"),
+    ("backend", "constants", "mov 5 $2\npush $2\ncall #f\npop $2\nadd $2 $1\nret\n", "mov 5 $2\npush $2\ncall #f\npop $2\nadd $2 $1\nret\n"),
+    ("backend", "constants", "mov 3 $2\nclt $2 $1\nret\n", "mov 3 $2\ncgt $1 3\nret\n"),
+    ("backend", "constants", "mov 5 $3\nclt $1 $3\nret\n", "mov 5 $3\nclt $1 5\nret\n"),
+    ("backend", "constants", "mov 5 $3\nclt 3 $3\nret\n", "mov 5 $3\nclt 3 $3\nret\n"),
+    ("backend", "constants", "mov #x $3\nstd $1 $3\nret\n", "mov #x $3\nstd $1 #x\nret\n"),
+    ("backend", "dead", "mov 5 $2\nadd 1 $2\nmov 3 $1\nret\n", "mov 3 $1\nret\n"),
+    ("backend", "dead", "mov #x $2\nldd $2 $3\nret\n", "ret\n"),
+    ("backend", "dead", "ldd $2 $3\nret\n", "ldd $2 $3\nret\n"),
+    ("backend", "registers", "push $1\nadd 4 $2\npop $3\nmov $3 $1\nret\n", "mov $1 $11\nadd 4 $2\nmov $11 $3\nmov $3 $1\nret\n"),
+    ("backend", "registers", "push $1\ncall #f\npop $1\nret\n", "push $1\ncall #f\npop $1\nret\n"),
+    ("backend", "copies", "mov $2 $3\nadd $3 $1\nret\n", "add $2 $1\nret\n"),
+    ("backend", "copies", "ldd $3 $2\nmov $2 $1\nret\n", "ldd $3 $1\nret\n"),
+    ("backend", "copies", "mov $2 $3\ncall #f\nadd $3 $1\nret\n", "mov $2 $3\ncall #f\nadd $3 $1\nret\n"),
+    ("icf", "functions",
+        "#main:\ncall #a\ncall #b\nret\n"
+        "#a:\n.func #a\nmov 1 $1\nret\n.endfunc\n"
+        "#b:\n.func #b\nmov 1 $1\nret\n.endfunc\n",
+        "#main:\ncall #a\ncall #a\nret\n"
+        "#a:\nmov 1 $1\nret\n"),
+    ("icf", "functions",
+        "#main:\ncall #c\ncall #d\nret\n"
+        "#c:\n.func #c\ncall #a\nret\n.endfunc\n"
+        "#d:\n.func #d\ncall #b\nret\n.endfunc\n"
+        "#a:\n.func #a\nmov 1 $1\nret\n.endfunc\n"
+        "#b:\n.func #b\nmov 1 $1\nret\n.endfunc\n",
+        "#main:\ncall #c\ncall #c\nret\n"
+        "#c:\ncall #a\nret\n"
+        "#a:\nmov 1 $1\nret\n"),
+    ("icf", "functions",
+        "#main:\ncall #a\ncall #b\nret\n"
+        "#a:\n.func #a\nmov #x $1\nret\n.endfunc\n"
+        "#b:\n.func #b\nmov #y $1\nret\n.endfunc\n"
+        "#x:\n.dword 1\n#y:\n.dword 1\n",
+        "#main:\ncall #a\ncall #b\nret\n"
+        "#a:\nmov #x $1\nret\n"
+        "#b:\nmov #y $1\nret\n"
+        "#x:\n.dword 1\n#y:\n.dword 1\n"),
+    ("icf", "tails",
+        "#f:\n.func #f\ncgt $1 5\njt #other\n"
+        "mov 1 $2\nadd $2 $1\nmov 7 $3\nadd $3 $1\nret\n"
+        "#other:\nmov 2 $2\nadd $2 $1\nmov 7 $3\nadd $3 $1\nret\n.endfunc\n",
+        "#f:\ncgt $1 5\njt #other\n"
+        "mov 1 $2\n#tail:\nadd $2 $1\nmov 7 $3\nadd $3 $1\nret\n"
+        "#other:\nmov 2 $2\nj #tail\n"),
+    # Shorter than the jump replacing it
+    ("icf", "tails",
+        "#f:\n.func #f\ncgt $1 5\njt #other\n"
+        "mov 1 $2\nadd $2 $1\nret\n"
+        "#other:\nmov 2 $2\nadd $2 $1\nret\n.endfunc\n",
+        "#f:\ncgt $1 5\njt #other\n"
+        "mov 1 $2\nadd $2 $1\nret\n"
+        "#other:\nmov 2 $2\nadd $2 $1\nret\n"),
+    ("lto", "removal",
+        "(static uint32 result)\n(static uint32 unused-static 4)\n"
+        "(fn uint32 unused ((uint32 a))\n(return (+ a 1)))\n"
+        "(fn void main ()\n(set-var result 3))\n",
+        "(static uint32 result)\n"
+        "(fn void main ()\n(set-var result 3))\n"),
+    ("lto", "statics",
+        "(static uint32 limit 10)\n(static uint32 result)\n"
+        "(fn void main ()\n(set-var result limit))\n",
+        "(static uint32 result)\n"
+        "(fn void main ()\n(set-var result 10))\n"),
+    ("lto", "statics",
+        "(static uint32 limit 10)\n(static uint32 result)\n"
+        "(fn void main ()\n(set-var limit 5)\n(set-var result limit))\n",
+        "(static uint32 limit 10)\n(static uint32 result)\n"
+        "(fn void main ()\n(set-var limit 5)\n(set-var result limit))\n"),
+    ("lto", "statics",
+        "(static uint32 limit 10)\n(static uint32 result)\n"
+        "(fn void main ()\n(asm \"mov #limit $1\")\n(set-var result limit))\n",
+        "(static uint32 limit 10)\n(static uint32 result)\n"
+        "(fn void main ()\n(asm \"mov #limit $1\")\n(set-var result limit))\n"),
+]
+
+# Modules of boot/build.py, in link order
+BOOT = ["main.kl", "graphics.kl", "device.kl", "keyboard.kl", "utils.kl"]
+
+# Builds of the boot image compared with the plain one: (optimize, lto, icf)
+BUILDS = {
+    "-O": (True, False, False),
+    "--lto": (False, True, False),
+    "--icf": (False, False, True),
+    "-O --lto --icf": (True, True, True),
+}
+
+# Sectors of the disks the boot menu lists, and the keys moving through it
+BOOT_DISKS = [1, 2]
+BOOT_KEYS = ["down", "up", "down"]
+BOOT_SETTLE = 50000
+BOOT_MAX_INSTRUCTIONS = 20000000
+
+def link(code, fold=None):
+    # Disassembly of the code linked at 0x200, after folding functions (and merging tails when
+    # `fold` is "tails") with icf.py
+    linked = assembler.build(["@RELOC:0x200", "<case>"], parse=lambda _: assembler.parser.parse(code), verbose=False)
+    if fold != None:
+        icf.fold(linked, merge_tails=fold == "tails")
+    data = bytes(linked.code)
+    return "\n".join(disassembler.disassemble(data, 0x200, 0x200, 0x200 + len(data), disassembler.Symbolizer(), show_bytes=False))
+
+def compile_kl(code, lto=False):
+    # Assembly of a KL module, compiled on its own or as a whole program with --lto
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "case.kl")
+        with open(path, "w") as f:
+            f.write(code)
+        if lto:
+            compilers, _ = kl.compile_program([path])
+            return compilers[path].code
+        return kl.compile_file(path).code
+
+def same(code):
+    return code
+
+# Kind -> (names every case must cover, runs one of them on `before`, turns `after` into what it
+# should return)
+KINDS = {
+    "peephole": (peephole.RULES, lambda name, code: peephole.Peephole([name]).optimize(code), same),
+    # Without peephole rules, but repeated until nothing changes like in kl.py -O
+    "backend": (backend.PASSES, lambda name, code: backend.Optimizer([name], []).optimize(code), same),
+    # Labels are gone after linking, so the binaries are compared
+    "icf": (("functions", "tails"), lambda name, code: link(code, name), link),
+    # KL compiled with --lto should give the same code as `after` compiled without it. Inlining
+    # and the register convention can't be written in KL, they are left to `boot`
+    "lto": (("removal", "statics"), lambda name, code: compile_kl(code, lto=True), compile_kl),
+}
+
+def normalize(code):
+    # Indentation and blank lines don't matter
+    return "\n".join(line.strip() for line in code.split("\n") if line.strip())
+
+def check(kind, name, before, after):
+    # Returns what was expected and what the rule generated when they differ, None otherwise
+    _, run, expect = KINDS[kind]
+    result = run(name, before)
+    expected = expect(after)
+    return None if normalize(result) == normalize(expected) else (expected, result)
+
+def build_boot(optimize=False, lto=False, fold=False):
+    # Image of boot/ built like boot/build.py with the given options of kl.py and assembler.py
+    old_directory = os.getcwd()
+    os.chdir(os.path.join(ROOT, "boot"))
+    try:
+        if lto:
+            compilers, _ = kl.compile_program(BOOT, func_directives=fold)
+        else:
+            compilers = {file: kl.compile_file(file, func_directives=fold) for file in BOOT}
+        modules = {}
+        for file, compiler in compilers.items():
+            code = compiler.code
+            if optimize:
+                code = backend.Optimizer().optimize(code)
+            modules[file + ".out"] = code
+
+        def parse(unit):
+            if unit in modules:
+                return assembler.parser.parse(modules[unit])
+            return assembler.parse_file(unit)
+
+        return bytes(assembler.build(["@RELOC:0x200", "init.asm", *modules], parse=parse, verbose=False, fold=fold).code)
+    finally:
+        os.chdir(old_directory)
+
+def boot(code):
+    # Boots an image like `harness.py --keys ... --settle`, returns why it stopped, how many
+    # instructions ran and the screen
+    machine = harness.Machine(disks=[bytearray(harness.SECTOR_SIZE * sectors) for sectors in BOOT_DISKS])
+    machine.load(code)
+    machine.keyboard.type([harness.parse_key(key) for key in BOOT_KEYS])
+    try:
+        reason = machine.run_until(BOOT_MAX_INSTRUCTIONS, BOOT_SETTLE)
+    except CpuException as e:
+        reason = f"{type(e).__name__} at 0x{e.ip:X}"
+    return reason, machine.instructions, bytes(machine.monitor.pixels(machine))
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.argument("names", nargs=-1)
+def rules(names):
+    """Runs every rule or pass named NAMES (like 'peephole/push-pop' or 'lto') on small
+    pieces of code and compares the result with the expected code."""
+    cases = [case for case in CASES if not names or case[0] in names or f"{case[0]}/{case[1]}" in names]
+    if not cases:
+        raise click.UsageError(f"no cases for {', '.join(names)}")
+    failed = 0
+    for kind, name, before, after in cases:
+        result = check(kind, name, before, after)
+        if result != None:
+            failed += 1
+            click.echo(f"FAILED {kind}/{name}")
+            for title, code in (("before", before), ("expected", result[0]), ("got", result[1])):
+                click.echo(f"  {title}:")
+                for line in normalize(code).split("\n"):
+                    click.echo(f"    {line}")
+
+    # Checked on every run, so a new rule without cases is noticed
+    checked = {(kind, name) for kind, name, _, _ in CASES}
+    missing = [f"{kind}/{name}" for kind, (all_names, _, _) in KINDS.items() for name in all_names if (kind, name) not in checked]
+    if missing:
+        click.echo(f"no cases for {', '.join(missing)}")
+
+    click.echo(f"{len(cases)} cases, {failed} failed")
+    if failed or missing:
+        exit(1)
+
+@cli.command("boot")
+def boot_command():
+    """Builds boot/ with -O, --lto and --icf, boots every image in the harness with the same disks
+    and keys, and compares the screen with the plain build."""
+    reason, instructions, screen = boot(build_boot())
+    click.echo(f"{'plain':<16} {reason} after {instructions} instructions")
+    if reason != "idle":
+        click.echo("ERROR: the plain build didn't get to the menu", err=True)
+        exit(1)
+
+    failed = False
+    for name, options in BUILDS.items():
+        try:
+            result = boot(build_boot(*options))
+        except kl.CompileError as e:
+            click.echo(f"{name:<16} {kl.format_error(e).splitlines()[0]}")
+            failed = True
+            continue
+        differences = [what for what, same in (("stopped", result[0] == reason), ("screen", result[2] == screen)) if not same]
+        failed = failed or bool(differences)
+        status = f"DIFFERENT {' and '.join(differences)}" if differences else "same screen"
+        click.echo(f"{name:<16} {result[0]} after {result[1]} instructions, {status}")
+
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    cli()
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
+import os
+import re
+import json
+import pickle
+import hashlib
 import pycparser
 from pycparser import c_ast
 import click
 
+import backend
+from timings import Timings, NO_TIMINGS, finish
+
 def flatten(l):
     for e in l:
         if isinstance(e, list):
@@ -12,24 +20,109 @@ def flatten(l):
         else:
             yield e
 
-def chunks(l, n):
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
 class CompileError(Exception):
     def __init__(self, message, node):
         super().__init__(message)
         self.message = message
         self.node = node
 
+# Local arrays up to this size are initialized with a push for each dword, bigger ones with a loop
+MAX_PUSHED_DWORDS = 8
+
+# Changing this invalidates every cached file, needed when the format of the cache changes
+CACHE_VERSION = 1
+
+# Line markers written by cpp, `# 12 "file.h" 1`
+LINE_MARKER = re.compile(r'^#\s*(?:line\s+)?\d+\s+"([^"]*)"', re.MULTILINE)
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class ParseCache:
+    # Keeps the preprocessed text and syntax tree of every file parsed in a directory, so files that
+    # didn't change skip both cpp and pycparser. An entry is found by the hash of the file and the
+    # cpp command, and is only used if every included file still has the same hash
+    def __init__(self, directory, cpp_path="cpp", cpp_args=(), timings=NO_TIMINGS):
+        self.directory = directory
+        self.timings = timings
+        self.cpp_path = cpp_path
+        self.cpp_args = list(cpp_args)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, file):
+        # Includes are looked up relative to the file, so its path is part of the key too
+        key = [CACHE_VERSION, pycparser.__version__, os.path.abspath(file), hash_file(file), self.cpp_path, self.cpp_args]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        # Written to a temporary file first, so other compilers never read half of a file
+        temporary = self.path(f"{name}.{os.getpid()}.tmp")
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self.path(name))
+
+    def lookup(self, file):
+        # Syntax tree of a file if it's cached and none of its dependencies changed
+        try:
+            with open(self.path(self.key(file) + ".json"), "r") as f:
+                entry = json.load(f)
+            for path, digest in entry["dependencies"].items():
+                if hash_file(path) != digest:
+                    return None
+            with open(self.path(entry["text"] + ".ast"), "rb") as f:
+                return pickle.load(f)
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def parse(self, file):
+        with self.timings.phase("cache"):
+            ast = self.lookup(file)
+        if ast != None:
+            self.hits += 1
+            self.timings.count("cache hits")
+            return ast
+        self.misses += 1
+        self.timings.count("cache misses")
+
+        with self.timings.phase("preprocess"):
+            text = pycparser.preprocess_file(file, self.cpp_path, self.cpp_args)
+        text_hash = hashlib.sha1(text.encode()).hexdigest()
+        # Markers like <built-in> aren't files
+        dependencies = {os.path.abspath(path): hash_file(path) for path in set(LINE_MARKER.findall(text)) | {file} if os.path.isfile(path)}
+
+        # Different files or flags can give the same text, which is parsed only once
+        try:
+            with self.timings.phase("cache"):
+                with open(self.path(text_hash + ".ast"), "rb") as f:
+                    ast = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self.timings.phase("parse"):
+                ast = pycparser.CParser().parse(text, file)
+            with self.timings.phase("cache"):
+                self.write(text_hash + ".i", text.encode())
+                self.write(text_hash + ".ast", pickle.dumps(ast, pickle.HIGHEST_PROTOCOL))
+
+        with self.timings.phase("cache"):
+            self.write(self.key(file) + ".json", json.dumps({"dependencies": dependencies, "text": text_hash}).encode())
+        return ast
+
 class Compiler:
-    def __init__(self, comment=False):
+    def __init__(self, comment=False, func_directives=False):
         self.code = "" # Generated assembly code
         self.funcs = [] # List of function declaration nodes
         self.vars = [{}] # Stores variables and scopes (first scope is global)
         self.sp_offset = 0 # Keeps track of distance from base of stack frame to store local variables
+        self.func_name = None # Name of the function being compiled, used in labels
+        self.constants = set() # Symbols of the read-only constants already generated
 
         self.comment = comment # When set to true, will generate comments for the assembly code
+        self.func_directives = func_directives # When set to true, will generate .func directives for assembler.py --icf and --map
 
         self._unique_id = 0 # Used for control flow labels
 
@@ -144,21 +237,31 @@ class Compiler:
         return None
 
     def compile(self, ast):
-        self.code = ""
+        self.constants = set()
+        # Each declaration is generated into an empty string and joined at the end, since appending
+        # to one long string copies it every time
+        pieces = []
         for node in ast.ext:
+            self.code = ""
             self.generate_decl(node)
+            pieces.append(self.code)
+        self.code = "".join(pieces)
     
     def generate_decl(self, node):
         if isinstance(node, c_ast.FuncDef):
             self.funcs.append(node.decl)
             self.sp_offset = 0
+            self.func_name = node.decl.name
 
             # TODO: add support for static/inline functions (and variables)
             # $12 is used to store base pointer of function stack frame
             # push $12 - store old value of $12 in case the caller is using it
             # mov $15 $12 - move stack pointer to $12, stack frame starts here
             # From now on, the stack will be used to store local variables and temporary values
-            self.code += f".export #{node.decl.name}\n{node.decl.name}:\npush $12\nmov $15 $12\n"
+            self.code += f".export #{node.decl.name}\n" + backend.label(node.decl.name)
+            if self.func_directives:
+                self.code += f".func #{node.decl.name}\n"
+            self.code += backend.PROLOGUE
             self.generate_expression(node.body)
             if self.comment:
                 self.code += "; default return\n"
@@ -167,9 +270,16 @@ class Compiler:
                 self.code += "mov $0 $1\n"
             # mov $12 $15 - set stack pointer back to the start of stack frame
             # pop $12 - pop the old $12 value that was left in the stack
-            self.code += "mov $12 $15\npop $12\nret\n"
+            self.code += backend.EPILOGUE
+            if self.func_directives:
+                self.code += ".endfunc\n"
         elif isinstance(node, c_ast.Decl):
-            self.code += f".export #{node.name}\n{node.name}:\n"
+            # Globals are aligned to the size of their type (of their elements for arrays)
+            if isinstance(node.type, (c_ast.TypeDecl, c_ast.ArrayDecl)):
+                alignment = self.type_size(self.type_base(node.type))
+                if alignment > 1:
+                    self.code += f".align {alignment}\n"
+            self.code += f".export #{node.name}\n" + backend.label(node.name)
             if isinstance(node.type, c_ast.TypeDecl):
                 if node.init != None:
                     if isinstance(node.init, c_ast.Constant):
@@ -216,7 +326,7 @@ class Compiler:
 
             # Return value is stored in $1
             self.generate_expression(node.expr)
-            self.code += "mov $12 $15\npop $12\nret\n"
+            self.code += backend.EPILOGUE
         elif isinstance(node, c_ast.Decl):
             if isinstance(node.type, (c_ast.TypeDecl, c_ast.PtrDecl)):
                 if self.comment:
@@ -236,29 +346,41 @@ class Compiler:
                     self.code += f"; variable (array) {node.name}\n"
 
                 array = list(flatten(self.make_array(node.type, node.init)))
-                
-                # Encode array into a sequence of dwords to be pushed
-                size = self.type_size(self.type_base(node.type.type)) * 8
-                in_dword = 32 // size
-                array += [0] * (len(array) % in_dword)
-                pushed = 0
-
-                for chunk in chunks(array[::-1], in_dword):
-                    dword = 0
-                    for shift in reversed(range(in_dword)):
-                        # Assumes array dim is constant TODO
-                        if chunk[shift] != None:
-                            value = int(chunk[shift].value)
-                        else:
-                            value = 0
-                        dword |= value << (shift * size)
-                    if dword == 0:
-                        self.code += f"push $0\n"
+
+                # Contents of the array in memory, padded to dwords since the stack only holds dwords
+                element_size = self.type_size(self.type_base(node.type.type))
+                data = b""
+                for item in array:
+                    # Assumes array dim is constant TODO
+                    value = int(item.value, 0) if item != None else 0
+                    data += (value & ((1 << element_size * 8) - 1)).to_bytes(element_size, "little")
+                data += bytes(-len(data) % 4)
+                self.sp_offset -= len(data)
+
+                if len(data) <= MAX_PUSHED_DWORDS * 4:
+                    # Last dword is pushed first, so the first element is at the lowest address
+                    for i in reversed(range(0, len(data), 4)):
+                        dword = int.from_bytes(data[i:i + 4], "little")
+                        self.code += "push $0\n" if dword == 0 else f"push {dword}\n"
+                else:
+                    # Bigger arrays are filled by a loop from $register to the end in $register+1,
+                    # zeros are stored directly and anything else is copied from a read-only constant
+                    label = f"__array_{self.func_name}_{self.unique_id}"
+                    self.code += f"sub {len(data)} $15\nmov $15 ${register}\nmov $15 ${register+1}\nadd {len(data)} ${register+1}\n"
+                    if not any(data):
+                        self.code += backend.label(label)
+                        self.code += f"std $0 ${register}\n"
                     else:
-                        self.code += f"push {dword}\n"
-                    pushed += 1
+                        # Named after the contents like KL constants, so the assembler merges identical ones
+                        symbol = f"__const_{hashlib.sha1(data).hexdigest()[:16]}"
+                        if symbol not in self.constants:
+                            self.constants.add(symbol)
+                            self.code += f".rodata #{symbol} .align 4 .byte x\"{data.hex()}\"\n"
+                        self.code += f"mov #{symbol} ${register+2}\n"
+                        self.code += backend.label(label)
+                        self.code += f"ldd ${register+2} ${register+3}\nstd ${register+3} ${register}\nadd 4 ${register+2}\n"
+                    self.code += f"add 4 ${register}\nclt ${register} ${register+1}\njt #{label}\n"
 
-                self.sp_offset -= 4 * pushed
                 self.vars[-1][node.name] = (self.sp_offset, node.type)
             else:
                 raise CompileError(f"unknown declaration type `{node.type.__class__.__name__}`", node)
@@ -294,7 +416,7 @@ class Compiler:
             else:
                 self.code += f"push ${register+1}\n"
             self.generate_expression(node.subscript, register=register)
-            self.code += f"mul {self.type_size(type.type)} ${register}\nmov $13 ${register}\npop ${register+1}\nadd ${register} ${register+1}\n"
+            self.code += f"mul {self.type_size(type.type)} ${register}\npop ${register+1}\nadd $13 ${register+1}\n"
             # Workaround for multidimensional arrays: pointers to sub-arrays aren't actually created in memory
             if isinstance(type.type, c_ast.ArrayDecl):
                 self.code += f"mov ${register+1} ${register}\n"
@@ -308,15 +430,15 @@ class Compiler:
             # Generating a compound expression already makes a new scope so this one
             # only contains variables defined in the initial loop statement
             self.vars.append({})
-            id = self.unique_id
+            label = f"__for_{self.func_name}_{self.unique_id}"
             for decl in node.init:
                 self.generate_expression(decl, register=register)
-            self.code += f"_for{id}:\n"
+            self.code += backend.label(label)
             self.generate_expression(node.cond, register=register)
-            self.code += f"bf #_for{id}end\n"
+            self.code += f"jf #{label}_end\n"
             self.generate_expression(node.stmt, register=register)
             self.generate_expression(node.next, register=register)
-            self.code += f"b #_for{id}\n_for{id}end:\n"
+            self.code += f"j #{label}\n" + backend.label(f"{label}_end")
             self.vars.pop()
         elif isinstance(node, c_ast.BinaryOp):
             if self.comment:
@@ -330,15 +452,9 @@ class Compiler:
             type = self.generate_expression(node.left, register=register)
 
             self.code += f"pop ${register+1}\n"
-            self.code += {
-                "+": f"add ${register+1} ${register}\n",
-                "-": f"sub ${register+1} ${register}\n",
-                "*": f"mul ${register+1} ${register}\nmov $13 ${register}\n",
-                "/": f"div ${register+1} ${register}\nmov $14 ${register}\n",
-                "%": f"div ${register+1} ${register}\nmov $13 ${register}\n",
-                "<": f"clt ${register} ${register+1}\n",
-                ">": f"cgt ${register} ${register+1}\n",
-            }[node.op]
+            if node.op not in backend.BINARY_OPS:
+                raise CompileError(f"invalid binary operator `{node.op}`", node)
+            self.code += backend.binary(node.op, register, register+1)
             return type
         elif isinstance(node, c_ast.UnaryOp):
             if self.comment:
@@ -389,7 +505,8 @@ class Compiler:
                 if offset == -1: # Variable is global
                     self.code += f"mov #{node.name} ${register+1}\nld{self.size_directive(type)[0]} ${register+1} ${register}\n"
                 else:
-                    self.code += f"mov $12 ${register+1}\nsub {-offset} ${register+1}\nld{self.size_directive(type)[0]} ${register+1} ${register}\n"
+                    self.code += backend.frame_address(offset, register+1)
+                    self.code += f"ld{self.size_directive(type)[0]} ${register+1} ${register}\n"
             else:
                 raise CompileError(f"undefined variable `{node.name}`", node)
 
@@ -403,22 +520,51 @@ class Compiler:
 @click.argument("files", type=click.Path(exists=True), required=True, nargs=-1)
 @click.option("--comment", is_flag=True, default=False)
 @click.option("--show-ast", is_flag=True, default=False)
-def run(files, comment, show_ast):
-    compiler = Compiler(comment=comment)
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Runs the optimizer of backend.py on the generated assembly code")
+@click.option("--include", "-I", "includes", multiple=True, help="Adds a directory to the include path of cpp.")
+@click.option("--define", "-D", "defines", multiple=True, help="Defines a macro, like NAME or NAME=VALUE.")
+@click.option("--cache-dir", type=click.Path(file_okay=False), default=None, help="Keeps preprocessed files and syntax trees in a directory, unchanged files aren't parsed again.")
+@click.option("--func-directives", is_flag=True, default=False, help="Adds .func directives for assembler.py --icf and --map")
+@click.option("--timings", "show_timings", is_flag=True, default=False, help="Prints the time spent in each phase and counters of the work done")
+@click.option("--timings-json", type=click.Path(), default=None, help="Writes the timings and counters to a JSON file")
+def run(files, comment, show_ast, optimize, includes, defines, cache_dir, func_directives, show_timings, timings_json):
+    timings = Timings(enabled=show_timings or timings_json != None)
+    compiler = Compiler(comment=comment, func_directives=func_directives)
+    cpp_args = [f"-I{path}" for path in includes] + [f"-D{define}" for define in defines]
+    cache = ParseCache(cache_dir, cpp_args=cpp_args, timings=timings) if cache_dir != None else None
     for file in files:
-        ast = pycparser.parse_file(file, use_cpp=True)
+        if cache != None:
+            ast = cache.parse(file)
+        else:
+            # Same as pycparser.parse_file, in two steps to time them separately
+            with timings.phase("preprocess"):
+                text = pycparser.preprocess_file(file, "cpp", cpp_args)
+            with timings.phase("parse"):
+                ast = pycparser.CParser().parse(text, file)
         if show_ast:
             ast.show(showcoord=True)
         try:
-            compiler.compile(ast)
+            with timings.phase("codegen"):
+                compiler.compile(ast)
         except CompileError as e:
             click.echo(f"ERROR: {e.message} ({e.node.coord})", err=True)
             with open(e.node.coord.file, "r") as f:
                 click.echo(f.readlines()[e.node.coord.line - 1][:-1], err=True)
                 click.echo(" " * (e.node.coord.column - 1) + "^", err=True)
             exit(1)
-        with open(file + ".out", "w") as f:
-            f.write(compiler.code)
+        code = compiler.code
+        if optimize:
+            with timings.phase("optimize"):
+                code = backend.Optimizer().optimize(code)
+        timings.count("files")
+        timings.count("assembly lines", code.count("\n"))
+
+        with timings.phase("write"):
+            with open(file + ".out", "w") as f:
+                f.write(code)
+
+    timings.count("functions", len(compiler.funcs))
+    finish(timings, "compiler.py", show_timings, timings_json)
 
 if __name__ == "__main__":
-    run(None, None, None)
\ No newline at end of file
+    run()
\ No newline at end of file
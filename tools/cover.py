@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import bisect
+import hashlib
+import click
+
+from emulator import BOOT_ADDRESS
+from debuginfo import DebugInfo
+from disassembler import Source
+
+VERSION = 1
+
+class Coverage:
+    # Instructions that ran in an image, one bit per byte of the image set for the first byte of
+    # each instruction. The emulator marks an instruction when it decodes it, which only happens the
+    # first time it runs (or after the code is rewritten), so collecting costs almost nothing
+    def __init__(self, start, size, image=None):
+        self.start = start
+        self.size = size
+        self.image = image # SHA-1 of the image, runs of different builds can't be merged
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_image(cls, data, start=BOOT_ADDRESS):
+        return cls(start, len(data), hashlib.sha1(data).hexdigest())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"unsupported coverage version {data.get('version')}")
+        coverage = cls(data["start"], data["size"], data["image"])
+        bits = bytes.fromhex(data["bits"])
+        if len(bits) != len(coverage.bits):
+            raise ValueError("wrong amount of bits")
+        coverage.bits[:] = bits
+        return coverage
+
+    def save(self, path):
+        data = {
+            "version": VERSION,
+            "image": self.image,
+            "start": self.start,
+            "size": self.size,
+            "bits": self.bits.hex(),
+        }
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def mark(self, address):
+        offset = address - self.start
+        if 0 <= offset < self.size:
+            self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def merge(self, other):
+        if (other.start, other.size, other.image) != (self.start, self.size, self.image):
+            raise ValueError("coverage of a different image")
+        length = len(self.bits)
+        merged = int.from_bytes(self.bits, "little") | int.from_bytes(other.bits, "little")
+        self.bits[:] = merged.to_bytes(length, "little")
+
+    def addresses(self):
+        # Sorted addresses of the instructions that ran
+        result = []
+        for i, byte in enumerate(self.bits):
+            if byte:
+                result += [self.start + i * 8 + bit for bit in range(8) if byte >> bit & 1]
+        return result
+
+def merge_into(coverage, path):
+    # Adds the coverage of a run to a file. A file with the coverage of another image is replaced,
+    # returns False when that happened
+    merged = True
+    if os.path.exists(path):
+        try:
+            coverage.merge(Coverage.load(path))
+        except (ValueError, KeyError):
+            merged = False
+    coverage.save(path)
+    return merged
+
+class Report:
+    # Coverage of the source lines and functions of an image built with debug info. A line with code
+    # is covered when an instruction ran in one of the address ranges the line table gives it. Only
+    # ranges inside functions count, the other ones are static data
+    def __init__(self, coverage, debug_info):
+        self.lines = {} # File -> {line: covered}
+        self.functions = {} # File -> [(line, name, covered)]
+        addresses = coverage.addresses()
+        end = coverage.start + coverage.size
+
+        def ran(start, stop):
+            i = bisect.bisect_left(addresses, start)
+            return i < len(addresses) and addresses[i] < stop
+
+        entries = debug_info.lines
+        for i, (address, index, line, _) in enumerate(entries):
+            stop = entries[i + 1][0] if i + 1 < len(entries) else end
+            # Only the last entry at an address has a range
+            function = debug_info.function(address)
+            if index == -1 or stop == address or function == None:
+                continue
+            stop = min(stop, function[2])
+            lines = self.lines.setdefault(debug_info.files[index], {})
+            lines[line] = lines.get(line, False) or ran(address, stop)
+
+        for name, start, stop in debug_info.functions:
+            location = debug_info.line(start)
+            if location != None:
+                self.functions.setdefault(location[0], []).append((location[1], name, ran(start, start + 1)))
+
+    def summary(self):
+        # Table of the lines and functions of each file and how many of them ran
+        rows = []
+        for file in sorted(self.lines):
+            lines = self.lines[file]
+            functions = self.functions.get(file, [])
+            rows.append((file, len(lines), sum(lines.values()), len(functions), sum(covered for _, _, covered in functions)))
+        total = ("total",) + tuple(sum(row[i] for row in rows) for i in range(1, 5))
+        width = max(len(row[0]) for row in rows + [total])
+        text = [f"{'file':<{width}} {'lines':>6} {'covered':>8} {'':>7} {'functions':>10} {'covered':>8}"]
+        for file, lines, covered, functions, functions_covered in rows + [total]:
+            percent = 100 * covered / lines if lines else 100.0
+            text.append(f"{file:<{width}} {lines:>6} {covered:>8} {percent:>6.1f}% {functions:>10} {functions_covered:>8}")
+        return "\n".join(text)
+
+    def annotate(self, file, source):
+        # Source of a file with `+` before covered lines and `-` before lines with code that never ran
+        lines = self.lines.get(file, {})
+        source.line(file, 1) # Reads the file
+        text = []
+        for number, line in enumerate(source.files[file], 1):
+            mark = " " if number not in lines else "+" if lines[number] else "-"
+            text.append(f"{number:>5} {mark} {line}".rstrip())
+        return "\n".join(text)
+
+    def lcov(self, directory):
+        # Tracefile for lcov/genhtml, paths are made absolute from the directory of the image
+        text = ["TN:"]
+        for file in sorted(self.lines):
+            lines = self.lines[file]
+            functions = sorted(self.functions.get(file, []))
+            text.append(f"SF:{os.path.abspath(os.path.join(directory, file))}")
+            for line, name, _ in functions:
+                text.append(f"FN:{line},{name}")
+            for _, name, covered in functions:
+                text.append(f"FNDA:{int(covered)},{name}")
+            text.append(f"FNF:{len(functions)}")
+            text.append(f"FNH:{sum(covered for _, _, covered in functions)}")
+            for line in sorted(lines):
+                text.append(f"DA:{line},{int(lines[line])}")
+            text.append(f"LF:{len(lines)}")
+            text.append(f"LH:{sum(lines.values())}")
+            text.append("end_of_record")
+        return "\n".join(text) + "\n"
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.argument("inputs", type=click.Path(exists=True), required=True, nargs=-1)
+@click.option("--annotate", "-a", is_flag=True, default=False, help="Prints the source of every file with the lines that ran marked.")
+@click.option("--lcov", type=click.Path(), default=None, help="Writes an lcov tracefile.")
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes the merged coverage to a file.")
+def run(file, inputs, annotate, lcov, output):
+    """Reports which KL lines and functions of an image ran, from coverage files written by
+    harness.py or emulator.py --coverage. The image needs debug info."""
+    with open(file, "rb") as f:
+        coverage = Coverage.for_image(f.read())
+    for path in inputs:
+        try:
+            coverage.merge(Coverage.load(path))
+        except (ValueError, KeyError) as e:
+            click.echo(f"ERROR: invalid coverage file {path}: {e}", err=True)
+            exit(1)
+    if output != None:
+        coverage.save(output)
+
+    debug_info = DebugInfo.find(file)
+    if debug_info == None:
+        click.echo(f"ERROR: no debug info found for {file}, build it with -g", err=True)
+        exit(1)
+    report = Report(coverage, debug_info)
+    directory = os.path.dirname(os.path.abspath(file))
+
+    click.echo(report.summary())
+    if annotate:
+        source = Source(directory)
+        for path in sorted(report.lines):
+            click.echo(f"\n{path}")
+            click.echo(report.annotate(path, source))
+    if lcov != None:
+        with open(lcov, "w") as f:
+            f.write(report.lcov(directory))
+
+if __name__ == "__main__":
+    run()
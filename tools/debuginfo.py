@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import json
+import bisect
+import os
+import click
+
+# Extension of the sidecar file written next to the binary by the assembler
+EXTENSION = ".dbg"
+
+VERSION = 2
+
+class DebugInfo:
+    # Maps addresses in a linked binary to KL source lines and functions. Line entries start a range
+    # that lasts until the next entry, entries without a file end the previous range. Entries at the
+    # same address are all kept (they mark where each node of the source starts, see pgo.py) and the
+    # last one is used for the range
+    def __init__(self, files=(), lines=(), functions=(), symbols=None):
+        self.files = list(files) # Source file paths, lines refer to them by index
+        self.lines = sorted(lines, key=lambda entry: entry[0]) # (address, file index or -1, line, column)
+        self.functions = sorted(functions, key=lambda function: function[1]) # (name, start, end)
+        self.symbols = dict(symbols or {}) # Global symbols from the linker: name -> address
+        self.line_addresses = [entry[0] for entry in self.lines]
+        self.function_starts = [function[1] for function in self.functions]
+        self.sorted_symbols = sorted((address, name) for name, address in self.symbols.items())
+        self.symbol_addresses = [address for address, _ in self.sorted_symbols]
+
+    @classmethod
+    def from_entries(cls, lines, functions, symbols=None):
+        # Builds the tables from (address, file path or None, line, column) entries
+        files = []
+        indices = {}
+        compact = []
+        for address, file, line, column in sorted(lines, key=lambda entry: entry[0]):
+            if file == None:
+                index, line, column = -1, 0, 0
+            else:
+                if file not in indices:
+                    indices[file] = len(files)
+                    files.append(file)
+                index = indices[file]
+            # Ends of ranges followed by another range and repeated entries are useless
+            if compact and compact[-1][0] == address and compact[-1][1] == -1:
+                compact.pop()
+            if compact and compact[-1][1:] == (index, line, column):
+                continue
+            compact.append((address, index, line, column))
+        return cls(files, compact, functions, symbols)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"unsupported debug info version {data.get('version')}")
+        lines = [tuple(data["lines"][i:i + 4]) for i in range(0, len(data["lines"]), 4)]
+        functions = [tuple(function) for function in data["functions"]]
+        return cls(data["files"], lines, functions, data.get("symbols"))
+
+    @classmethod
+    def find(cls, binary):
+        # Debug info of a binary if it was built with it, None otherwise
+        path = binary + EXTENSION
+        return cls.load(path) if os.path.exists(path) else None
+
+    def save(self, path):
+        data = {
+            "version": VERSION,
+            "files": self.files,
+            # Flat list of address, file, line, column to keep the file small
+            "lines": [value for entry in self.lines for value in entry],
+            "functions": [list(function) for function in self.functions],
+            "symbols": self.symbols,
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    def line(self, address):
+        # (file, line) of the code at an address, or None
+        i = bisect.bisect_right(self.line_addresses, address) - 1
+        if i < 0 or self.lines[i][1] == -1:
+            return None
+        return (self.files[self.lines[i][1]], self.lines[i][2])
+
+    def positions(self):
+        # (address, file, line, column) of every entry
+        for address, index, line, column in self.lines:
+            if index != -1:
+                yield (address, self.files[index], line, column)
+
+    def function(self, address):
+        # (name, start, end) of the function containing an address, or None
+        i = bisect.bisect_right(self.function_starts, address) - 1
+        if i < 0 or address >= self.functions[i][2]:
+            return None
+        return self.functions[i]
+
+    def symbol(self, address):
+        # (name, address) of the closest global symbol at or before an address, or None
+        i = bisect.bisect_right(self.symbol_addresses, address) - 1
+        if i < 0:
+            return None
+        address, name = self.sorted_symbols[i]
+        return (name, address)
+
+    def name(self, address):
+        # Name of the function containing an address, falling back to the closest symbol
+        function = self.function(address)
+        if function != None:
+            return function[0]
+        symbol = self.symbol(address)
+        return symbol[0] if symbol != None else None
+
+    def describe(self, address):
+        # Human readable location, like "main+0x1C (main.kl:12)"
+        text = f"0x{address:X}"
+        function = self.function(address)
+        if function == None:
+            function = self.symbol(address)
+        if function != None:
+            name, start = function[:2]
+            text = name if address == start else f"{name}+0x{address - start:X}"
+        line = self.line(address)
+        if line != None:
+            text += f" ({line[0]}:{line[1]})"
+        return text
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.argument("addresses", nargs=-1)
+def run(file, addresses):
+    """Prints the source location of each address, or every function when no address is given."""
+    debug_info = DebugInfo.load(file)
+
+    if not addresses:
+        for name, start, end in debug_info.functions:
+            line = debug_info.line(start)
+            location = f" ({line[0]}:{line[1]})" if line != None else ""
+            click.echo(f"0x{start:08X}-0x{end:08X} {name}{location}")
+        return
+
+    for address in addresses:
+        try:
+            value = int(address, 0)
+        except ValueError:
+            click.echo(f"ERROR: invalid address '{address}'", err=True)
+            continue
+        click.echo(f"0x{value:08X} {debug_info.describe(value)}")
+
+if __name__ == "__main__":
+    run(None, None)
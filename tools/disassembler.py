@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import struct
+import click
+
+from assembler import INSTRUCTIONS
+from emulator import BOOT_ADDRESS
+from debuginfo import DebugInfo
+
+U32 = struct.Struct("<I")
+
+# Instructions that take an address to go to, their immediate gets the name of the function it
+# points into when it isn't a symbol
+BRANCHES = {"ji", "jti", "jfi", "calli"}
+
+def build_table():
+    # 256 entries indexed by the first byte: None for invalid opcodes, (name, operands, size) for
+    # one byte opcodes, and another 256 entries indexed by the second byte for the 0x10/0x20/0x30
+    # groups, where the low nibble of the second byte is the register
+    table = [None] * 256
+    for name, instruction in INSTRUCTIONS.items():
+        opcode = instruction["opcode"]
+        operands = instruction["operands"]
+        size = len(opcode) + (1 if operands == "rr" else 0) + 4 * operands.count("i")
+        if len(opcode) == 1:
+            table[opcode[0]] = (name, operands, size)
+            continue
+        if table[opcode[0]] == None:
+            table[opcode[0]] = [None] * 256
+        for register in range(16):
+            table[opcode[0]][opcode[1] | register] = (name, operands, size)
+    return table
+
+TABLE = build_table()
+
+# Runs of zeros at least this long are shown as one .byte directive instead of nops
+ZERO_RUN = 16
+NONZERO = re.compile(rb"[^\x00]")
+
+def decode(data, start=0, end=None, base=0, zero_run=None):
+    # Decodes data[start:end] in one pass. Returns (address, size, name, values) for every
+    # instruction, values are register numbers and immediates in the same order as in assembly.
+    # Bytes that don't start a valid instruction get a None name, a size of 1 and the byte as the
+    # value, and runs of zeros at least `zero_run` long a None name and (0, length)
+    # Slices of bytes are used as keys, memory from the emulator is a bytearray
+    data = bytes(data) if not isinstance(data, bytes) else data
+    view = memoryview(data)
+    end = len(view) if end == None else min(end, len(view))
+    unpack = U32.unpack_from
+    table = TABLE
+    # Most instructions are repeated many times, they are only decoded once
+    decoded = {}
+    result = []
+    append = result.append
+    i = start
+    while i < end:
+        byte = view[i]
+        if byte == 0 and zero_run != None:
+            match = NONZERO.search(view, i, end)
+            length = (match.start() if match else end) - i
+            if length >= zero_run:
+                append((base + i, length, None, (0, length)))
+                i += length
+                continue
+        entry = table[byte]
+        if entry.__class__ is list:
+            entry = entry[view[i + 1]] if i + 1 < end else None
+        if entry == None or i + entry[2] > end:
+            append((base + i, 1, None, (byte,)))
+            i += 1
+            continue
+
+        name, operands, size = entry
+        raw = data[i:i + size]
+        instruction = decoded.get(raw)
+        if instruction == None:
+            if operands == "":
+                values = ()
+            elif operands == "rr":
+                values = (view[i + 1] >> 4, view[i + 1] & 0xF)
+            elif operands == "i":
+                values = unpack(view, i + 1)
+            elif operands == "ii":
+                values = (unpack(view, i + 1)[0], unpack(view, i + 5)[0])
+            elif operands == "r":
+                values = (view[i + 1] & 0xF,)
+            elif operands == "ir":
+                values = (unpack(view, i + 2)[0], view[i + 1] & 0xF)
+            else: # "ri"
+                values = (view[i + 1] & 0xF, unpack(view, i + 2)[0])
+            instruction = decoded[raw] = (size, name, values)
+        append((base + i,) + instruction)
+        i += size
+    return result
+
+class Symbolizer:
+    # Names for addresses from the linker's global symbols and the functions of the debug info
+    def __init__(self, debug_info=None):
+        self.debug_info = debug_info
+        self.names = {}
+        if debug_info != None:
+            self.names.update((address, name) for name, address in debug_info.symbols.items())
+            self.names.update((start, name) for name, start, _ in debug_info.functions)
+
+    def immediate(self, value):
+        name = self.names.get(value)
+        if name != None:
+            return f"#{name}"
+        return str(value) if value < 0x100 else f"0x{value:X}"
+
+    def location(self, address):
+        # "name+0x1C" for an address inside a function or after a symbol, None if unknown
+        if self.debug_info == None:
+            return None
+        function = self.debug_info.function(address) or self.debug_info.symbol(address)
+        if function == None:
+            return None
+        name, start = function[:2]
+        return name if address == start else f"{name}+0x{address - start:X}"
+
+def format_instruction(name, values, operands, symbolizer):
+    if name == None:
+        return f".byte 0x{values[0]:02X}" + (f" {values[1]}" if len(values) > 1 else "")
+    if not operands:
+        return name
+    text = [f"${value}" if kind == "r" else symbolizer.immediate(value) for kind, value in zip(operands, values)]
+    return f"{assembly_name(name, operands)} {' '.join(text)}"
+
+def assembly_name(name, operands):
+    # The assembler picks the instruction from the operands, the names ending in i are only in
+    # INSTRUCTIONS (addi is written add, stbii is written stb)
+    if operands == "ii":
+        return name[:-2]
+    if "i" in operands and name.endswith("i") and name[:-1] in INSTRUCTIONS:
+        return name[:-1]
+    return name
+
+class Source:
+    # Lines of the source files named in the debug info, relative to the binary
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def line(self, file, number):
+        if file not in self.files:
+            try:
+                with open(os.path.join(self.directory, file), "r") as f:
+                    self.files[file] = f.read().split("\n")
+            except OSError:
+                self.files[file] = []
+        lines = self.files[file]
+        return lines[number - 1].strip() if 0 < number <= len(lines) else ""
+
+def disassemble(data, base, start, end, symbolizer, show_bytes=True, source=None):
+    # Lines of text for the instructions between two addresses, with labels at symbols and the
+    # source lines when `source` is given
+    debug_info = symbolizer.debug_info
+    names = symbolizer.names
+    # Symbols are often data or code after data, each part between two of them is decoded on its
+    # own so the instructions start at every symbol
+    bounds = [start] + [address for address in sorted(names) if start < address < end] + [end]
+    instructions = []
+    for first, last in zip(bounds, bounds[1:]):
+        instructions += decode(data, first - base, last - base, base, ZERO_RUN)
+    lines = []
+    append = lines.append
+    last_line = None
+    # The same instructions come up again and again, the text after the address is only made once
+    texts = {}
+    for address, size, name, values in instructions:
+        label = names.get(address)
+        if label != None:
+            append(f"#{label}:")
+        if source != None:
+            line = debug_info.line(address)
+            if line != None and line != last_line:
+                append(f"    ; {line[0]}:{line[1]}: {source.line(*line)}")
+            last_line = line
+
+        text = texts.get((name, values))
+        if text == None:
+            text = format_instruction(name, values, INSTRUCTIONS[name]["operands"] if name != None else "", symbolizer)
+            if name in BRANCHES and values[0] not in names:
+                location = symbolizer.location(values[0])
+                if location != None:
+                    text += f" ; {location}"
+            if show_bytes:
+                offset = address - base
+                raw = data[offset:offset + min(size, 9)].hex(" ").upper()
+                text = f"{raw:<26} {text}"
+            texts[(name, values)] = text
+        append(f"    0x{address:08X}  {text}")
+    return lines
+
+def parse_address(text, debug_info):
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    if debug_info != None:
+        if text in debug_info.symbols:
+            return debug_info.symbols[text]
+        for name, start, _ in debug_info.functions:
+            if name == text:
+                return start
+    click.echo(f"ERROR: unknown address or symbol '{text}'", err=True)
+    exit(1)
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--base", "-b", type=str, default=hex(BOOT_ADDRESS), help="Address the image is loaded at.")
+@click.option("--start", "-s", type=str, default=None, help="First address to disassemble, or a symbol.")
+@click.option("--end", "-e", type=str, default=None, help="Address to stop at, or a symbol.")
+@click.option("--function", "-f", type=str, default=None, help="Only disassembles a function.")
+@click.option("--source", "-S", "show_source", is_flag=True, help="Shows the source lines, needs debug info.")
+@click.option("--bytes/--no-bytes", "show_bytes", default=True, help="Shows the bytes of each instruction.")
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes the output to a file.")
+def run(file, base, start, end, function, show_source, show_bytes, output):
+    """Disassembles a binary. Names of symbols and functions and source lines come from the debug
+    info of images built with -g."""
+    with open(file, "rb") as f:
+        data = f.read()
+    debug_info = DebugInfo.find(file)
+    base = int(base, 0)
+    if show_source and debug_info == None:
+        click.echo(f"ERROR: no debug info found for {file}, build it with -g", err=True)
+        exit(1)
+
+    first, last = base, base + len(data)
+    if function != None:
+        if debug_info == None:
+            click.echo(f"ERROR: no debug info found for {file}, build it with -g", err=True)
+            exit(1)
+        matches = [entry for entry in debug_info.functions if entry[0] == function]
+        if not matches:
+            click.echo(f"ERROR: unknown function '{function}'", err=True)
+            exit(1)
+        first, last = matches[0][1:]
+    if start != None:
+        first = parse_address(start, debug_info)
+    if end != None:
+        last = parse_address(end, debug_info)
+    first = max(first, base)
+    last = min(last, base + len(data))
+
+    source = Source(os.path.dirname(os.path.abspath(file))) if show_source else None
+    lines = disassemble(data, base, first, last, Symbolizer(debug_info), show_bytes, source)
+    text = "\n".join(lines) + "\n" if lines else ""
+    if output != None:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        click.echo(text, nl=False)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,872 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import zlib
+import click
+import struct
+from debuginfo import DebugInfo
+
+BOOT_ADDRESS = 0x200
+INTERRUPT_TABLE = 0xF2000
+MEMORY_SIZE = 128 * 1024 * 1024
+
+MAX_INSTRUCTION_SIZE = 9
+
+# Writes bigger than this check every decoded instruction instead of every written address
+LARGE_WRITE = 64
+
+# Devices are updated (and can send interrupts) once every this many instructions
+UPDATE_INTERVAL = 1000
+
+MASK = 0xFFFFFFFF
+
+SNAPSHOT_MAGIC = b"VMSNAP"
+SNAPSHOT_VERSION = 1
+
+# Snapshots only store pages with something other than zeros
+PAGE_SIZE = 4096
+# Memory is first checked in blocks of this size, most of them are empty
+SCAN_SIZE = 64 * 1024
+
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+
+# Instruction names, the same as in assembler.INSTRUCTIONS. Branches relative to the instruction,
+# which the assembler doesn't have, are named like in vm/src/cpu.rs
+OPCODES = {
+    0x00: "nop", 0x01: "add", 0x02: "sub", 0x03: "mul", 0x04: "div", 0x05: "and", 0x06: "or", 0x07: "xor",
+    0x08: "shl", 0x09: "shr", 0x0A: "stb", 0x0B: "stw", 0x0C: "std", 0x0D: "ldb", 0x0E: "ldw", 0x0F: "ldd",
+    0x21: "pushi", 0x23: "ji", 0x24: "jti", 0x25: "jfi", 0x26: "bi", 0x27: "bti", 0x28: "bfi", 0x29: "calli",
+    0x2A: "cgtq", 0x2B: "cltq", 0x2C: "ceq", 0x2D: "cnq", 0x2E: "cgt", 0x2F: "clt", 0x31: "mov",
+    0x32: "stbii", 0x33: "stwii", 0x34: "stdii", 0x35: "ret", 0x36: "bali",
+    0x40: "syscall", 0x41: "iret", 0x42: "cli", 0x43: "sti",
+}
+
+# Opcodes followed by a second byte with a sub-opcode and a register
+GROUPS = {
+    0x10: {
+        0x1: "addi", 0x2: "subi", 0x3: "muli", 0x4: "divi", 0x5: "andi", 0x6: "ori", 0x7: "xori", 0x8: "shli",
+        0x9: "shri", 0xA: "stbi", 0xB: "stwi", 0xC: "stdi", 0xD: "ldbi", 0xE: "ldwi", 0xF: "lddi",
+    },
+    0x20: {0x1: "push", 0x2: "pop", 0x3: "j", 0x4: "jt", 0x5: "jf", 0x6: "b", 0x7: "bt", 0x8: "bf", 0x9: "call"},
+    0x30: {0x1: "movi", 0x6: "bal", 0xA: "cgtqi", 0xB: "cltqi", 0xC: "ceqi", 0xD: "cnqi", 0xE: "cgti", 0xF: "clti"},
+}
+
+REGISTER_OPCODES = set(range(0x01, 0x10)) | set(range(0x2A, 0x30)) | {0x31}
+IMMEDIATE_OPCODES = {0x21, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x29, 0x36}
+RELATIVE_OPCODES = {0x26, 0x27, 0x28, 0x36}
+IMMEDIATE_PAIR_OPCODES = {0x32, 0x33, 0x34}
+
+# Instructions writing the register in their first or second operand, see Emulator.zeroed
+WRITES_A = {"addi", "subi", "andi", "ori", "xori", "shli", "shri", "ldbi", "ldwi", "lddi", "pop", "movi"}
+WRITES_B = {"add", "sub", "and", "or", "xor", "shl", "shr", "ldb", "ldw", "ldd", "mov"}
+
+class CpuException(Exception):
+    def __init__(self, ip):
+        super().__init__(f"{type(self).__name__} at 0x{ip:X}")
+        self.ip = ip
+
+class InvalidOpcode(CpuException):
+    pass
+
+class ProtectionFault(CpuException):
+    pass
+
+class DivisionByZero(CpuException):
+    pass
+
+def decode_instruction(memory, ip):
+    # Returns the name, both operands and the address of the next instruction. Operands are register
+    # numbers or immediates in the same order as in assembly, relative branches with an immediate get
+    # the absolute address and the other relative instructions (b, bt, bf, bal) the instruction address
+    try:
+        opcode = memory[ip]
+    except IndexError:
+        raise ProtectionFault(ip)
+
+    try:
+        if opcode in GROUPS:
+            operands = memory[ip + 1]
+            name = GROUPS[opcode].get(operands >> 4)
+            if name == None:
+                raise InvalidOpcode(ip)
+            if opcode == 0x20:
+                return name, operands & 0xF, ip, ip + 2
+            imm = U32.unpack_from(memory, ip + 2)[0]
+            if name == "bal": # The immediate has to be readable but isn't used, same as vm/
+                return name, operands & 0xF, ip, ip + 2
+            return name, operands & 0xF, imm, ip + 6
+
+        name = OPCODES.get(opcode)
+        if name == None:
+            raise InvalidOpcode(ip)
+        if opcode in REGISTER_OPCODES:
+            operands = memory[ip + 1]
+            return name, operands >> 4, operands & 0xF, ip + 2
+        if opcode in IMMEDIATE_OPCODES:
+            imm = U32.unpack_from(memory, ip + 1)[0]
+            if opcode in RELATIVE_OPCODES:
+                imm = (ip + imm) & MASK
+            return name, imm, None, ip + 5
+        if opcode in IMMEDIATE_PAIR_OPCODES:
+            return name, U32.unpack_from(memory, ip + 1)[0], U32.unpack_from(memory, ip + 5)[0], ip + 9
+        return name, None, None, ip + 1
+    except (IndexError, struct.error):
+        raise InvalidOpcode(ip)
+
+class Device:
+    # Same interface as the `Device` trait in vm/src/device.rs, `emulator.memory` is the raw memory
+    def record(self):
+        return None
+
+    def memory_area(self):
+        return range(0)
+
+    def init_memory(self, emulator):
+        pass
+
+    def read_memory(self, emulator, address):
+        return emulator.memory[address]
+
+    def write_memory(self, emulator, address, value):
+        # Returns False to cancel the write
+        return True
+
+    def update_device(self, emulator):
+        pass
+
+    def hooks_memory(self):
+        # Only devices that override reads or writes slow down memory accesses to their area
+        return type(self).read_memory is not Device.read_memory or type(self).write_memory is not Device.write_memory
+
+    def save_state(self):
+        # State kept outside of memory, as something that can be stored as JSON
+        return None
+
+    def load_state(self, state):
+        pass
+
+class Emulator:
+    def __init__(self, memory_size=MEMORY_SIZE, devices=()):
+        self.memory = bytearray(memory_size)
+        self.registers = [0] * 16
+        self.ip = BOOT_ADDRESS
+        self.cmp = False
+        self.user_mode = False
+        self.interrupts_enabled = False
+        self.paging_enabled = False
+
+        self.halted = False
+        self.instructions = 0
+        self.decoded = 0
+        self.invalidated = 0
+
+        self.cache = {} # Decoded instructions: address -> (handler, operand, operand, next ip)
+        # Addresses that a write can start at and overwrite a decoded instruction. Each instruction
+        # adds the 3 bytes before it, so stores of any size only have to check their first address.
+        # Addresses are only removed on flush, a stale one just makes writes to it slower
+        self.code_bytes = set()
+        self.coverage = None # cover.Coverage marked with every instruction decoded. Optional
+
+        self.devices = []
+        self.io_devices = []
+        for device in devices:
+            self.attach(device)
+        self.build_handlers()
+
+    def attach(self, device):
+        self.devices.append(device)
+        if device.hooks_memory():
+            self.io_devices.append(device)
+        device.init_memory(self)
+        self.build_handlers()
+
+    def load(self, data, address=BOOT_ADDRESS):
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        self.write_raw(address, data)
+
+    def write_raw(self, address, data):
+        # Writes bytes without going through devices, for loaders and devices doing DMA
+        self.memory[address:address + len(data)] = data
+        self.invalidate(address, len(data))
+
+    def get_flags(self):
+        return (self.paging_enabled << 3) | (self.cmp << 2) | (self.interrupts_enabled << 1) | self.user_mode
+
+    def set_flags(self, flags):
+        self.user_mode = flags & 1 == 1
+        self.interrupts_enabled = flags >> 1 & 1 == 1
+        self.cmp = flags >> 2 & 1 == 1
+        self.paging_enabled = flags >> 3 & 1 == 1
+
+    def interrupt(self, line, error_code=None):
+        # Interrupts sent while they are disabled are lost, same as the Rust VM
+        if not self.interrupts_enabled:
+            return
+        sp = self.registers[15]
+        try:
+            for offset, value in ((4, self.get_flags()), (8, sp), (12, self.ip), (16, error_code or 0)):
+                address = (sp - offset) & MASK
+                U32.pack_into(self.memory, address, value)
+                self.invalidate(address, 4)
+            self.ip = U32.unpack_from(self.memory, INTERRUPT_TABLE + line * 4)[0]
+        except (IndexError, struct.error):
+            raise ProtectionFault(self.ip)
+        self.registers[15] = (sp - 16) & MASK
+        self.user_mode = False
+        self.interrupts_enabled = False
+        self.halted = False
+
+    def device_at(self, address):
+        for device in self.io_devices:
+            if address in device.memory_area():
+                return device
+        return None
+
+    def read_io(self, address, size):
+        value = 0
+        for i in range(size):
+            device = self.device_at(address + i)
+            byte = self.memory[address + i] if device == None else device.read_memory(self, address + i)
+            if byte == None:
+                raise IndexError(address + i)
+            value |= byte << (i * 8)
+        return value
+
+    def write_io(self, address, value, size):
+        for i in range(size):
+            byte = value >> (i * 8) & 0xFF
+            device = self.device_at(address + i)
+            if device == None or device.write_memory(self, address + i, byte):
+                self.memory[address + i] = byte
+
+    # Memory accesses used by tools and devices, going through devices like the CPU does
+
+    def read_u8(self, address):
+        return self.read_io(address, 1)
+
+    def read_u16(self, address):
+        return self.read_io(address, 2)
+
+    def read_u32(self, address):
+        return self.read_io(address, 4)
+
+    def write_u8(self, address, value):
+        self.write_io(address, value, 1)
+        self.invalidate(address, 1)
+
+    def write_u16(self, address, value):
+        self.write_io(address, value, 2)
+        self.invalidate(address, 2)
+
+    def write_u32(self, address, value):
+        self.write_io(address, value, 4)
+        self.invalidate(address, 4)
+
+    def invalidate(self, address, size):
+        # Removes decoded instructions overlapping the written bytes
+        cache = self.cache
+        if size > LARGE_WRITE:
+            starts = [start for start, entry in cache.items() if start < address + size and entry[3] > address]
+        else:
+            starts = [start for start in range(address - MAX_INSTRUCTION_SIZE + 1, address + size)
+                      if start in cache and cache[start][3] > address]
+        for start in starts:
+            del cache[start]
+        self.invalidated += len(starts)
+
+    def flush(self):
+        self.cache.clear()
+        self.code_bytes.clear()
+
+    def used_pages(self):
+        # Start of every page that isn't all zeros
+        memory = self.memory
+        zero_block = bytes(SCAN_SIZE)
+        pages = []
+        for block in range(0, len(memory), SCAN_SIZE):
+            # The last block can be shorter
+            if memory[block:block + SCAN_SIZE] != zero_block[:len(memory) - block]:
+                pages += [page for page in range(block, min(block + SCAN_SIZE, len(memory)), PAGE_SIZE)
+                          if memory[page:page + PAGE_SIZE].strip(b"\0")]
+        return pages
+
+    def save_snapshot(self, path):
+        # Writes the registers, flags, the used pages of memory and the state of every device. The
+        # file is the magic, the length of a JSON header, the header and the compressed pages
+        pages = self.used_pages()
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "memory_size": len(self.memory),
+            "registers": self.registers,
+            "ip": self.ip,
+            "flags": self.get_flags(),
+            "halted": self.halted,
+            "instructions": self.instructions,
+            "pages": [page // PAGE_SIZE for page in pages],
+            "devices": [[type(device).__name__, device.save_state()] for device in self.devices],
+        }
+        data = json.dumps(header, separators=(",", ":")).encode()
+        with open(path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(U32.pack(len(data)))
+            f.write(data)
+            f.write(zlib.compress(b"".join(self.memory[page:page + PAGE_SIZE].ljust(PAGE_SIZE, b"\0") for page in pages), 1))
+
+    def load_snapshot(self, path):
+        # Restores a snapshot taken with the same memory size and devices
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("not a snapshot")
+        start = len(SNAPSHOT_MAGIC) + 4
+        end = start + U32.unpack_from(data, len(SNAPSHOT_MAGIC))[0]
+        header = json.loads(data[start:end])
+        if header["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {header['version']}")
+        if header["memory_size"] != len(self.memory):
+            raise ValueError(f"snapshot has {header['memory_size']} bytes of memory, not {len(self.memory)}")
+        if [name for name, _ in header["devices"]] != [type(device).__name__ for device in self.devices]:
+            raise ValueError("snapshot was taken with other devices")
+
+        # Slices are cut to the end of memory, so assigning them never resizes it
+        memory = self.memory
+        size = len(memory)
+        for page in self.used_pages():
+            memory[page:page + PAGE_SIZE] = bytes(min(PAGE_SIZE, size - page))
+        contents = zlib.decompress(data[end:])
+        for i, page in enumerate(header["pages"]):
+            page *= PAGE_SIZE
+            memory[page:page + PAGE_SIZE] = contents[i * PAGE_SIZE:i * PAGE_SIZE + min(PAGE_SIZE, size - page)]
+        self.flush()
+
+        self.registers[:] = header["registers"]
+        self.ip = header["ip"]
+        self.set_flags(header["flags"])
+        self.halted = header["halted"]
+        self.instructions = header["instructions"]
+        for device, (_, state) in zip(self.devices, header["devices"]):
+            device.load_state(state)
+
+    def decode(self, ip):
+        name, a, b, next = decode_instruction(self.memory, ip)
+        handler = self.handlers[name]
+        if (a == 0 and name in WRITES_A) or (b == 0 and name in WRITES_B):
+            handler = self.zeroed(handler)
+
+        entry = (handler, a, b, next)
+        self.cache[ip] = entry
+        self.code_bytes.update(range(ip - 3, next))
+        self.decoded += 1
+        if self.coverage != None:
+            self.coverage.mark(ip)
+        return entry
+
+    def zeroed(self, handler):
+        # $0 is always read as 0, so instructions writing it reset it afterwards
+        registers = self.registers
+        def run(a, b, next):
+            next = handler(a, b, next)
+            registers[0] = 0
+            return next
+        return run
+
+    def build_handlers(self):
+        # Handlers take the decoded operands and the address of the next instruction, and return
+        # the new instruction pointer
+        r = self.registers
+        memory = self.memory
+        cpu = self
+        code_bytes = self.code_bytes
+        invalidate = self.invalidate
+        read_io = self.read_io
+        write_io = self.write_io
+
+        # Accesses to this range go through devices, 3 bytes are added so unaligned accesses
+        # overlapping the range are included
+        areas = [device.memory_area() for device in self.io_devices if len(device.memory_area()) > 0]
+        io_start = min((area.start for area in areas), default=MASK + 1) - 3
+        io_end = max((area.stop - 1 for area in areas), default=-1)
+        self.io_range = (io_start, io_end)
+
+        pack16 = U16.pack_into
+        pack32 = U32.pack_into
+        unpack16 = U16.unpack_from
+        unpack32 = U32.unpack_from
+
+        def load8(address):
+            if io_start <= address <= io_end:
+                return read_io(address, 1)
+            return memory[address]
+
+        def load16(address):
+            if io_start <= address <= io_end:
+                return read_io(address, 2)
+            return unpack16(memory, address)[0]
+
+        def load32(address):
+            if io_start <= address <= io_end:
+                return read_io(address, 4)
+            return unpack32(memory, address)[0]
+
+        def store8(address, value):
+            if io_start <= address <= io_end:
+                write_io(address, value & 0xFF, 1)
+            else:
+                memory[address] = value & 0xFF
+            if address in code_bytes:
+                invalidate(address, 1)
+
+        def store16(address, value):
+            if io_start <= address <= io_end:
+                write_io(address, value & 0xFFFF, 2)
+            else:
+                pack16(memory, address, value & 0xFFFF)
+            if address in code_bytes:
+                invalidate(address, 2)
+
+        def store32(address, value):
+            if io_start <= address <= io_end:
+                write_io(address, value, 4)
+            else:
+                pack32(memory, address, value)
+            if address in code_bytes:
+                invalidate(address, 4)
+
+        # The most common instructions have the memory accesses inlined
+
+        def push(value):
+            sp = (r[15] - 4) & MASK
+            r[15] = sp
+            if io_start <= sp <= io_end:
+                write_io(sp, value, 4)
+            else:
+                pack32(memory, sp, value)
+            if sp in code_bytes:
+                invalidate(sp, 4)
+
+        def pop():
+            sp = r[15]
+            value = read_io(sp, 4) if io_start <= sp <= io_end else unpack32(memory, sp)[0]
+            r[15] = (sp + 4) & MASK
+            return value
+
+        # Register-register instructions, `a` and `b` are register numbers
+
+        def add(a, b, next):
+            r[b] = (r[b] + r[a]) & MASK
+            return next
+
+        def sub(a, b, next):
+            r[b] = (r[b] - r[a]) & MASK
+            return next
+
+        def mul(a, b, next):
+            result = r[b] * r[a]
+            r[14] = result >> 32
+            r[13] = result & MASK
+            return next
+
+        def div(a, b, next):
+            if r[a] == 0:
+                raise DivisionByZero(next - 2)
+            r[14] = r[b] // r[a]
+            r[13] = r[b] % r[a]
+            return next
+
+        def and_(a, b, next):
+            r[b] &= r[a]
+            return next
+
+        def or_(a, b, next):
+            r[b] |= r[a]
+            return next
+
+        def xor(a, b, next):
+            r[b] ^= r[a]
+            return next
+
+        # Shifting by 32 or more gives 0, same as the Zig VM
+        def shl(a, b, next):
+            r[b] = (r[b] << r[a]) & MASK if r[a] < 32 else 0
+            return next
+
+        def shr(a, b, next):
+            r[b] >>= r[a]
+            return next
+
+        def stb(a, b, next):
+            address = r[b]
+            if io_start <= address <= io_end:
+                write_io(address, r[a] & 0xFF, 1)
+            else:
+                memory[address] = r[a] & 0xFF
+            if address in code_bytes:
+                invalidate(address, 1)
+            return next
+
+        def stw(a, b, next):
+            store16(r[b], r[a])
+            return next
+
+        def std(a, b, next):
+            address = r[b]
+            if io_start <= address <= io_end:
+                write_io(address, r[a], 4)
+            else:
+                pack32(memory, address, r[a])
+            if address in code_bytes:
+                invalidate(address, 4)
+            return next
+
+        def ldb(a, b, next):
+            address = r[a]
+            r[b] = read_io(address, 1) if io_start <= address <= io_end else memory[address]
+            return next
+
+        def ldw(a, b, next):
+            r[b] = load16(r[a])
+            return next
+
+        def ldd(a, b, next):
+            address = r[a]
+            r[b] = read_io(address, 4) if io_start <= address <= io_end else unpack32(memory, address)[0]
+            return next
+
+        def cgtq(a, b, next):
+            cpu.cmp = r[a] >= r[b]
+            return next
+
+        def cltq(a, b, next):
+            cpu.cmp = r[a] <= r[b]
+            return next
+
+        def ceq(a, b, next):
+            cpu.cmp = r[a] == r[b]
+            return next
+
+        def cnq(a, b, next):
+            cpu.cmp = r[a] != r[b]
+            return next
+
+        def cgt(a, b, next):
+            cpu.cmp = r[a] > r[b]
+            return next
+
+        def clt(a, b, next):
+            cpu.cmp = r[a] < r[b]
+            return next
+
+        def mov(a, b, next):
+            r[b] = r[a]
+            return next
+
+        # Register-immediate instructions, `a` is a register and `b` the immediate
+
+        def addi(a, b, next):
+            r[a] = (r[a] + b) & MASK
+            return next
+
+        def subi(a, b, next):
+            r[a] = (r[a] - b) & MASK
+            return next
+
+        def muli(a, b, next):
+            result = r[a] * b
+            r[14] = result >> 32
+            r[13] = result & MASK
+            return next
+
+        def divi(a, b, next):
+            if b == 0:
+                raise DivisionByZero(next - 6)
+            r[14] = r[a] // b
+            r[13] = r[a] % b
+            return next
+
+        def andi(a, b, next):
+            r[a] &= b
+            return next
+
+        def ori(a, b, next):
+            r[a] |= b
+            return next
+
+        def xori(a, b, next):
+            r[a] ^= b
+            return next
+
+        def shli(a, b, next):
+            r[a] = (r[a] << b) & MASK if b < 32 else 0
+            return next
+
+        def shri(a, b, next):
+            r[a] >>= b
+            return next
+
+        def stbi(a, b, next):
+            store8(b, r[a])
+            return next
+
+        def stwi(a, b, next):
+            store16(b, r[a])
+            return next
+
+        def stdi(a, b, next):
+            store32(b, r[a])
+            return next
+
+        def ldbi(a, b, next):
+            r[a] = load8(b)
+            return next
+
+        def ldwi(a, b, next):
+            r[a] = load16(b)
+            return next
+
+        def lddi(a, b, next):
+            r[a] = load32(b)
+            return next
+
+        def movi(a, b, next):
+            r[a] = b
+            return next
+
+        def bal(a, b, next):
+            # `b` is the address of the instruction
+            push(next)
+            return (b + r[a]) & MASK
+
+        def cgtqi(a, b, next):
+            cpu.cmp = r[a] >= b
+            return next
+
+        def cltqi(a, b, next):
+            cpu.cmp = r[a] <= b
+            return next
+
+        def ceqi(a, b, next):
+            cpu.cmp = r[a] == b
+            return next
+
+        def cnqi(a, b, next):
+            cpu.cmp = r[a] != b
+            return next
+
+        def cgti(a, b, next):
+            cpu.cmp = r[a] > b
+            return next
+
+        def clti(a, b, next):
+            cpu.cmp = r[a] < b
+            return next
+
+        # Single register instructions, `b` is the address of the instruction
+
+        def push_(a, b, next):
+            sp = (r[15] - 4) & MASK
+            r[15] = sp
+            if io_start <= sp <= io_end:
+                write_io(sp, r[a], 4)
+            else:
+                pack32(memory, sp, r[a])
+            if sp in code_bytes:
+                invalidate(sp, 4)
+            return next
+
+        def pop_(a, b, next):
+            # Same order as vm/, `pop $15` adds 4 to the popped value
+            sp = r[15]
+            r[a] = read_io(sp, 4) if io_start <= sp <= io_end else unpack32(memory, sp)[0]
+            r[15] = (r[15] + 4) & MASK
+            return next
+
+        def j(a, b, next):
+            return r[a]
+
+        def jt(a, b, next):
+            return r[a] if cpu.cmp else next
+
+        def jf(a, b, next):
+            return next if cpu.cmp else r[a]
+
+        def b_(a, b, next):
+            return (b + r[a]) & MASK
+
+        def bt(a, b, next):
+            return (b + r[a]) & MASK if cpu.cmp else next
+
+        def bf(a, b, next):
+            return next if cpu.cmp else (b + r[a]) & MASK
+
+        def call(a, b, next):
+            target = r[a]
+            push(next)
+            return target
+
+        # Immediate instructions, `a` is the immediate (already added to the address for branches)
+
+        def pushi(a, b, next):
+            push(a)
+            return next
+
+        def ji(a, b, next):
+            return a
+
+        def jti(a, b, next):
+            return a if cpu.cmp else next
+
+        def jfi(a, b, next):
+            return next if cpu.cmp else a
+
+        def calli(a, b, next):
+            push(next)
+            return a
+
+        def stbii(a, b, next):
+            store8(b, a)
+            return next
+
+        def stwii(a, b, next):
+            store16(b, a)
+            return next
+
+        def stdii(a, b, next):
+            store32(b, a)
+            return next
+
+        def nop(a, b, next):
+            return next
+
+        def ret(a, b, next):
+            return pop()
+
+        def syscall(a, b, next):
+            # Returns after the syscall, vm/ and vmz/ save its own address and run it again on iret
+            cpu.ip = next
+            cpu.interrupt(15)
+            return cpu.ip
+
+        def iret(a, b, next):
+            sp = r[15]
+            ip = load32(sp)
+            r[15] = load32((sp + 4) & MASK)
+            cpu.set_flags(load32((sp + 8) & MASK) & 0xFF)
+            return ip
+
+        def cli(a, b, next):
+            cpu.interrupts_enabled = False
+            return next
+
+        def sti(a, b, next):
+            cpu.interrupts_enabled = True
+            return next
+
+        self.handlers = {
+            "nop": nop, "add": add, "sub": sub, "mul": mul, "div": div, "and": and_, "or": or_, "xor": xor,
+            "shl": shl, "shr": shr, "stb": stb, "stw": stw, "std": std, "ldb": ldb, "ldw": ldw, "ldd": ldd,
+            "addi": addi, "subi": subi, "muli": muli, "divi": divi, "andi": andi, "ori": ori, "xori": xori,
+            "shli": shli, "shri": shri, "stbi": stbi, "stwi": stwi, "stdi": stdi, "ldbi": ldbi, "ldwi": ldwi,
+            "lddi": lddi, "push": push_, "pop": pop_, "j": j, "jt": jt, "jf": jf, "b": b_, "bt": bt, "bf": bf,
+            "call": call, "pushi": pushi, "ji": ji, "jti": jti, "jfi": jfi, "bi": ji, "bti": jti, "bfi": jfi,
+            "calli": calli, "cgtq": cgtq, "cltq": cltq, "ceq": ceq, "cnq": cnq, "cgt": cgt, "clt": clt,
+            "movi": movi, "bal": bal, "cgtqi": cgtqi, "cltqi": cltqi, "ceqi": ceqi, "cnqi": cnqi, "cgti": cgti,
+            "clti": clti, "mov": mov, "stbii": stbii, "stwii": stwii, "stdii": stdii, "ret": ret, "bali": calli,
+            "syscall": syscall, "iret": iret, "cli": cli, "sti": sti,
+        }
+
+        # Handlers are bound to the current devices
+        self.flush()
+
+    def step(self, count=UPDATE_INTERVAL):
+        # Runs up to `count` instructions without updating devices, returns how many ran
+        cache = self.cache
+        decode = self.decode
+        ip = self.ip
+        executed = 0
+        try:
+            for executed in range(1, count + 1):
+                try:
+                    handler, a, b, next = cache[ip]
+                except KeyError:
+                    handler, a, b, next = decode(ip)
+                new = handler(a, b, next)
+                if new == ip:
+                    # Jumping to itself can only be left through an interrupt
+                    self.halted = not self.interrupts_enabled
+                    break
+                ip = new
+            else:
+                executed = count
+        except (IndexError, struct.error):
+            self.ip = ip
+            self.instructions += executed - 1
+            raise ProtectionFault(ip)
+        except CpuException:
+            self.ip = ip
+            self.instructions += executed - 1
+            raise
+        self.ip = ip
+        self.instructions += executed
+        return executed
+
+    def run(self, max_instructions=None):
+        while not self.halted:
+            count = UPDATE_INTERVAL
+            if max_instructions != None:
+                count = min(count, max_instructions - self.instructions)
+                if count <= 0:
+                    break
+            self.step(count)
+            for device in self.devices:
+                device.update_device(self)
+        return self.halted
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--memory-size", "-m", default=MEMORY_SIZE, help="Memory size in bytes (default 128M).")
+@click.option("--max-instructions", "-n", type=int, default=None, help="Stops after this many instructions.")
+@click.option("--registers", is_flag=True, default=False, help="Prints the registers when stopping.")
+@click.option("--translate", "-t", is_flag=True, default=False, help="Compiles basic blocks into Python functions.")
+@click.option("--coverage", "coverage_output", type=click.Path(), default=None, help="Adds the instructions that ran to a coverage file for cover.py.")
+def run(file, memory_size, max_instructions, registers, translate, coverage_output):
+    """Runs a boot image without any devices until it halts (jumps to itself with interrupts disabled)."""
+    if translate:
+        # Imported here since the translator imports this module
+        from translator import TranslatingEmulator
+        emulator = TranslatingEmulator(memory_size)
+    else:
+        emulator = Emulator(memory_size)
+    emulator.load(file)
+    if coverage_output != None:
+        # Imported here since cover.py imports this module
+        from cover import Coverage
+        with open(file, "rb") as f:
+            emulator.coverage = Coverage.for_image(f.read())
+    # Source locations are shown when the image was built with debug info
+    debug_info = DebugInfo.find(file)
+    describe = debug_info.describe if debug_info != None else lambda address: f"0x{address:X}"
+
+    start = time.perf_counter()
+    try:
+        emulator.run(max_instructions)
+    except CpuException as e:
+        click.echo(f"ERROR: {type(e).__name__} at {describe(e.ip)}", err=True)
+    elapsed = time.perf_counter() - start
+
+    state = "halted" if emulator.halted else "stopped"
+    click.echo(f"{state} at {describe(emulator.ip)} after {emulator.instructions} instructions in {elapsed:.3f}s "
+               f"({emulator.instructions / elapsed / 1e6:.2f}M instructions/s, "
+               + (f"{emulator.translated} translated)" if translate else f"{emulator.decoded} decoded)"))
+    if registers:
+        click.echo(" ".join(f"${i}={value:X}" for i, value in enumerate(emulator.registers)))
+    if coverage_output != None:
+        from cover import merge_into
+        if not merge_into(emulator.coverage, coverage_output):
+            click.echo(f"WARNING: replaced the coverage of another image in {coverage_output}", err=True)
+
+if __name__ == "__main__":
+    run(None, None, None, None, None)
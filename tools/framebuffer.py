@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import time
+import zlib
+import struct
+import click
+import numpy as np
+from emulator import Device, CpuException, MEMORY_SIZE, UPDATE_INTERVAL
+from debuginfo import DebugInfo
+from harness import Machine, FRAMEBUFFER_ADDRESS, SCREEN_WIDTH, SCREEN_HEIGHT, KEY_DELAY, open_disk, parse_key
+
+# Size of the squares changes are tracked in, same as a character of boot/graphics.kl
+TILE_SIZE = 8
+
+class Framebuffer:
+    # Screen of the monitor as a (height, width) array of 0x00RRGGBB pixels. The array is a view of
+    # the emulator's memory, so it always shows the current screen without copying anything
+    def __init__(self, emulator, address=FRAMEBUFFER_ADDRESS, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.width = width
+        self.height = height
+        self.pixels = np.frombuffer(emulator.memory, dtype="<u4", count=width * height, offset=address).reshape(height, width)
+
+    def capture(self):
+        # Copy of the current screen
+        return self.pixels.copy()
+
+def rgb(frame):
+    # (height, width, 3) array of bytes
+    return frame.view(np.uint8).reshape(*frame.shape, 4)[:, :, 2::-1]
+
+def dirty_tiles(frame, reference, tile=TILE_SIZE):
+    # (rows, columns) array telling which tiles have a different pixel
+    changed = frame != reference
+    height, width = changed.shape
+    rows, columns = -(-height // tile), -(-width // tile)
+    if rows * tile != height or columns * tile != width:
+        changed = np.pad(changed, ((0, rows * tile - height), (0, columns * tile - width)))
+    # Reducing the rows of each tile first keeps the inner loops over contiguous memory, which is
+    # several times faster than any(axis=(1, 3))
+    tiles = np.logical_or.reduce(changed.reshape(rows, tile, columns, tile), axis=1)
+    return np.logical_or.reduce(tiles, axis=2)
+
+def dirty_rectangles(frame, reference, tile=TILE_SIZE):
+    # (x, y, width, height) rectangles covering every changed pixel, made of runs of changed tiles
+    # merged with the same run in the rows below
+    tiles = dirty_tiles(frame, reference, tile)
+    height, width = frame.shape
+    rectangles = []
+    open_runs = {} # (first column, last column) -> index in rectangles, for runs in the last row
+    last_row = None
+    for row in np.flatnonzero(tiles.any(axis=1)):
+        if last_row == None or row != last_row + 1:
+            open_runs = {}
+        last_row = row
+        # Starts and ends of runs of changed tiles in this row
+        edges = np.flatnonzero(np.diff(tiles[row], prepend=False, append=False))
+        runs = {}
+        for start, end in zip(edges[::2], edges[1::2]):
+            index = open_runs.get((start, end))
+            if index == None:
+                index = len(rectangles)
+                rectangles.append([start * tile, row * tile, (end - start) * tile, 0])
+            rectangles[index][3] += tile
+            runs[(start, end)] = index
+        open_runs = runs
+    # Tiles at the right and bottom edges can go past the screen
+    return [(int(x), int(y), int(min(w, width - x)), int(min(h, height - y))) for x, y, w, h in rectangles]
+
+def bounding_box(frame, reference):
+    # (x, y, width, height) of the smallest rectangle with every changed pixel, None if equal
+    changed = frame != reference
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return (int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1))
+
+def write_ppm(frame, path):
+    with open(path, "wb") as f:
+        f.write(f"P6\n{frame.shape[1]} {frame.shape[0]}\n255\n".encode())
+        f.write(np.ascontiguousarray(rgb(frame)).tobytes())
+
+def read_ppm(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    # Header is "P6", width, height and maximum value separated by whitespace
+    fields = data.split(maxsplit=4)
+    if fields[0] != b"P6" or fields[3] != b"255":
+        raise ValueError("only binary PPM files with 8 bit channels are supported")
+    width, height = int(fields[1]), int(fields[2])
+    pixels = np.frombuffer(fields[4][:width * height * 3], dtype=np.uint8).reshape(height, width, 3).astype("<u4")
+    return (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+
+def write_png(frame, path):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    height, width = frame.shape
+    # Every row starts with filter type 0 (none)
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb(frame).reshape(height, width * 3)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+def save(frame, path):
+    # Format from the extension, .npy keeps the exact pixel values
+    if path.endswith(".png"):
+        write_png(frame, path)
+    elif path.endswith(".npy"):
+        np.save(path, frame)
+    else:
+        write_ppm(frame, path)
+
+def load(path):
+    if path.endswith(".npy"):
+        return np.load(path)
+    return read_ppm(path)
+
+class FrameCounter(Device):
+    # Looks at the screen every `interval` device updates and counts the times it changed
+    def __init__(self, framebuffer, interval=1):
+        self.framebuffer = framebuffer
+        self.interval = interval
+        self.countdown = interval
+        self.last = framebuffer.capture()
+        self.frames = [] # (instructions, bounding box of the change)
+
+    def update_device(self, emulator):
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.interval
+        pixels = self.framebuffer.pixels
+        if not np.array_equal(pixels, self.last):
+            self.frames.append((emulator.instructions, bounding_box(pixels, self.last)))
+            self.last[:] = pixels
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--memory-size", "-m", default=MEMORY_SIZE, help="Memory size in bytes (default 128M).")
+@click.option("--max-instructions", "-n", type=int, default=None, help="Stops after this many instructions.")
+@click.option("--disk", "-d", "disks", type=click.Path(exists=True), multiple=True, help="Disk image, can be given up to 8 times.")
+@click.option("--keys", "-k", default="", help="Comma separated keys to type, like 'down,enter'.")
+@click.option("--key-delay", type=int, default=KEY_DELAY, help="Instructions to wait before each key.")
+@click.option("--settle", type=int, default=None, help="Stops this many instructions after the last key was handled.")
+@click.option("--restore", "-r", type=click.Path(exists=True), default=None, help="Starts from a snapshot instead of booting.")
+@click.option("--interval", "-i", type=int, default=1, help=f"Looks for new frames every N * {UPDATE_INTERVAL} instructions.")
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes the last frame to a .png, .ppm or .npy file.")
+@click.option("--reference", type=click.Path(exists=True), default=None, help="Compares the last frame with a .ppm or .npy file.")
+def run(file, memory_size, max_instructions, disks, keys, key_delay, settle, restore, interval, output, reference):
+    """Runs an image like harness.py while counting the frames drawn, and compares or saves the last one."""
+    debug_info = DebugInfo.find(file)
+    describe = debug_info.describe if debug_info != None else lambda address: f"0x{address:X}"
+
+    machine = Machine(memory_size, [open_disk(disk) for disk in disks], (), key_delay)
+    machine.load(file)
+    if restore != None:
+        machine.load_snapshot(restore)
+    machine.keyboard.type([parse_key(key.strip()) for key in keys.split(",") if key.strip()])
+    framebuffer = Framebuffer(machine)
+    counter = FrameCounter(framebuffer, interval)
+    machine.attach(counter)
+
+    initial = machine.instructions
+    start = time.perf_counter()
+    try:
+        reason = machine.run_until(max_instructions, settle)
+    except CpuException as e:
+        click.echo(f"ERROR: {type(e).__name__} at {describe(e.ip)}", err=True)
+        reason = "fault"
+    elapsed = time.perf_counter() - start
+    # Changes after the last update
+    counter.countdown = 1
+    counter.update_device(machine)
+
+    executed = machine.instructions - initial
+    frames = len(counter.frames)
+    click.echo(f"{reason} after {executed} instructions in {elapsed:.3f}s, {frames} frames "
+               f"({frames / executed * 1e6 if executed else 0:.2f} per million instructions)")
+
+    frame = framebuffer.capture()
+    if output != None:
+        save(frame, output)
+    if reference != None:
+        expected = load(reference)
+        if expected.shape != frame.shape:
+            click.echo(f"ERROR: reference is {expected.shape[1]}x{expected.shape[0]}, not {frame.shape[1]}x{frame.shape[0]}", err=True)
+            exit(1)
+        rectangles = dirty_rectangles(frame, expected)
+        if rectangles:
+            click.echo(f"frame differs from {reference} in {len(rectangles)} rectangles:")
+            for x, y, width, height in rectangles:
+                click.echo(f"  {width}x{height} at ({x}, {y})")
+            exit(1)
+        click.echo(f"frame matches {reference}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+import mmap
+import time
+import click
+from emulator import Emulator, Device, CpuException, MEMORY_SIZE, UPDATE_INTERVAL, U16, U32
+from translator import TranslatingEmulator
+from debuginfo import DebugInfo
+from cover import Coverage, merge_into
+
+# Device classes, same values as `Class` in vm/src/device.rs
+CLASS_MEMORY = 0x1
+CLASS_DISK_CONTROLLER = 0x2
+CLASS_INTERRUPT_CONTROLLER = 0x3
+CLASS_KEYBOARD = 0x11
+CLASS_MONITOR = 0x20
+
+# Addresses and sizes used by vm/src/vm.rs
+DEVICE_MANAGER_ADDRESS = 0xF0000
+DISK_CONTROLLER_ADDRESS = 0xF1000
+INTERRUPT_CONTROLLER_ADDRESS = 0xF2000
+KEYBOARD_ADDRESS = 0xF3000
+FRAMEBUFFER_ADDRESS = 0x100000
+FRAMEBUFFER_SIZE = 32 * 1024 * 1024
+SCREEN_WIDTH = 640
+SCREEN_HEIGHT = 360
+
+SECTOR_SIZE = 512
+MAX_DISKS = 8
+
+# Key codes sent by the keyboard, in the order of minifb's `Key` (and the `key` enum of boot/keyboard.kl)
+KEYS = [
+    *(f"key-{i}" for i in range(10)),
+    *"abcdefghijklmnopqrstuvwxyz",
+    *(f"f{i}" for i in range(1, 16)),
+    "down", "left", "right", "up",
+    "apostrophe", "backquote", "backslash", "comma", "equal", "left-bracket", "minus",
+    "period", "right-bracket", "semicolon", "slash", "backspace", "delete", "end", "enter",
+    "escape", "home", "insert", "menu", "page-down", "page-up", "pause", "space", "tab", "num-lock",
+    "caps-lock", "scroll-lock", "left-shift", "right-shift", "left-ctrl", "right-ctrl",
+    *(f"numpad-{i}" for i in range(10)),
+    "numpad-dot", "numpad-slash", "numpad-asterisk", "numpad-minus", "numpad-plus", "numpad-enter",
+    "left-alt", "right-alt", "left-super", "right-super", "unknown",
+]
+
+# Instructions waited before sending each scripted key, so the program has time to handle the last one
+KEY_DELAY = 100000
+
+class DeviceRecord:
+    # Same fields as `DeviceRecord` in vm/src/device.rs
+    def __init__(self, id, device_class, interrupt_line=0, base_address_0=0, limit_0=0, base_address_1=0, limit_1=0):
+        self.id = id
+        self.device_class = device_class
+        self.interrupt_line = interrupt_line
+        self.base_address_0 = base_address_0
+        self.limit_0 = limit_0
+        self.base_address_1 = base_address_1
+        self.limit_1 = limit_1
+
+class DeviceManager(Device):
+    # Answers the device scan of boot/device.kl with the records of the other devices
+    def __init__(self, address=DEVICE_MANAGER_ADDRESS):
+        self.address = address
+        self.device_id = 0
+        self.records = {} # Device id -> DeviceRecord
+
+    def register(self, record):
+        self.records[record.id] = record
+
+    def save_state(self):
+        return {"device_id": self.device_id}
+
+    def load_state(self, state):
+        self.device_id = state["device_id"]
+
+    def memory_area(self):
+        return range(self.address, self.address + 0x14)
+
+    def init_memory(self, emulator):
+        emulator.memory[self.address] = 0x01
+
+    def write_memory(self, emulator, address, value):
+        offset = address - self.address
+        if offset == 0 and value == 0x01:
+            record = self.records.get(self.device_id)
+            memory = emulator.memory
+            if record != None:
+                memory[self.address] = 0x01
+                memory[self.address + 0x1] = self.device_id
+                memory[self.address + 0x2] = record.device_class
+                memory[self.address + 0x3] = record.interrupt_line
+                for offset, value in ((0x4, record.base_address_0), (0x8, record.limit_0),
+                                      (0xC, record.base_address_1), (0x10, record.limit_1)):
+                    U32.pack_into(memory, self.address + offset, value)
+            else:
+                memory[self.address] = 0x04
+        elif offset == 1:
+            self.device_id = value
+        return False
+
+class MemoryDevice(Device):
+    def __init__(self, id, memory_size):
+        self.device_record = DeviceRecord(id, CLASS_MEMORY, limit_0=memory_size)
+
+    def record(self):
+        return self.device_record
+
+class Monitor(Device):
+    # The framebuffer is plain memory with one 0x00RRGGBB pixel per 4 bytes, only read by `dump`
+    def __init__(self, id, address=FRAMEBUFFER_ADDRESS, framebuffer_size=FRAMEBUFFER_SIZE,
+                 width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        self.device_record = DeviceRecord(id, CLASS_MONITOR, base_address_0=address + framebuffer_size,
+                                          base_address_1=address, limit_1=address + framebuffer_size - 1)
+        self.address = address + framebuffer_size
+        self.framebuffer_address = address
+        self.width = width
+        self.height = height
+
+    def record(self):
+        return self.device_record
+
+    def memory_area(self):
+        return range(self.framebuffer_address, self.address + 1)
+
+    def init_memory(self, emulator):
+        emulator.memory[self.address] = 0x01
+
+    def pixels(self, emulator):
+        # RGB bytes of the visible part of the framebuffer
+        start = self.framebuffer_address
+        framebuffer = emulator.memory[start:start + self.width * self.height * 4]
+        rgb = bytearray(self.width * self.height * 3)
+        rgb[0::3] = framebuffer[2::4]
+        rgb[1::3] = framebuffer[1::4]
+        rgb[2::3] = framebuffer[0::4]
+        return rgb
+
+    def dump(self, emulator, path):
+        # Writes the screen as a binary PPM image
+        with open(path, "wb") as f:
+            f.write(f"P6\n{self.width} {self.height}\n255\n".encode())
+            f.write(self.pixels(emulator))
+
+class DiskController(Device):
+    # Disks are anything that supports slicing, like bytes or an mmap. Writes only change the
+    # disk object, so a read-only image should be passed as a bytearray or a copy-on-write mmap
+    def __init__(self, id, address=DISK_CONTROLLER_ADDRESS):
+        self.device_record = DeviceRecord(id, CLASS_DISK_CONTROLLER, base_address_0=address + SECTOR_SIZE,
+                                          base_address_1=address, limit_1=address + SECTOR_SIZE - 1)
+        self.address = address + SECTOR_SIZE
+        self.data_address = address
+        self.disks = [None] * MAX_DISKS
+        self.input = bytearray(4)
+        self.selected_disk = 0
+        self.update_disk_register = None
+
+    def record(self):
+        return self.device_record
+
+    def set_disk(self, slot, disk):
+        self.disks[slot] = disk
+        self.update_disk_register = sum(1 << i for i, disk in enumerate(self.disks) if disk != None)
+
+    def save_state(self):
+        # The disks aren't saved, they are given again when restoring
+        return {"input": list(self.input), "selected_disk": self.selected_disk}
+
+    def load_state(self, state):
+        self.input[:] = bytes(state["input"])
+        self.selected_disk = state["selected_disk"]
+        # The restored register has the disks of the snapshot
+        self.update_disk_register = sum(1 << i for i, disk in enumerate(self.disks) if disk != None)
+
+    def memory_area(self):
+        return range(self.data_address, self.address + 0x7)
+
+    def init_memory(self, emulator):
+        emulator.memory[self.address] = 0x01
+
+    def read_memory(self, emulator, address):
+        if self.update_disk_register != None:
+            emulator.memory[self.address + 1] = self.update_disk_register
+            self.update_disk_register = None
+        return emulator.memory[address]
+
+    def error(self, emulator, code):
+        emulator.memory[self.address] = 0x04
+        emulator.memory[self.address + 2] = code
+
+    def write_memory(self, emulator, address, value):
+        offset = address - self.address
+        disk = self.disks[self.selected_disk]
+        if offset == 0 and value in (0x1, 0x2, 0x8) and disk == None:
+            self.error(emulator, 0x01)
+        elif offset == 0 and value == 0x1: # Read sector
+            start = U32.unpack(self.input)[0] * SECTOR_SIZE
+            if start + SECTOR_SIZE <= len(disk):
+                emulator.write_raw(self.data_address, disk[start:start + SECTOR_SIZE])
+            else:
+                self.error(emulator, 0x02)
+        elif offset == 0 and value == 0x2: # Write sector
+            start = U32.unpack(self.input)[0] * SECTOR_SIZE
+            if start + SECTOR_SIZE <= len(disk):
+                disk[start:start + SECTOR_SIZE] = emulator.memory[self.data_address:self.address]
+            else:
+                self.error(emulator, 0x02)
+        elif offset == 0 and value == 0x4: # Select disk
+            if self.input[0] < MAX_DISKS and self.disks[self.input[0]] != None:
+                emulator.memory[self.address] = 0x01
+                self.selected_disk = self.input[0]
+            else:
+                self.error(emulator, 0x01)
+        elif offset == 0 and value == 0x8: # Get sector count
+            U32.pack_into(emulator.memory, self.address + 3, len(disk) // SECTOR_SIZE)
+        elif 1 <= offset <= 4:
+            self.input[offset - 1] = value
+        return False
+
+class InterruptController(Device):
+    # Sends the interrupts queued by other devices. Unlike vm/, interrupts are kept in the queue
+    # while the CPU has them disabled instead of being lost, so scripted input always arrives
+    def __init__(self, id, address=INTERRUPT_CONTROLLER_ADDRESS):
+        self.device_record = DeviceRecord(id, CLASS_INTERRUPT_CONTROLLER, base_address_0=address + 64,
+                                          base_address_1=address, limit_1=address + 64 - 1)
+        self.address = address + 64
+        self.table_address = address
+        self.enabled = False
+        self.bitmask = 0xFFFF
+        self.queue = [] # (line, error code)
+
+    def record(self):
+        return self.device_record
+
+    def save_state(self):
+        return {"enabled": self.enabled, "bitmask": self.bitmask, "queue": self.queue}
+
+    def load_state(self, state):
+        self.enabled = state["enabled"]
+        self.bitmask = state["bitmask"]
+        self.queue = [tuple(interrupt) for interrupt in state["queue"]]
+
+    def memory_area(self):
+        return range(self.table_address, self.address + 3)
+
+    def init_memory(self, emulator):
+        emulator.memory[self.address] = 0x01
+        U16.pack_into(emulator.memory, self.address + 1, self.bitmask)
+
+    def write_memory(self, emulator, address, value):
+        offset = address - self.address
+        if offset == 0:
+            self.enabled = value & 1 == 0
+        elif offset == 1:
+            self.bitmask = (self.bitmask & 0xFF00) | value
+        elif offset == 2:
+            self.bitmask = (self.bitmask & 0x00FF) | (value << 8)
+        return True
+
+    def update_device(self, emulator):
+        if not self.enabled or not emulator.interrupts_enabled or not self.queue:
+            return
+        # Interrupt handlers run with interrupts disabled, so only one can be sent at a time
+        for i, (line, error_code) in enumerate(self.queue):
+            if self.bitmask >> line & 1 == 0:
+                del self.queue[i]
+                emulator.interrupt(line, error_code)
+                return
+
+class Keyboard(Device):
+    # Sends the keys of a script, each one `delay` instructions after the last one was acknowledged
+    def __init__(self, id, interrupt_controller, address=KEYBOARD_ADDRESS, script=(), delay=KEY_DELAY):
+        self.device_record = DeviceRecord(id, CLASS_KEYBOARD, base_address_0=address, interrupt_line=1)
+        self.address = address
+        self.interrupt_controller = interrupt_controller
+        self.script = list(script) # Key codes left to send
+        self.delay = delay
+        self.waiting = False
+        self.next = delay # Instruction count when the next key can be sent
+        self.done = None if self.script else 0 # Instruction count when the last key was acknowledged
+
+    def record(self):
+        return self.device_record
+
+    def type(self, keys):
+        # Adds keys to the end of the script
+        self.script += keys
+        if keys:
+            self.done = None
+
+    def save_state(self):
+        return {"script": self.script, "waiting": self.waiting, "next": self.next, "done": self.done}
+
+    def load_state(self, state):
+        self.script = list(state["script"])
+        self.waiting = state["waiting"]
+        self.next = state["next"]
+        self.done = state["done"]
+
+    def memory_area(self):
+        return range(self.address, self.address + 4)
+
+    def init_memory(self, emulator):
+        emulator.memory[self.address] = 0x01
+
+    def update_device(self, emulator):
+        if self.waiting or not self.script or emulator.instructions < self.next:
+            return
+        self.interrupt_controller.queue.append((self.device_record.interrupt_line, None))
+        self.waiting = True
+        U16.pack_into(emulator.memory, self.address + 2, self.script.pop(0))
+        emulator.memory[self.address] = 0x02
+
+    def write_memory(self, emulator, address, value):
+        if address == self.address and value == 0x01:
+            self.waiting = False
+            emulator.memory[self.address] = 0x01
+            self.next = emulator.instructions + self.delay
+            if not self.script and self.done == None:
+                self.done = emulator.instructions
+        return False
+
+class Breakpoint(CpuException):
+    pass
+
+class Machine(Emulator):
+    # Emulator with the devices of vm/src/vm.rs, without a window or real disks
+    def __init__(self, memory_size=MEMORY_SIZE, disks=(), keys=(), key_delay=KEY_DELAY, breakpoints=()):
+        super().__init__(memory_size)
+        self.breakpoints = set(breakpoints)
+
+        self.interrupt_controller = InterruptController(3)
+        self.memory_device = MemoryDevice(0, memory_size)
+        self.monitor = Monitor(1)
+        self.disk_controller = DiskController(2)
+        self.keyboard = Keyboard(4, self.interrupt_controller, script=keys, delay=key_delay)
+        self.device_manager = DeviceManager()
+        for slot, disk in enumerate(disks):
+            self.disk_controller.set_disk(slot, disk)
+
+        # The interrupt controller is updated last, so it sends the interrupts queued by the other
+        # devices in the same update like `Vm::cycle`
+        for device in (self.memory_device, self.monitor, self.disk_controller, self.keyboard,
+                       self.device_manager, self.interrupt_controller):
+            self.attach(device)
+            if device.record() != None:
+                self.device_manager.register(device.record())
+
+    def decode(self, ip):
+        # Breakpoints aren't cached, so they still work after the code under them is rewritten
+        if ip in self.breakpoints:
+            return (self.stop, ip, None, ip)
+        return super().decode(ip)
+
+    def stop(self, a, b, next):
+        raise Breakpoint(a)
+
+    def run_until(self, max_instructions=None, settle=None):
+        # Runs until the program halts or reaches a breakpoint, `max_instructions` are run or, with
+        # `settle`, `settle` instructions after the last scripted key was acknowledged. Returns why
+        # it stopped
+        try:
+            while not self.halted:
+                if settle != None and self.keyboard.done != None and self.instructions >= self.keyboard.done + settle:
+                    return "idle"
+                limit = self.instructions + UPDATE_INTERVAL
+                if max_instructions != None:
+                    if self.instructions >= max_instructions:
+                        return "limit"
+                    limit = min(limit, max_instructions)
+                self.run(limit)
+        except Breakpoint:
+            return "breakpoint"
+        return "halted"
+
+class TranslatingMachine(Machine, TranslatingEmulator):
+    # Breakpoints are never translated, the translator runs them through Machine.decode
+    pass
+
+def open_disk(path):
+    # Copy-on-write mapping, the program can write to the disk without changing the file
+    with open(path, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except ValueError:
+            # Empty files can't be mapped
+            return bytearray(f.read())
+
+def parse_key(key):
+    if key in KEYS:
+        return KEYS.index(key)
+    try:
+        return int(key, 0)
+    except ValueError:
+        raise click.BadParameter(f"unknown key '{key}'")
+
+def parse_address(address, debug_info):
+    if debug_info != None and address in debug_info.symbols:
+        return debug_info.symbols[address]
+    try:
+        return int(address, 0)
+    except ValueError:
+        raise click.BadParameter(f"invalid address '{address}'")
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--memory-size", "-m", default=MEMORY_SIZE, help="Memory size in bytes (default 128M).")
+@click.option("--max-instructions", "-n", type=int, default=None, help="Stops after this many instructions.")
+@click.option("--disk", "-d", "disks", type=click.Path(exists=True), multiple=True, help="Disk image, can be given up to 8 times.")
+@click.option("--keys", "-k", default="", help="Comma separated keys to type, like 'down,enter' (names from boot/keyboard.kl or codes).")
+@click.option("--key-delay", type=int, default=KEY_DELAY, help="Instructions to wait before each key.")
+@click.option("--until", "-u", multiple=True, help="Stops when reaching an address or a global symbol (with debug info).")
+@click.option("--settle", type=int, default=None, help="Stops this many instructions after the last key was handled.")
+@click.option("--screenshot", "-s", type=click.Path(), default=None, help="Writes the screen to a PPM file when stopping.")
+@click.option("--registers", is_flag=True, default=False, help="Prints the registers when stopping.")
+@click.option("--restore", "-r", type=click.Path(exists=True), default=None, help="Starts from a snapshot instead of booting.")
+@click.option("--snapshot", type=click.Path(), default=None, help="Writes a snapshot of the machine when stopping.")
+@click.option("--coverage", "coverage_output", type=click.Path(), default=None, help="Adds the instructions that ran to a coverage file for cover.py.")
+@click.option("--translate", "-t", is_flag=True, default=False, help="Compiles basic blocks into Python functions.")
+def run(file, memory_size, max_instructions, disks, keys, key_delay, until, settle, screenshot, registers, restore, snapshot, coverage_output, translate):
+    """Boots an image with stand-ins for the devices of vm/ and no window, and reports how long it took."""
+    if len(disks) > MAX_DISKS:
+        click.echo(f"ERROR: at most {MAX_DISKS} disks can be used", err=True)
+        exit(1)
+
+    if memory_size <= FRAMEBUFFER_ADDRESS + FRAMEBUFFER_SIZE:
+        click.echo(f"ERROR: memory must be bigger than 0x{FRAMEBUFFER_ADDRESS + FRAMEBUFFER_SIZE:X} bytes to fit the framebuffer", err=True)
+        exit(1)
+
+    debug_info = DebugInfo.find(file)
+    describe = debug_info.describe if debug_info != None else lambda address: f"0x{address:X}"
+
+    machine = (TranslatingMachine if translate else Machine)(memory_size, [open_disk(disk) for disk in disks], (), key_delay,
+                      [parse_address(address, debug_info) for address in until])
+    machine.load(file)
+    if coverage_output != None:
+        with open(file, "rb") as f:
+            machine.coverage = Coverage.for_image(f.read())
+    if restore != None:
+        start = time.perf_counter()
+        try:
+            machine.load_snapshot(restore)
+        except (ValueError, KeyError) as e:
+            click.echo(f"ERROR: invalid snapshot: {e}", err=True)
+            exit(1)
+        click.echo(f"restored {restore} at {machine.instructions} instructions in {time.perf_counter() - start:.3f}s")
+    # Keys are added after restoring, which replaces the script
+    machine.keyboard.type([parse_key(key.strip()) for key in keys.split(",") if key.strip()])
+
+    initial = machine.instructions
+    start = time.perf_counter()
+    try:
+        reason = machine.run_until(max_instructions, settle)
+    except CpuException as e:
+        click.echo(f"ERROR: {type(e).__name__} at {describe(e.ip)}", err=True)
+        reason = "fault"
+    elapsed = time.perf_counter() - start
+
+    executed = machine.instructions - initial
+    click.echo(f"{reason} at {describe(machine.ip)} after {machine.instructions} instructions, {executed} in {elapsed:.3f}s "
+               f"({executed / elapsed / 1e6:.2f}M instructions/s)")
+    if registers:
+        click.echo(" ".join(f"${i}={value:X}" for i, value in enumerate(machine.registers)))
+    if screenshot != None:
+        machine.monitor.dump(machine, screenshot)
+    if snapshot != None:
+        machine.save_snapshot(snapshot)
+    if coverage_output != None and not merge_into(machine.coverage, coverage_output):
+        click.echo(f"WARNING: replaced the coverage of another image in {coverage_output}", err=True)
+    if reason == "fault":
+        exit(1)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import bisect
+import struct
+
+U32 = struct.Struct("<I")
+
+JI = 0x23 # Opcode of `j` with an immediate, used to jump to a merged tail
+RET = 0x35
+JI_SIZE = 5
+# A merged tail costs a jump every time it runs, so small savings aren't worth it
+MIN_TAIL_SAVING = 4
+
+class Function:
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start # Positions in the code, not addresses
+        self.end = end
+        self.folded = None # Function with the same code it was folded into
+
+    def kept(self):
+        function = self
+        while function.folded != None:
+            function = function.folded
+        return function
+
+class Report:
+    def __init__(self, size):
+        self.size = size # Size of the code before folding
+        self.folded = [] # (name, name of the function kept, size)
+        self.tails = {} # Function name -> [tails merged, bytes saved]
+        self.saved = 0
+
+def fold(assembler, merge_tails=True):
+    # Folds functions with the same code once their relocations are normalized onto a single
+    # copy and replaces tails of a function ending like an earlier tail with a jump to it, then
+    # removes the code that isn't used anymore. Functions come from .func/.endfunc directives, and
+    # every address pointing into moved code has to be a relocation. Needs the final link to be done
+    base = assembler.pos_offset
+    code = assembler.code
+    relocations = assembler.relocations
+    report = Report(len(code))
+
+    # Functions with .align inside aren't touched, removing code before the padding would change it
+    aligned = [position for position, _, _ in assembler.alignments]
+    functions = []
+    for name, start, end in sorted(assembler.debug_functions, key=lambda function: function[1]):
+        start, end = start - base, end - base
+        i = bisect.bisect_left(aligned, start)
+        if i < len(aligned) and aligned[i] < end:
+            continue
+        functions.append(Function(name, start, end))
+    starts = [function.start for function in functions]
+    positions = sorted(relocations)
+
+    def containing(position):
+        i = bisect.bisect_right(starts, position) - 1
+        if i >= 0 and position < functions[i].end:
+            return functions[i]
+        return None
+
+    def resolve(address):
+        # Address in the copy of a folded function that is kept
+        function = containing(address - base)
+        if function == None or function.folded == None:
+            return address
+        return address - function.start + function.kept().start
+
+    def normalized(function):
+        # Code of a function with the relocations replaced by where they point to, relative to
+        # the function when they point inside it
+        data = bytearray(code[function.start:function.end])
+        targets = []
+        for position in positions[bisect.bisect_left(positions, function.start):bisect.bisect_left(positions, function.end)]:
+            offset = position - function.start
+            data[offset:offset + 4] = bytes(4)
+            target = relocations[position] - base
+            if function.start <= target < function.end:
+                targets.append((offset, "self", target - function.start))
+            else:
+                targets.append((offset, resolve(target + base)))
+        return bytes(data), tuple(targets)
+
+    # Functions calling folded functions can become identical, so this runs until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        groups = {}
+        for function in functions:
+            if function.folded == None:
+                groups.setdefault(normalized(function), []).append(function)
+        for group in groups.values():
+            for function in group[1:]:
+                function.folded = group[0]
+                report.folded.append((function.name, group[0].name, function.end - function.start))
+                changed = True
+
+    removed = [(function.start, function.end) for function in functions if function.folded != None]
+    if merge_tails:
+        referenced = {target - base for target in relocations.values()}
+        referenced |= {address - base for address in assembler.global_symbols_def.values()}
+        for function in functions:
+            if function.folded == None:
+                removed += merge_function_tails(assembler, function, referenced, report)
+
+    compact(assembler, removed, resolve)
+    report.saved = report.size - len(assembler.code)
+    return report
+
+def merge_function_tails(assembler, function, referenced, report):
+    # Finds instructions ending a path (`j` to a label or `ret`) that are the same, and walks back
+    # from both while the instructions match. The later copy is replaced with a jump to the
+    # earlier one, which is only possible when nothing jumps into the middle of it
+    code = assembler.code
+    base = assembler.pos_offset
+    relocations = assembler.relocations
+    first = bisect.bisect_left(assembler.instructions, function.start)
+    last = bisect.bisect_left(assembler.instructions, function.end)
+    instructions = assembler.instructions[first:last]
+    if not instructions:
+        return []
+    ends = instructions[1:] + [function.end]
+
+    def same(i, j):
+        a, b = instructions[i], instructions[j]
+        if ends[i] - a != ends[j] - b or code[a:ends[i]] != code[b:ends[j]]:
+            return False
+        # Equal bytes can still be a constant on one side and an address that will move on the other
+        return all(((a + offset) in relocations) == ((b + offset) in relocations) for offset in range(ends[i] - a))
+
+    groups = {}
+    for i, position in enumerate(instructions):
+        if code[position] in (JI, RET) and ends[i] - position == (JI_SIZE if code[position] == JI else 1):
+            groups.setdefault(bytes(code[position:ends[i]]), []).append(i)
+
+    used = set() # Instructions already replaced
+    removed = []
+    for group in groups.values():
+        kept = group[0]
+        for other in group[1:]:
+            if other in used:
+                continue
+            i, j = kept, other
+            start = None
+            while i >= 0 and j > kept and i not in used and j not in used and same(i, j):
+                start = (i, j)
+                # Only the first instruction of the removed copy can be jumped to
+                if instructions[j] in referenced:
+                    break
+                i -= 1
+                j -= 1
+            if start == None:
+                continue
+            target, first_removed = instructions[start[0]], instructions[start[1]]
+            end = ends[other]
+            if end - first_removed - JI_SIZE < MIN_TAIL_SAVING:
+                continue
+
+            for position in range(first_removed, end):
+                relocations.pop(position, None)
+            code[first_removed] = JI
+            code[first_removed + 1:first_removed + JI_SIZE] = U32.pack(target + base)
+            relocations[first_removed + 1] = target + base
+            referenced.add(target)
+            used.update(range(start[1], other + 1))
+            removed.append((first_removed + JI_SIZE, end))
+            entry = report.tails.setdefault(function.name, [0, 0])
+            entry[0] += 1
+            entry[1] += end - first_removed - JI_SIZE
+    return removed
+
+def compact(assembler, removed, resolve):
+    # Removes ranges of the code and moves everything after them, fixing relocations, symbols and
+    # debug info. Alignment padding is removed and added again where the code ends up
+    base = assembler.pos_offset
+    code = assembler.code
+    cuts = [(start, end, None) for start, end in removed if end > start]
+    cuts += [(position, position + padding, alignment) for position, padding, alignment in assembler.alignments]
+    cuts.sort(key=lambda cut: (cut[0], cut[1]))
+
+    new = bytearray()
+    segments = [] # (old start, old end, new start) of the code that stays
+    alignments = []
+    padding = 0
+    position = 0
+    for start, end, alignment in cuts:
+        if start > position:
+            segments.append((position, start, len(new)))
+            new += code[position:start]
+        if alignment != None:
+            added = -(len(new) + base) % alignment
+            alignments.append((len(new), added, alignment))
+            new += bytes(added)
+            padding += added
+        position = max(position, end)
+    segments.append((position, len(code), len(new)))
+    new += code[position:]
+    old_starts = [segment[0] for segment in segments]
+
+    def kept(position):
+        i = bisect.bisect_right(old_starts, position) - 1
+        return i >= 0 and position < segments[i][1]
+
+    def move(position):
+        # Removed positions go to where the code after them ends up
+        i = bisect.bisect_right(old_starts, position) - 1
+        if i >= 0 and position < segments[i][1]:
+            return segments[i][2] + position - segments[i][0]
+        return segments[i + 1][2] if i + 1 < len(segments) else len(new)
+
+    def move_end(position):
+        # End of the code that stays before a position
+        i = bisect.bisect_left(old_starts, position) - 1
+        return segments[i][2] + min(position, segments[i][1]) - segments[i][0] if i >= 0 else 0
+
+    def move_address(address):
+        return move(resolve(address) - base) + base
+
+    relocations = {}
+    for position, target in assembler.relocations.items():
+        if kept(position):
+            relocations[move(position)] = move_address(target)
+            new[move(position):move(position) + 4] = U32.pack(move_address(target) & 0xFFFFFFFF)
+    assembler.relocations = relocations
+    assembler.global_symbols_def = {symbol: move_address(address) for symbol, address in assembler.global_symbols_def.items()}
+
+    assembler.debug_functions = [
+        (name, move(start - base) + base, move_end(end - base) + base)
+        for name, start, end in assembler.debug_functions
+        if kept(start - base)
+    ]
+    assembler.debug_lines = [
+        (move(address - base) + base, file, line, column)
+        for address, file, line, column in assembler.debug_lines
+        if kept(address - base) or address - base >= len(code)
+    ]
+    assembler.instructions = [move(position) for position in assembler.instructions if kept(position)]
+    if assembler.rodata_start != None:
+        assembler.rodata_start = move(assembler.rodata_start)
+    assembler.padding += padding - sum(padding for _, padding, _ in assembler.alignments)
+    assembler.alignments = alignments
+    assembler.code = new
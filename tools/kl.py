@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 
+import os
 import click
+import struct
+import hashlib
+
+import peephole
+import backend
+import pgo
+import lto
+from timings import Timings, NO_TIMINGS, finish
 
 UNSIGNED_INT_TYPES = [
     "uint8",
@@ -25,6 +34,15 @@ TYPE_SIZES = {
     "int32": 4,
 }
 
+TYPE_FORMATS = {
+    "uint8": "<B",
+    "uint16": "<H",
+    "uint32": "<I",
+    "int8": "<b",
+    "int16": "<h",
+    "int32": "<i",
+}
+
 SIZE_DIRECTIVES = {
     1: "byte",
     2: "word",
@@ -45,6 +63,7 @@ class Node():
         self.type = type
         self.line = line
         self.col = col
+        self.suffix = "" # Added to the id of copies, so their labels don't collide
     
     def __repr__(self):
         return f"Node({repr(self.value)}, {repr(self.type)}, {repr(self.line)}, {repr(self.col)})"
@@ -66,7 +85,7 @@ class Node():
     
     @property
     def id(self):
-        return f"{self.line}_{self.col}"
+        return f"{self.line}_{self.col}{self.suffix}"
 
     def transform(self, f):
         f(self)
@@ -74,6 +93,74 @@ class Node():
             for node in self.value:
                 node.transform(f)
 
+    def clone(self, suffix):
+        if self.type == "list":
+            value = [node.clone(suffix) for node in self.value]
+        elif self.type == "bytes":
+            value = bytearray(self.value)
+        else:
+            value = self.value
+        node = Node(value, self.type, self.line, self.col)
+        node.suffix = self.suffix + suffix
+        return node
+
+    def size(self):
+        # Amount of nodes in the tree
+        if self.type == "list":
+            return 1 + sum(node.size() for node in self.value)
+        return 1
+
+def literal_values(node):
+    # Returns the values of a string or a list of integer literals, or None for any other node
+    if node.type == "bytes":
+        return list(node.value)
+    elif node.type == "list" and len(node) > 0 and all(val.type == "int" for val in node.value):
+        return [val.value for val in node.value]
+    return None
+
+def literal_string(node):
+    # Returns the text of a string literal or list of bytes without the null terminator
+    values = literal_values(node)
+    if values == None:
+        return None
+    return "".join([chr(value) for value in values[:-1]])
+
+def data_directive(type, values):
+    # Encodes a list of values of the same type in a single data directive
+    directive = TYPE_DIRECTIVES[type]
+    if len(values) > 1 and not any(values):
+        return f".{directive} 0 {len(values)}"
+    elif directive == "byte" and all(0 <= value <= 0xFF for value in values):
+        return f".byte x\"{bytes(values).hex()}\""
+    else:
+        return f".{directive} " + ", ".join([str(value) for value in values])
+
+def struct_layout(fields, aligned=False):
+    # Offsets of the fields of a struct and its size. Fields are packed back to back, or with
+    # `aligned` put at a multiple of their size with the size rounded up to the biggest field
+    offsets = {} # Field name -> (offset, type)
+    size = 0
+    alignment = 1
+    for field in fields:
+        field_size = TYPE_SIZES[field["type"]]
+        if aligned:
+            size += -size % field_size
+            alignment = max(alignment, field_size)
+        offsets[field["name"]] = (size, field["type"])
+        size += field_size
+    return offsets, size + -size % alignment
+
+def align_directive(type):
+    # Data is aligned to the size of its type, so loads and stores of it are aligned
+    return f".align {TYPE_SIZES[type]}\n" if TYPE_SIZES[type] > 1 else ""
+
+def pack_values(type, values):
+    # Returns the little endian encoding of a list of values, or None if a value doesn't fit in the type
+    try:
+        return b"".join([struct.pack(TYPE_FORMATS[type], value) for value in values])
+    except struct.error:
+        return None
+
 def parse(code, line=1, col=1):
     stack = []
     current_list = Node([], "list", line, col)
@@ -105,13 +192,13 @@ def parse(code, line=1, col=1):
                 continue
 
             elif char == "\"":
-                current.value.append(Node(0, "int", line, col))
+                current.value.append(0)
                 current_list.value.append(current)
                 mode = "normal"
                 current = None
                 continue
 
-            current.value.append(Node(ord(char), "int", line, col))
+            current.value += char.encode()
 
         elif mode == "char":
             current.value = ord(char)
@@ -141,7 +228,7 @@ def parse(code, line=1, col=1):
 
             elif char == "\"":
                 mode = "string"
-                current = Node([], "list", line, col)
+                current = Node(bytearray(), "bytes", line, col)
             
             elif char == "'":
                 mode = "char"
@@ -164,15 +251,98 @@ class CompileError(Exception):
         self.message = message
         self.node = node
 
+class SymbolTable(dict):
+    # Global symbols, looked up through the namespace prefixes that are in effect (no prefix,
+    # current namespace, then `@using` namespaces). Resolved names are cached until a symbol
+    # or a prefix is added
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefixes = [""]
+        self.resolved = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.resolved.clear()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.resolved.clear()
+
+    def set_prefixes(self, prefixes):
+        self.prefixes = prefixes
+        self.resolved.clear()
+
+    def resolve(self, key):
+        try:
+            return self.resolved[key]
+        except KeyError:
+            pass
+
+        entry = (None, None)
+        for prefix in self.prefixes:
+            if prefix + key in self:
+                entry = (self[prefix + key], prefix + key)
+                break
+
+        self.resolved[key] = entry
+        return entry
+
+class Scopes:
+    # Stack of variable scopes (first scope is global). Local variables are also indexed
+    # by name so a lookup doesn't have to walk every scope
+    def __init__(self):
+        self.scopes = [SymbolTable()]
+        self.locals = {} # Variable name -> entries in enclosing scopes, innermost last
+
+    def __getitem__(self, index):
+        return self.scopes[index]
+
+    def __len__(self):
+        return len(self.scopes)
+
+    @property
+    def globals(self):
+        return self.scopes[0]
+
+    def push(self):
+        self.scopes.append({})
+
+    def pop(self):
+        scope = self.scopes.pop()
+        for name in scope:
+            entries = self.locals[name]
+            entries.pop()
+            if not entries:
+                del self.locals[name]
+        return scope
+
+    def declare(self, name, entry):
+        self.scopes[-1][name] = entry
+        self.locals.setdefault(name, []).append(entry)
+
+    def lookup(self, name):
+        entries = self.locals.get(name)
+        if entries:
+            return entries[-1], name
+        return self.globals.resolve(name)
+
+    def isolated(self):
+        # New stack of scopes with the same globals, for code that can't see the current locals
+        scopes = Scopes()
+        scopes.scopes[0] = self.globals
+        return scopes
+
 class Compiler:
-    def __init__(self, path="<unknown>", comment=False, type_checking="loose", definitions_mode=False, import_mode=False):
+    def __init__(self, path="<unknown>", comment=False, type_checking="loose", definitions_mode=False, import_mode=False, import_cache=None, debug=False, func_directives=False, profile=None, timings=None, program=None):
         self.code = "" # Generated assembly code
-        self.funcs = {} # Dict of function declaration nodes
-        self.structs = {} # Stores struct definitions
-        self.vars = [{}] # Stores variables and scopes (first scope is global)
+        self.data = [] # Data emitted by `data` expressions, put before the code in reverse order
+        self.funcs = SymbolTable() # Dict of function declaration nodes
+        self.structs = SymbolTable() # Stores struct definitions
+        self.vars = Scopes() # Stores variables and scopes (first scope is global)
         self.sp_offset = 0 # Keeps track of distance from base of stack frame to store local variables
         self.directives = {
             "private": False,
+            "aligned": False,
             "namespace": "",
             "using": [],
         }
@@ -181,10 +351,22 @@ class Compiler:
         self.source_code = None # Contents of source code file to generate comments. Optional, must be set manually
         self.line = 0 # Last line of code that a comment was generated for
         self.comment = comment # When set to true, will generate comments for the assembly code
+        self.debug = debug # When set to true, will generate .loc and .func directives for debug info
+        self.func_directives = func_directives or debug # When set to true, will generate .func directives for assembler.py --icf and --map
+        self.profile = profile # pgo.Profile of a previous build, used for code layout and inlining. Optional
+        self.program = program # lto.Program when the whole program is compiled together. Optional
 
         self.type_checking = type_checking # Type checking mode. [strict/loose/off]
         self.definitions_mode = definitions_mode # When in definitions mode, compiler doesn't generate any code
         self.import_mode = import_mode # Set when the compiler is being used to import definitions
+        self.import_cache = import_cache # Optional dict of path -> (mtime, compiler) shared between compilers
+        self.timings = timings if timings != None else NO_TIMINGS # Shared with the compilers of imported files
+        self.imports = [] # Paths of files imported by the compiled code
+        self.constants = set() # Symbols of read-only constants already emitted
+        self.function = None # Name of the function being generated
+        self.cold = "" # Code placed after the end of the function being generated
+        self.inline_end = None # Label that `return` jumps to while generating an inlined function
+        self.inlined = 0 # Amount of inlined calls, used to make their labels unique
     
     def warning(self, message, node):
         click.echo(f"WARNING: {message} ({self.path}:{node.line}:{node.col})", err=True)
@@ -216,14 +398,35 @@ class Compiler:
         else:
             raise CompileError(f"cannot merge types '{l}' and '{r}'", node)
     
-    def get_entry(self, dict, key):
-        for prefix in ["", self.directives["namespace"]] + self.directives["using"]:
-            try:
-                return dict[prefix + key], prefix + key
-            except KeyError:
-                pass
-        
-        return None, None
+    def update_prefixes(self):
+        prefixes = ["", self.directives["namespace"]] + self.directives["using"]
+        for table in (self.funcs, self.structs, self.vars.globals):
+            table.set_prefixes(prefixes)
+
+    def import_definitions(self, path):
+        # Imported files are compiled in definitions mode only, so the result doesn't depend
+        # on the importing file and can be reused as long as the file isn't modified
+        with self.timings.phase("imports"):
+            mtime = os.stat(path).st_mtime_ns
+            if self.import_cache is not None and path in self.import_cache:
+                cached_mtime, compiler = self.import_cache[path]
+                if cached_mtime == mtime:
+                    self.timings.count("import cache hits")
+                    return compiler
+
+            with open(path, "r") as f:
+                code = f.read()
+            compiler = Compiler(path=path, definitions_mode=True, import_mode=True, timings=self.timings)
+            with self.timings.phase("parse"):
+                ast = parse(code)
+            if self.timings.enabled:
+                self.timings.count("nodes parsed", ast.size())
+            compiler.compile(ast)
+            self.timings.count("imports resolved")
+
+            if self.import_cache is not None:
+                self.import_cache[path] = (mtime, compiler)
+            return compiler
 
     def compile(self, ast):
         if not self.definitions_mode:
@@ -233,49 +436,217 @@ class Compiler:
 
         else:
             self.code = ""
-            self.funcs = {}
-            self.structs = {}
-            self.vars = [{}]
+            self.data = []
+            self.funcs = SymbolTable()
+            self.structs = SymbolTable()
+            self.vars = Scopes()
             self.line = 0
+            self.imports = []
+            self.constants = set()
+            self.inlined = 0
+            self.update_prefixes()
 
             if self.source_code:
                 self.source_code = self.source_code.split("\n")
 
-        for node in ast:
-            self.generate_expression(node, root=True)
-    
-    def generate_expression(self, node, root=False, statement=False, r=1):
-        if not self.definitions_mode and root:
-            # TODO: macros?
-            def f(node):
-                if node.type == "list" and len(node) > 0:
-                    if node[0].value == "zero":
-                        if len(node) != 2:
-                            raise CompileError("wrong number of arguments", node)
-                        
-                        if node[1].type == "int":
-                            size = node[1].value
-                        elif node[1].value in self.structs.keys():
-                            size = self.structs[node[1].value]["size"]
-                        elif node[1].value in TYPES:
-                            size = TYPE_SIZES[node[1].value]
-                        else:
-                            raise CompileError("invalid argument", node)
+        # Every top-level node is generated into an empty string and joined at the end, since
+        # appending to one long string copies it every time
+        self.pieces = [self.code]
+        self.functions = [] # (name, index in pieces) of each function
+        self.roots = set() # Indices of top-level asm, which can be entered from anywhere
+        with self.timings.phase("definitions" if self.definitions_mode else "codegen"):
+            for node in ast:
+                self.code = ""
+                if self.program != None:
+                    # Each item gets its own constants, so it can be left out on its own
+                    self.constants = set()
+                self.generate_expression(node, root=True)
+                if not self.definitions_mode and node.type == "list" and node[0].value == "fn":
+                    self.functions.append((self.function, len(self.pieces)))
+                if node.type == "list" and node[0].value == "asm":
+                    self.roots.add(len(self.pieces))
+                self.pieces.append(self.code)
+        self.code = "".join(self.pieces)
+        if not self.definitions_mode:
+            self.timings.count("functions", len(self.functions))
+            self.join()
+
+    def join(self, used=None):
+        # Puts together the code of the data and top-level nodes, leaving out the ones `used(path,
+        # code)` is false for
+        pieces = list(self.pieces)
+        if self.profile != None:
+            self.order_functions(pieces)
+        pieces = list(reversed(self.data)) + pieces
+        if used != None:
+            pieces = [piece for piece in pieces if used(self.path, piece)]
+        self.code = "".join(pieces)
+        if self.program != None:
+            self.code = lto.imports(self.code) + self.code
+
+    def items(self):
+        # (path, code, root) of the data and top-level nodes, for Program.reach
+        for piece in self.data:
+            yield (self.path, piece, False)
+        for i, piece in enumerate(self.pieces):
+            yield (self.path, piece, i in self.roots)
+
+    def order_functions(self, pieces):
+        # Puts the functions that ran the most instructions first and the ones that never ran last,
+        # in the places the functions were generated at
+        def key(function):
+            heat = self.profile.heat(function[0])
+            return (heat == 0, -(heat or 0))
+
+        hot = [pieces[i] for _, i in sorted(self.functions, key=key)]
+        for (_, i), piece in zip(self.functions, hot):
+            pieces[i] = piece
+
+    def escaped_path(self):
+        return self.path.replace("\\", "\\\\").replace('"', '\\"')
+
+    def mark(self, node):
+        # Marks where the code of a node starts, so a profile can tell how many times it ran
+        if self.debug and not self.definitions_mode:
+            self.code += f'.loc "{self.escaped_path()}" {node.line} {node.col}\n'
+
+    def count(self, node):
+        # How many times the code of a node ran in the profile, None if unknown
+        if self.profile == None:
+            return None
+        return self.profile.count(self.path, node)
+
+    def define_constant(self, name, type, value):
+        # Value of a scalar static or enum element, used with --lto while it's never written. It's
+        # masked like a load from memory would do
+        if self.program != None and self.program.analyzing and not self.import_mode:
+            self.program.statics[name] = value & ((1 << 8 * TYPE_SIZES[type]) - 1)
+
+    def mark_written(self, node):
+        # Statics that are written or whose address is used keep being loaded with --lto
+        if self.program != None and self.program.analyzing and node.type == "word":
+            var, var_name = self.vars.lookup(node.value.lstrip("&"))
+            if var != None and var["global"]:
+                self.program.written.add(var_name)
+
+    def expand(self, node):
+        # TODO: macros?
+        def f(node):
+            if node.type == "list" and len(node) > 0:
+                if node[0].value == "zero":
+                    if len(node) != 2:
+                        raise CompileError("wrong number of arguments", node)
+                    
+                    if node[1].type == "int":
+                        size = node[1].value
+                    elif node[1].value in self.structs.keys():
+                        size = self.structs[node[1].value]["size"]
+                    elif node[1].value in TYPES:
+                        size = TYPE_SIZES[node[1].value]
+                    else:
+                        raise CompileError("invalid argument", node)
 
-                        node.value = [Node(0, "int", node.line, node.col) for _ in range(size)]
-                
-                    elif node[0].value == "str":
-                        if len(node) != 2:
-                            raise CompileError("wrong number of arguments", node)
+                    node.type = "bytes"
+                    node.value = bytearray(size)
+            
+                elif node[0].value == "str":
+                    if len(node) != 2:
+                        raise CompileError("wrong number of arguments", node)
 
-                        if node[1].type != "list" or set([val.type for val in node[1].value]) != set(["int"]):
-                            raise CompileError("argument must be string or list of bytes", node)
+                    if literal_values(node[1]) == None:
+                        raise CompileError("argument must be string or list of bytes", node)
 
-                        string = node[1]
-                        node.value = parse("addr (data uint8 ())", line=node.line, col=node.col)
-                        node[1].value[2] = string
+                    string = node[1]
+                    node.value = parse("addr (const uint8 ())", line=node.line, col=node.col)
+                    node[1].value[2] = string
 
-            node.transform(f)
+        node.transform(f)
+    
+    def inlinable(self, func, func_name, node):
+        # Only small leaf functions of the same module that were called often are inlined. With
+        # --lto, functions of any module are, when they are tiny or only called once
+        module = self.module(func)
+        if (module == None and self.profile == None) or self.inline_end != None or func_name == self.function:
+            return False
+        body = func["node"][4:]
+        size = sum(expr.size() for expr in body)
+        limit = 0
+        if module != None:
+            once = self.program.internal(func_name) and self.program.calls[func_name] == 1
+            limit = pgo.INLINE_MAX_NODES if once else lto.INLINE_MAX_NODES
+        elif func.get("path") == self.path and func.get("namespace") == self.directives["namespace"]:
+            module = self
+        else:
+            return False
+        if self.profile != None and (self.count(node) or 0) >= pgo.INLINE_MIN_CALLS:
+            limit = pgo.INLINE_MAX_NODES
+        if size > limit:
+            return False
+
+        leaf = True
+        def f(node):
+            nonlocal leaf
+            if node.type == "list" and len(node) > 0 and node[0].type == "word":
+                if node[0].value in ("asm", "data", "static") or module.funcs.resolve(node[0].value)[0] != None:
+                    leaf = False
+        for expr in body:
+            expr.transform(f)
+        return leaf
+
+    def module(self, func):
+        # Compiler of the module a function is defined in with --lto, None without it
+        if self.program == None or self.program.analyzing:
+            return None
+        return self.program.modules.get(os.path.realpath(func["path"]))
+
+    def generate_inline(self, func, r):
+        # Generates the body of a function in place of a call, with the arguments already pushed. The
+        # body gets its own frame like a called function, without the return address. Names in the
+        # body are looked up in the tables of the module it comes from
+        self.inlined += 1
+        label = f"__inline_{self.inlined}"
+        state = (self.vars, self.sp_offset, self.inline_end, self.line)
+        module = self.module(func) or self
+        tables = (self.funcs, self.structs, self.path, self.source_code)
+
+        self.vars = module.vars.isolated()
+        self.funcs, self.structs, self.path, self.source_code = module.funcs, module.structs, module.path, module.source_code
+        self.sp_offset = 0
+        self.inline_end = label
+        self.line = 0
+        self.vars.push()
+        for i, arg in enumerate(func["node"][3]):
+            self.vars.declare(arg[1].value, {
+                "global": False,
+                "offset": 4 + i * 4,
+                "node": arg,
+                "type": arg[0].value,
+                "length": 1,
+            })
+
+        self.code += backend.PROLOGUE
+        for expr in func["node"][4:]:
+            expr = expr.clone(f"_i{self.inlined}")
+            self.expand(expr)
+            self.generate_expression(expr, statement=True, r=1)
+        self.code += f"#{label}:\nmov $12 $15\npop $12\n"
+
+        self.vars, self.sp_offset, self.inline_end, self.line = state
+        self.funcs, self.structs, self.path, self.source_code = tables
+
+    def generate_statements(self, nodes, r):
+        # Each statement is generated into an empty string and the pieces are joined, so the code
+        # of a big function isn't copied for every line appended to it
+        pieces = [self.code]
+        for node in nodes:
+            self.code = ""
+            self.generate_expression(node, statement=True, r=r)
+            pieces.append(self.code)
+        self.code = "".join(pieces)
+
+    def generate_expression(self, node, root=False, statement=False, r=1):
+        if not self.definitions_mode and root:
+            self.expand(node)
 
         top_level = ["fn", "static", "import", "import-defs", "struct", "enum"]
 
@@ -289,58 +660,54 @@ class Compiler:
         elif node.type == "list" and node[0].value in top_level:
             raise CompileError("expression must be top-level", node)
 
-        if self.comment and not self.definitions_mode and node.line > self.line:
+        if (self.comment or self.debug) and not self.definitions_mode and node.line > self.line:
             self.line = node.line
 
-            self.code += f"; >>> {self.path}:{node.line}"
-            if self.source_code:
-                self.code += f" | {self.source_code[node.line - 1]}"
+            if self.comment:
+                self.code += f"; >>> {self.path}:{node.line}"
+                if self.source_code:
+                    self.code += f" | {self.source_code[node.line - 1]}"
+
+                self.code += "\n"
 
-            self.code += "\n"
+            if self.debug:
+                self.code += f'.loc "{self.escaped_path()}" {node.line} {node.col}\n'
 
         if node.type == "int":
             self.code += f"mov {node.value} ${r}\n"
             
             return "int"
+
+        elif node.type == "bytes":
+            raise CompileError("string cannot be used as expression", node)
         
         elif node.type == "word":
             addr = node.value[0] == "&"
             if addr:
                 node.value = node.value[1:]
 
-            for i, scope in reversed(list(enumerate(self.vars))):
-                if i == 0:
-                    var, var_name = self.get_entry(scope, node.value)
+            var, var_name = self.vars.lookup(node.value)
+
+            if var == None:
+                raise CompileError("undefined variable", node)
+
+            if var["global"]:
+                value = self.program.constant(var_name) if self.program != None and not addr else None
+                if value != None:
+                    self.code += f"mov {value} ${r}\n"
+                elif not addr:
+                    self.code += f"mov #{var_name} ${r+1}\nld{TYPE_DIRECTIVES[var['type']][0]} ${r+1} ${r}\n"
                 else:
-                    try:
-                        var, var_name = scope[node.value], node.value
-                    except KeyError:
-                        var = None
-                
-                if var != None:
-                    if var["global"]:
-                        if not addr:
-                            self.code += f"mov #{var_name} ${r+1}\nld{TYPE_DIRECTIVES[var['type']][0]} ${r+1} ${r}\n"
-                        else:
-                            self.code += f"mov #{var_name} ${r}\n"
-                    else:
-                        if not addr:
-                            self.code += f"mov $12 ${r+1}\n"
-                            if var["offset"] < 0:
-                                self.code += f"sub {-var['offset']} ${r+1}\n"
-                            else:
-                                self.code += f"add {var['offset']} ${r+1}\n"
-                            self.code += f"ld{TYPE_DIRECTIVES[var['type']][0]} ${r+1} ${r}\n"
-                        else:
-                            self.code += f"mov $12 ${r}\n"
-                            if var["offset"] < 0:
-                                self.code += f"sub {-var['offset']} ${r}\n"
-                            else:
-                                self.code += f"add {var['offset']} ${r}\n"
-                    
-                    return var["type"]
-            
-            raise CompileError("undefined variable", node)
+                    self.mark_written(node)
+                    self.code += f"mov #{var_name} ${r}\n"
+            else:
+                if not addr:
+                    self.code += backend.frame_address(var["offset"], r+1)
+                    self.code += f"ld{TYPE_DIRECTIVES[var['type']][0]} ${r+1} ${r}\n"
+                else:
+                    self.code += backend.frame_address(var["offset"], r)
+
+            return var["type"]
 
         elif node[0].value == "@private":
             if len(node) != 1:
@@ -349,6 +716,13 @@ class Compiler:
             if self.import_mode:
                 self.directives["private"] = True
 
+        elif node[0].value == "@aligned":
+            if len(node) != 1:
+                raise CompileError("wrong number of arguments", node)
+
+            if self.definitions_mode:
+                self.directives["aligned"] = True
+
         elif node[0].value == "@namespace":
             if len(node) != 2:
                 raise CompileError("wrong number of arguments", node)
@@ -358,6 +732,7 @@ class Compiler:
 
             if self.definitions_mode:
                 self.directives["namespace"] = node[1].value + "::"
+                self.update_prefixes()
         
         elif node[0].value == "@using":
             if len(node) != 2:
@@ -367,33 +742,32 @@ class Compiler:
                 raise CompileError("namespace name must be word", node)
 
             self.directives["using"].append(node[1].value + "::")
+            self.update_prefixes()
 
         elif node[0].value == "import":
             if len(node) != 2:
                 raise CompileError("wrong number of arguments", node)
                 
-            if node[1].type != "list":
+            path = literal_string(node[1])
+            if path == None:
                 raise CompileError("file name must be string or list of bytes", node)
 
             if self.definitions_mode:
                 return
 
-            path = "".join([chr(val.value) for val in node[1].value[:-1]])
-            with open(path, "r") as f:
-                code = f.read()
-                compiler = Compiler(definitions_mode=True, import_mode=True)
+            self.imports.append(path)
 
-                old_path = self.path
-                self.path = path
-                compiler.compile(parse(code))
-                self.path = old_path
+            old_path = self.path
+            self.path = path
+            compiler = self.import_definitions(path)
+            self.path = old_path
 
-                self.funcs = {**self.funcs, **compiler.funcs}
-                self.structs = {**self.structs, **compiler.structs}
-                self.vars[0] = {**self.vars[0], **compiler.vars[0]}
+            self.funcs.update(compiler.funcs)
+            self.structs.update(compiler.structs)
+            self.vars.globals.update(compiler.vars.globals)
 
-                for symbol in {**compiler.funcs, **compiler.vars[0]}.keys():
-                    self.code += f".import #{symbol}\n"
+            for symbol in {**compiler.funcs, **compiler.vars.globals}.keys():
+                self.code += f".import #{symbol}\n"
         
         elif node[0].value == "import-defs":
             if len(node) == 1:
@@ -449,30 +823,51 @@ class Compiler:
                         "node": node,
                         "type": node[1].value,
                         "args": [arg[0].value for arg in node[3]],
+                        "path": self.path,
+                        "namespace": self.directives["namespace"],
                     }
 
                 self.directives["private"] = False
 
             else:
                 self.sp_offset = 0
-                self.vars.append({})
+                self.function = fn_name
+                self.cold = ""
+                self.vars.push()
+
+                # With --lto, internal functions get their first argument in $1 and push it as
+                # their first local
+                label = fn_name
+                if self.program != None:
+                    label = self.program.register_name(fn_name, len(node[3]))
+                register = label != fn_name
 
                 arg_offset = 8
-                for arg in node[3]:
-                    self.vars[-1][arg[1].value] = {
+                for i, arg in enumerate(node[3]):
+                    self.vars.declare(arg[1].value, {
                         "global": False, 
-                        "offset": arg_offset,
+                        "offset": -4 if register and i == 0 else arg_offset,
                         "node": arg,
                         "type": arg[0].value,
                         "length": 1,
-                    }
-                    arg_offset += 4
-
-                self.code += f".export #{fn_name}\n#{fn_name}:\npush $12\nmov $15 $12\n"
-                for expr in node[4:]:
-                    self.generate_expression(expr, statement=True, r=r)
-                self.code += "mov $12 $15\npop $12\nret\n"
-
+                    })
+                    if not register or i > 0:
+                        arg_offset += 4
+
+                self.code += f".export #{label}\n#{label}:\n"
+                if self.func_directives:
+                    self.code += f".func #{label}\n"
+                self.code += backend.PROLOGUE
+                if register:
+                    self.code += "push $1\n"
+                    self.sp_offset = -4
+                self.generate_statements(node[4:], r)
+                self.code += backend.EPILOGUE
+                self.code += self.cold
+                if self.func_directives:
+                    self.code += ".endfunc\n"
+
+                self.cold = ""
                 self.vars.pop()
 
         elif node[0].value == "struct":
@@ -486,7 +881,6 @@ class Compiler:
 
             if self.definitions_mode:
                 fields = []
-                size = 0
 
                 for field in node[2:]:
                     if len(field) != 2:
@@ -502,16 +896,22 @@ class Compiler:
                         raise CompileError("cannot define struct field twice", node)
 
                     fields.append({"name": field[1].value, "type": field[0].value})
-                    size += TYPE_SIZES[field[0].value]
+
+                aligned = self.directives["aligned"]
+                offsets, size = struct_layout(fields, aligned)
 
                 if not self.directives["private"]:
                     self.structs[struct_name] = {
                         "node": node,
                         "fields": fields,
+                        "offsets": offsets,
                         "size": size,
+                        "aligned": aligned,
+                        "path": self.path,
                     }
 
                 self.directives["private"] = False
+                self.directives["aligned"] = False
         
         elif node[0].value == "enum":
             if len(node) <= 3:
@@ -552,6 +952,7 @@ class Compiler:
                             "type": node[1].value,
                             "length": 1,
                         }
+                    self.define_constant(enum_name + "::" + element_name, node[1].value, element_value)
                     
                     element_value += 1
 
@@ -578,17 +979,36 @@ class Compiler:
             if not statement:
                 raise CompileError("while loop cannot be used in expression", node)
 
-            self.vars.append({})
+            # Loops that usually run more than once are rotated, so each iteration only runs one jump
+            tests = self.count(node[1])
+            iterations = self.count(node[2]) if len(node) > 2 else None
+            rotate = tests != None and iterations != None and iterations > tests - iterations
 
-            self.code += f"#__while_{node.id}:\n"
+            code = self.code
+            self.code = ""
+            self.mark(node[1])
             self.generate_expression(node[1], r=r)
-            self.code += f"jf #__while_{node.id}_end\n"
-            for expr in node[2:]:
-                self.generate_expression(expr, statement=True, r=r)
+            condition = self.code
+            self.code = code
+            # Keeping the old code alive while the body is generated adds up to a copy per nesting level
+            del code
+
+            self.vars.push()
+
+            if rotate:
+                self.code += f"j #__while_{node.id}\n#__while_{node.id}_body:\n"
+            else:
+                self.code += f"#__while_{node.id}:\n{condition}jf #__while_{node.id}_end\n"
+            if len(node) > 2:
+                self.mark(node[2])
+            self.generate_statements(node[2:], r)
             for _ in self.vars[-1]:
                 self.code += "pop $0\n"
                 self.sp_offset += 4
-            self.code += f"j #__while_{node.id}\n#__while_{node.id}_end:\n"
+            if rotate:
+                self.code += f"#__while_{node.id}:\n{condition}jt #__while_{node.id}_body\n#__while_{node.id}_end:\n"
+            else:
+                self.code += f"j #__while_{node.id}\n#__while_{node.id}_end:\n"
 
             self.vars.pop()
         
@@ -603,20 +1023,35 @@ class Compiler:
                 if len(block) == 0:
                     raise CompileError("cond branch cannot be empty", node)
 
+                self.mark(block[0])
                 self.generate_expression(block[0], r=r)
-                self.code += f"jf #__cond_{node.id}_{i}\n"
 
-                self.vars.append({})
+                # Branches that are rarely taken are moved after the end of the function
+                tests = self.count(block[0])
+                taken = self.count(block[1])
+                cold = self.function != None and tests and taken != None and taken < tests * pgo.COLD_RATIO
+                if cold:
+                    self.code += f"jt #__cond_{node.id}_{i}_cold\n"
+                    code = self.code
+                    self.code = f"#__cond_{node.id}_{i}_cold:\n"
+                else:
+                    self.code += f"jf #__cond_{node.id}_{i}\n"
+
+                self.vars.push()
 
-                for expr in block[1]:
-                    self.generate_expression(expr, statement=True, r=r)
+                self.mark(block[1])
+                self.generate_statements(block[1], r)
                 for _ in self.vars[-1]:
                     self.code += "pop $0\n"
                     self.sp_offset += 4
 
                 self.vars.pop()
 
-                self.code += f"j #__cond_{node.id}_end\n#__cond_{node.id}_{i}:\n"
+                self.code += f"j #__cond_{node.id}_end\n"
+                if cold:
+                    self.cold += self.code
+                    self.code = code
+                self.code += f"#__cond_{node.id}_{i}:\n"
             self.code += f"#__cond_{node.id}_end:\n"
 
         elif node[0].value == "switch":
@@ -626,9 +1061,17 @@ class Compiler:
             if not statement:
                 raise CompileError("switch statement cannot be used in expression", node)
 
+            blocks = list(chunks(node[2:], 2))
+            # Cases with different integer values can be tested in any order, so the ones that matched
+            # the most are tested first
+            keys = [block[0].value for block in blocks if block[0].type == "int"]
+            counts = [self.count(block[1]) for block in blocks if len(block) == 2]
+            if len(keys) == len(blocks) and len(set(keys)) == len(keys) and None not in counts and len(counts) == len(blocks):
+                blocks.sort(key=lambda block: -self.count(block[1]))
+
             self.generate_expression(node[1], r=r)
             self.code += f"mov ${r} ${r+1}\n"
-            for i, block in enumerate(chunks(node[2:], 2)):
+            for i, block in enumerate(blocks):
                 if len(block) == 0:
                     raise CompileError("switch branch cannot be empty", node)
 
@@ -636,10 +1079,11 @@ class Compiler:
                 self.generate_expression(block[0], r=r)
                 self.code += f"pop ${r+1}\nceq ${r} ${r+1}\njf #__switch_{node.id}_{i}\n"
 
-                self.vars.append({})
+                self.vars.push()
+
+                self.mark(block[1])
 
-                for expr in block[1]:
-                    self.generate_expression(expr, statement=True, r=r)
+                self.generate_statements(block[1], r)
                 for _ in self.vars[-1]:
                     self.code += "pop $0\n"
                     self.sp_offset += 4
@@ -661,7 +1105,7 @@ class Compiler:
 
             var_name = self.directives["namespace"] + node[2].value
 
-            if len(node) == 4 and node[3].type not in ("int", "list"):
+            if len(node) == 4 and node[3].type not in ("int", "list", "bytes"):
                 raise CompileError("static variable must be integer or array of integers", node)
 
             if self.definitions_mode:
@@ -673,12 +1117,16 @@ class Compiler:
                         "global": True,
                         "node": node,
                         "type": node[1].value,
-                        "length": len(node[3]) if len(node) == 4 and node[3].type == "list" else 1,
+                        "length": len(node[3]) if len(node) == 4 and node[3].type in ("list", "bytes") else 1,
                     }
 
+                if len(node) == 3 or node[3].type == "int":
+                    self.define_constant(var_name, node[1].value, node[3].value if len(node) == 4 else 0)
+
                 self.directives["private"] = False
 
             else:
+                self.code += align_directive(node[1].value)
                 if len(node) == 3:
                     self.code += f".export #{var_name}\n#{var_name}:\n.{TYPE_DIRECTIVES[node[1].value]} 0\n"
 
@@ -691,13 +1139,11 @@ class Compiler:
                             self.code += f"{node[3]}\n"
 
                     else:
-                        self.code += f".export #{var_name}\n#{var_name}:\n" 
-
-                        for expr in node[3]:
-                            if expr.type != "int":
-                                raise CompileError("array element must be integer literal", node)
+                        values = literal_values(node[3])
+                        if values == None:
+                            raise CompileError("array element must be integer literal", node)
 
-                            self.code += f".{TYPE_DIRECTIVES[node[1].value]} {expr}\n"
+                        self.code += f".export #{var_name}\n#{var_name}:\n{data_directive(node[1].value, values)}\n"
         
         elif node[0].value == "local":
             if len(node) not in (4, 3):
@@ -724,13 +1170,13 @@ class Compiler:
             self.code += f"push ${r}\n"
 
             self.sp_offset -= 4
-            self.vars[-1][node[2].value] = {
+            self.vars.declare(node[2].value, {
                 "global": False, 
                 "offset": self.sp_offset,
                 "node": node,
                 "type": node[1].value,
                 "length": 1,
-            }
+            })
         
         elif node[0].value == "return":
             if len(node) > 2:
@@ -743,7 +1189,10 @@ class Compiler:
                 self.generate_expression(node[1], r=r)
                 if r != 1:
                     self.code += f"mov ${r} $1\n"
-            self.code += "mov $12 $15\npop $12\nret\n"
+            if self.inline_end != None:
+                self.code += f"j #{self.inline_end}\n"
+            else:
+                self.code += backend.EPILOGUE
         
         elif node[0].value in ("+", "-", "*", "/", "%", "<", ">", ">=", "<=", "==", "!=", "&", "|", "<<", ">>"):
             if len(node) != 3:
@@ -754,24 +1203,7 @@ class Compiler:
             type_l = self.generate_expression(node[1], r=r)
             self.code += f"pop ${r+1}\n"
 
-            self.code += {
-                "+": f"add ${r+1} ${r}\n",
-                "-": f"sub ${r+1} ${r}\n",
-                "*": f"mul ${r+1} ${r}\nmov $13 ${r}\n",
-                "/": f"div ${r+1} ${r}\nmov $14 ${r}\n",
-                "%": f"div ${r+1} ${r}\nmov $13 ${r}\n",
-                # TODO: clt and cgt don't work for signed ints
-                "<": f"clt ${r} ${r+1}\n",
-                ">": f"cgt ${r} ${r+1}\n",
-                "<=": f"cltq ${r} ${r+1}\n",
-                ">=": f"cgtq ${r} ${r+1}\n",
-                "==": f"ceq ${r} ${r+1}\n",
-                "!=": f"cnq ${r} ${r+1}\n",
-                "&": f"and ${r+1} ${r}\n",
-                "|": f"or ${r+1} ${r}\n",
-                "<<": f"shl ${r+1} ${r}\n",
-                ">>": f"shr ${r+1} ${r}\n",
-            }[node[0].value]
+            self.code += backend.binary(node[0].value, r, r+1)
             
             return self.merge_types(type_l, type_r, node)
         
@@ -785,6 +1217,7 @@ class Compiler:
             if node[1].type != "word":
                 raise CompileError("first argument must be variable name", node)
 
+            self.mark_written(node[1])
             type_l = self.generate_expression(node[1], r=r)
             self.code += f"push ${r+1}\n"
             type_r = self.generate_expression(node[2], r=r)
@@ -845,26 +1278,15 @@ class Compiler:
 
             [struct_name, struct_field] = node[1].value.split(".")
 
-            struct, struct_name = self.get_entry(self.structs, struct_name)
+            struct, struct_name = self.structs.resolve(struct_name)
             if struct == None:
                 raise CompileError("undefined struct", node)
 
-            struct = self.structs[struct_name]
-            offset = 0
-            found = False
-            type = None
-
-            for field in struct["fields"]:
-                if field["name"] == struct_field:
-                    found = True
-                    type = field["type"]
-                    break
-
-                offset += TYPE_SIZES[field["type"]]
-
-            if not found:
+            if struct_field not in struct["offsets"]:
                 raise CompileError("undefined struct field", node)
 
+            offset, type = struct["offsets"][struct_field]
+
             if node[0].value == "get":
                 self.generate_expression(node[2], r=r)
                 self.code += f"mov ${r} ${r+1}\n"
@@ -912,6 +1334,7 @@ class Compiler:
             if len(node) != 2:
                 raise CompileError("wrong number of arguments", node)
 
+            self.mark_written(node[1])
             self.generate_expression(node[1], r=r)
             self.code += f"mov ${r+1} ${r}\n"
 
@@ -940,6 +1363,7 @@ class Compiler:
             if node[1].type != "word":
                 raise CompileError("first argument must be variable name", node)
 
+            self.mark_written(node[1])
             type_l = self.generate_expression(node[1], r=r)
             self.code += f"push ${r+1}\n"
             type_r = self.generate_expression(node[2], r=r)
@@ -985,7 +1409,7 @@ class Compiler:
             if node[1].type != "word":
                 raise CompileError("first argument must be variable name", node)
 
-            var, var_name = self.get_entry(self.vars[0], node[1].value)
+            var, var_name = self.vars.globals.resolve(node[1].value)
 
             if var == None:
                 raise CompileError("undefined static variable", node)
@@ -999,11 +1423,17 @@ class Compiler:
                 raise CompileError("wrong number of arguments", node)
             
             if not self.definitions_mode:
+                # Markers keep the peephole optimizer from touching inline assembly
+                self.code += peephole.ASM_BEGIN + "\n"
                 for arg in node[1:]:
-                    if arg.type != "list" or set([val.type for val in arg.value]) != set(["int"]):
+                    code = literal_string(arg)
+                    if code == None:
                         raise CompileError("inline assembly must be string or list of bytes", arg)
 
-                    self.code += "".join([chr(val.value) for val in arg.value[:-1]]) + "\n"
+                    self.code += code + "\n"
+                    if self.program != None and self.program.analyzing:
+                        self.program.escaping.update(lto.SYMBOL.findall(lto.IGNORED.sub("", code)))
+                self.code += peephole.ASM_END + "\n"
 
         elif node[0].value == "data": # TODO: return address to data instead?
             if len(node) != 3:
@@ -1013,18 +1443,46 @@ class Compiler:
                 raise CompileError("first argument must be type", node)
             
             if node[2].type == "int":
-                self.code = f"#__data_{node.id}:\n.{TYPE_DIRECTIVES[node[1].value]} {node[2]}\n" + self.code
-            elif node[2].type == "list" and set([val.type for val in node[2].value]) == set(["int"]):
-                code = "\n".join([f".{TYPE_DIRECTIVES[node[1].value]} {i}" for i in node[2].value])
-                self.code = f"#__data_{node.id}:\n{code}\n" + self.code
+                self.data.append(f"{align_directive(node[1].value)}#__data_{node.id}:\n.{TYPE_DIRECTIVES[node[1].value]} {node[2]}\n")
+            elif literal_values(node[2]) != None:
+                self.data.append(f"{align_directive(node[1].value)}#__data_{node.id}:\n{data_directive(node[1].value, literal_values(node[2]))}\n")
             else:
                 raise CompileError("invalid data type", node)
             self.code += f"mov #__data_{node.id} ${r+1}\nld{TYPE_DIRECTIVES[node[1].value][0]} ${r+1} ${r}\n"
 
             return node[1].value
 
+        elif node[0].value == "const":
+            if len(node) != 3:
+                raise CompileError("wrong number of arguments", node)
+
+            if node[1].value not in TYPES or node[1].value == "void":
+                raise CompileError("first argument must be type", node)
+
+            if node[2].type == "int":
+                values = [node[2].value]
+            else:
+                values = literal_values(node[2])
+                if values == None:
+                    raise CompileError("invalid data type", node)
+
+            data = pack_values(node[1].value, values)
+            if data == None:
+                raise CompileError("value out of range for type", node)
+
+            # Constants are named after their contents, so the assembler can merge identical
+            # constants from every module into a single copy
+            symbol = f"__const_{hashlib.sha1(data).hexdigest()[:16]}"
+            if symbol not in self.constants:
+                self.constants.add(symbol)
+                alignment = f" .align {TYPE_SIZES[node[1].value]}" if TYPE_SIZES[node[1].value] > 1 else ""
+                self.code += f".rodata #{symbol}{alignment} .byte x\"{data.hex()}\"\n"
+            self.code += f"mov #{symbol} ${r+1}\nld{TYPE_DIRECTIVES[node[1].value][0]} ${r+1} ${r}\n"
+
+            return node[1].value
+
         else:
-            func, func_name = self.get_entry(self.funcs, node[0].value)
+            func, func_name = self.funcs.resolve(node[0].value)
 
             if func == None:
                 raise CompileError("undefined function", node)
@@ -1032,46 +1490,186 @@ class Compiler:
             if len(node) - 1 != len(func["args"]):
                 raise CompileError("wrong number of arguments", node)
 
-            for (arg, param) in zip(reversed(node[1:]), reversed(func["args"])):
+            self.mark(node)
+            if self.program != None and self.program.analyzing:
+                self.program.calls[func_name] = self.program.calls.get(func_name, 0) + 1
+
+            inline = self.inlinable(func, func_name, node)
+            label = func_name
+            if not inline and self.program != None:
+                label = self.program.register_name(func_name, len(func["args"]))
+            args = list(zip(node[1:], func["args"]))
+            pushed = args[1:] if label != func_name else args
+            for (arg, param) in reversed(pushed):
                 type = self.generate_expression(arg, r=r)
                 self.merge_types(type, param, arg)
                 self.code += f"push ${r}\n"
-            self.code += f"call #{func_name}\n"
+            if label != func_name:
+                type = self.generate_expression(args[0][0], r=r)
+                self.merge_types(type, args[0][1], args[0][0])
+                if r != 1:
+                    self.code += f"mov ${r} $1\n"
+
+            if inline:
+                self.generate_inline(func, r)
+            else:
+                self.code += f"call #{label}\n"
             if r != 1:
                 self.code += f"mov $1 ${r}\n"
-            for _ in node[1:]:
+            for _ in pushed:
                 self.code += "pop $0\n"
             
             return func["type"]
 
-@click.command()
-@click.argument("files", type=click.Path(exists=True), required=True, nargs=-1)
-@click.option("--comment", is_flag=True, default=False, help="Adds comment lines to the generated assembly code")
-@click.option("--type-checking", default="loose", help="Type checking mode [strict/loose/off]")
-def run(files, comment, type_checking):
-    for file in files:
-        compiler = Compiler(comment=comment, type_checking=type_checking)
+def compile_file(file, comment=False, type_checking="loose", import_cache=None, debug=False, func_directives=False, profile=None, timings=None, program=None):
+    compiler = Compiler(comment=comment, type_checking=type_checking, import_cache=import_cache, debug=debug, func_directives=func_directives, profile=profile, timings=timings, program=program)
 
+    with compiler.timings.phase("parse"):
         with open(file, "r") as f:
             code = f.read()
             ast = parse(code)
+    if compiler.timings.enabled:
+        compiler.timings.count("nodes parsed", ast.size())
+
+    compiler.path = file
+    compiler.source_code = code
+
+    try:
+        compiler.compile(ast)
+    except CompileError as e:
+        # Imports temporarily change the compiler path, so keep the file the error happened in
+        e.path = compiler.path
+        raise
+
+    return compiler
+
+def compile_program(files, keep=("main",), comment=False, type_checking="loose", debug=False, func_directives=False, profile=None, timings=None):
+    # Compiles the files as one program (--lto). They are compiled once to find what the modules do
+    # with each other's symbols and again with it, then the top-level items nothing refers to are
+    # left out. Returns file -> compiler and the kept symbols that aren't defined
+    timings = timings if timings != None else NO_TIMINGS
+    program = lto.Program(keep)
+    import_cache = {}
+    for analyzing in (True, False):
+        program.analyzing = analyzing
+        compilers = {}
+        for file in files:
+            compiler = compile_file(file, comment=comment, type_checking=type_checking, import_cache=import_cache, debug=debug, func_directives=func_directives, profile=profile, timings=timings, program=program)
+            compilers[file] = program.modules[os.path.realpath(file)] = compiler
+
+    items = [item for compiler in compilers.values() for item in compiler.items()]
+    with timings.phase("lto removal"):
+        missing = program.reach(items)
+        for compiler in compilers.values():
+            compiler.join(program.used)
+    timings.count("lto constant statics", len(program.statics.keys() - program.written - program.escaping))
+    timings.count("lto items removed", len(program.dead))
+    return compilers, missing
+
+def layout_report(structs, path):
+    # Offsets and padding of the structs defined in a file, with the size of the other layout and
+    # the fields a packed struct leaves misaligned
+    lines = []
+    for name, struct in structs.items():
+        if struct.get("path") != path:
+            continue
+        packed_size = struct_layout(struct["fields"])[1]
+        aligned_size = struct_layout(struct["fields"], aligned=True)[1]
+        padding = struct["size"] - packed_size
+        if struct["aligned"]:
+            lines.append(f"struct {name}: {struct['size']} bytes, aligned, padding: {padding} (packed: {packed_size} bytes)")
+        else:
+            lines.append(f"struct {name}: {struct['size']} bytes, packed (aligned: {aligned_size} bytes, padding: {aligned_size - packed_size})")
+        lines.append(f"  {'offset':>6} {'size':>4} {'padding':>7}  field")
+        end = 0
+        for field in struct["fields"]:
+            offset, type = struct["offsets"][field["name"]]
+            size = TYPE_SIZES[type]
+            note = "  misaligned" if offset % size != 0 else ""
+            lines.append(f"  {offset:>6} {size:>4} {offset - end:>7}  {type} {field['name']}{note}")
+            end = offset + size
+        if struct["size"] != end:
+            lines.append(f"  {end:>6} {0:>4} {struct['size'] - end:>7}  (end)")
+    return "\n".join(lines)
+
+def format_error(e):
+    message = f"ERROR: {e.message} ({e.path}:{e.node.line}:{e.node.col})\n"
+
+    with open(e.path, "r") as f:
+        message += f.readlines()[e.node.line - 1][:-1] + "\n"
+        message += " " * (e.node.col - 1) + "^"
+
+    return message
+
+@click.command()
+@click.argument("files", type=click.Path(exists=True), required=True, nargs=-1)
+@click.option("--comment", is_flag=True, default=False, help="Adds comment lines to the generated assembly code")
+@click.option("--type-checking", default="loose", help="Type checking mode [strict/loose/off]")
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Runs the optimizer of backend.py on the generated assembly code")
+@click.option("--peephole-rules", default=None, help="Comma separated list of peephole rules to run (default: all)")
+@click.option("--passes", default=None, help="Comma separated list of backend passes to run (default: all)")
+@click.option("--peephole-stats", is_flag=True, default=False, help="Prints how many times each pass and peephole rule changed the code")
+@click.option("--debug", "-g", is_flag=True, default=False, help="Adds .loc and .func directives used by the assembler to generate debug info")
+@click.option("--func-directives", is_flag=True, default=False, help="Adds only the .func directives, for assembler.py --icf and --map (implied by --debug)")
+@click.option("--profile", type=click.Path(exists=True), default=None, help="Uses a profile written by profiler.py --pgo to lay out and inline code")
+@click.option("--layout", is_flag=True, default=False, help="Prints the offsets and padding of the structs defined in each file")
+@click.option("--timings", "show_timings", is_flag=True, default=False, help="Prints the time spent in each phase and counters of the work done")
+@click.option("--timings-json", type=click.Path(), default=None, help="Writes the timings and counters to a JSON file")
+@click.option("--lto", "whole_program", is_flag=True, default=False, help="Compiles the files as one program, optimizing across modules and removing unused code")
+@click.option("--keep", multiple=True, default=["main"], help="Symbol used from outside the KL files with --lto, can be repeated (default: main)")
+def run(files, comment, type_checking, optimize, peephole_rules, passes, peephole_stats, debug, func_directives, profile, layout, show_timings, timings_json, whole_program, keep):
+    timings = Timings(enabled=show_timings or timings_json != None)
+    optimizer = None
+    if optimize:
+        optimizer = backend.Optimizer(backend.parse_passes(passes, None), peephole.parse_rules(peephole_rules, None))
+
+    if profile != None:
+        try:
+            profile = pgo.Profile.load(profile)
+        except (ValueError, KeyError) as e:
+            click.echo(f"ERROR: invalid profile: {e}", err=True)
+            exit(1)
 
-        compiler.path = file
-        compiler.source_code = code
+    if whole_program:
+        try:
+            compilers, missing = compile_program(files, keep, comment=comment, type_checking=type_checking, debug=debug, func_directives=func_directives, profile=profile, timings=timings)
+        except CompileError as e:
+            click.echo(format_error(e), err=True)
+            exit(1)
+        if missing:
+            click.echo(f"ERROR: kept symbols aren't defined: {', '.join(missing)}", err=True)
+            exit(1)
 
+    for file in files:
         try:
-            compiler.compile(ast)
+            if whole_program:
+                compiler = compilers[file]
+            else:
+                compiler = compile_file(file, comment=comment, type_checking=type_checking, debug=debug, func_directives=func_directives, profile=profile, timings=timings)
         except CompileError as e:
-            click.echo(f"ERROR: {e.message} ({compiler.path}:{e.node.line}:{e.node.col})", err=True)
+            click.echo(format_error(e), err=True)
+            exit(1)
 
-            with open(compiler.path, "r") as f:
-                click.echo(f.readlines()[e.node.line - 1][:-1], err=True)
-                click.echo(" " * (e.node.col - 1) + "^", err=True)
+        if layout:
+            report = layout_report(compiler.structs, compiler.path)
+            if report:
+                click.echo(report)
 
-            exit(1)
+        code = compiler.code
+        if optimizer != None:
+            with timings.phase("optimize"):
+                code = optimizer.optimize(code)
+        timings.count("files")
+        timings.count("assembly lines", code.count("\n"))
+
+        with timings.phase("write"):
+            with open(file + ".out", "w") as f:
+                f.write(code)
+
+    if optimizer != None and peephole_stats:
+        click.echo(optimizer.report(), err=True)
 
-        with open(file + ".out", "w") as f:
-            f.write(compiler.code)
+    finish(timings, "kl.py", show_timings, timings_json)
 
 if __name__ == "__main__":
-    run(None, None, None)
\ No newline at end of file
+    run()
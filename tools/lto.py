@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import re
+
+# Names in assembly code, same characters as WORD in grammar.lark
+WORD = r"[a-zA-Z_\-](?:[\w\-\.:]*[\w\-\.])?"
+SYMBOL = re.compile(rf"#({WORD})")
+DEFINITION = re.compile(rf"^[ \t]*(?:#({WORD}):|\.rodata[ \t]+#({WORD}))", re.M)
+EXPORT = re.compile(rf"^\.export[ \t]+#({WORD})", re.M)
+# Comments and imports don't refer to anything the code needs
+IGNORED = re.compile(r";.*$|^\.import.*$", re.M)
+
+# Leaf functions with at most this many nodes are inlined at every call without a profile. Functions
+# called once are inlined up to pgo.INLINE_MAX_NODES, since their own copy is removed afterwards
+INLINE_MAX_NODES = 8
+
+# Added to the name of functions taking their first argument in $1, so assembly written for the
+# usual convention can't call them by mistake
+REGISTER_SUFFIX = ".r1"
+
+class Program:
+    # What the modules of a program do with each other's symbols, for `kl.py --lto`. Every module
+    # is compiled once while `analyzing` to collect it, and again using it
+    def __init__(self, keep=("main",)):
+        self.keep = set(keep) # Symbols used from outside the KL code, like `main` by init.asm
+        self.analyzing = True
+        self.modules = {} # Real path -> last compiler of each module, for cross-module inlining
+        self.statics = {} # Static or enum element -> value, for the scalar ones defined in the program
+        self.written = set() # Statics written or whose address is taken
+        self.calls = {} # Function -> amount of calls in KL code
+        self.escaping = set(self.keep) # Symbols named in inline assembly or kept
+        self.dead = set() # (path, code) of the top-level items nothing live refers to
+
+    def constant(self, name):
+        # Value to use instead of loading a static, None when it can change or isn't known
+        if self.analyzing or name in self.written or name in self.escaping:
+            return None
+        return self.statics.get(name)
+
+    def internal(self, name):
+        # Functions only called directly from KL code, which can be changed with their callers
+        return not self.analyzing and name not in self.escaping and self.calls.get(name, 0) > 0
+
+    def register_name(self, name, arity):
+        # Label of a function, with REGISTER_SUFFIX when it takes its first argument in $1
+        if arity > 0 and self.internal(name):
+            return name + REGISTER_SUFFIX
+        return name
+
+    def reach(self, items):
+        # Finds the top-level items (path, code, root) nothing refers to starting from the roots, the
+        # kept symbols and the items that define nothing. Returns the kept symbols that aren't defined
+        items = list(items)
+        local = {} # (path, label) -> item
+        exported = {} # Symbol -> item
+        defines = [False] * len(items)
+        for i, (path, code, _) in enumerate(items):
+            for match in DEFINITION.finditer(code):
+                local[(path, match.group(1) or match.group(2))] = i
+                defines[i] = True
+            for name in EXPORT.findall(code):
+                exported[name] = i
+
+        stack = [i for i, (_, _, root) in enumerate(items) if root or not defines[i]]
+        stack += [exported[name] for name in self.keep if name in exported]
+        live = set(stack)
+        while stack:
+            path, code, _ = items[stack.pop()]
+            for name in SYMBOL.findall(IGNORED.sub("", code)):
+                i = local.get((path, name), exported.get(name))
+                if i != None and i not in live:
+                    live.add(i)
+                    stack.append(i)
+
+        self.dead = {(path, code) for i, (path, code, _) in enumerate(items) if i not in live}
+        return sorted(self.keep - exported.keys())
+
+    def used(self, path, code):
+        return (path, code) not in self.dead
+
+def imports(code):
+    # .import lines for the symbols code refers to without defining or importing them, like the
+    # statics of another module in an inlined function
+    defined = {match.group(1) or match.group(2) for match in DEFINITION.finditer(code)}
+    defined |= set(re.findall(rf"^\.import[ \t]+#({WORD})", code, re.M))
+    missing = sorted(set(SYMBOL.findall(IGNORED.sub("", code))) - defined)
+    return "".join(f".import #{name}\n" for name in missing)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import click
+
+# Minimum amount of consecutive `pop $0` to replace with a single `add`, fewer pops are smaller
+MIN_POPS = 3
+
+# Lines between these comments are never modified, used for inline assembly in KL
+ASM_BEGIN = "; begin asm"
+ASM_END = "; end asm"
+
+# Directives that don't generate any bytes where they are placed
+SILENT_DIRECTIVES = (".export", ".import", ".define", ".rodata", ".loc", ".func", ".endfunc")
+
+class Line:
+    def __init__(self, text, asm=False):
+        self.text = text
+        self.deleted = False
+        self.op = None
+        self.args = []
+
+        stripped = text.strip()
+        if asm:
+            self.kind = "asm"
+        elif stripped == "" or stripped[0] == ";":
+            self.kind = "comment"
+        elif stripped[0] == "#" and stripped.endswith(":"):
+            self.kind = "label"
+            self.op = stripped[:-1]
+        elif stripped[0] == ".":
+            self.kind = "silent" if stripped.startswith(SILENT_DIRECTIVES) else "data"
+        else:
+            self.kind = "instruction"
+            [self.op, *self.args] = stripped.split(";")[0].split()
+
+    def __repr__(self):
+        return f"Line({repr(self.text)})"
+
+    def replace(self, op, *args):
+        self.op = op
+        self.args = list(args)
+        self.text = " ".join([op, *args])
+
+    def delete(self):
+        self.deleted = True
+
+    def is_instruction(self, op, *args):
+        # Arguments set to None match any argument
+        return (self.kind == "instruction" and self.op == op and len(self.args) == len(args)
+            and all(arg == None or arg == own for own, arg in zip(self.args, args)))
+
+def is_register(arg):
+    return arg[0] == "$"
+
+def overwrites(line, register):
+    # Checks if an instruction sets a register without reading its old value
+    if line.kind != "instruction" or register == "$15":
+        return False
+    if line.op == "mov" and len(line.args) == 2:
+        return line.args[1] == register and line.args[0] != register
+    if line.op in ("ldb", "ldw", "ldd"):
+        return line.args[1] == register and line.args[0] != register
+    if line.op == "pop":
+        return line.args[0] == register
+    return False
+
+def registers(line):
+    # Registers read and written by a mov or load, None for any other instruction
+    if line.kind != "instruction" or len(line.args) != 2:
+        return None
+    if line.op == "mov":
+        return ([line.args[0]] if is_register(line.args[0]) else [], [line.args[1]])
+    if line.op in ("ldb", "ldw", "ldd") and is_register(line.args[0]):
+        return ([line.args[0]], [line.args[1]])
+    return None
+
+# Rules look at the line at index `i` of the window, followed by the next lines that aren't
+# deleted, and return True if they modified any line
+
+def following(window, i, amount):
+    # Next instructions after `i`, stopping at the first label, data or inline assembly line
+    lines = []
+    for j in range(i + 1, len(window)):
+        line = window[j]
+        if len(lines) == amount:
+            break
+        if line.deleted:
+            continue
+        if line.kind != "instruction":
+            break
+        lines.append(line)
+    return lines
+
+def rule_push_pop(window, i):
+    # push $a / pop $b -> mov $a $b
+    line = window[i]
+    if not line.is_instruction("push", None):
+        return False
+    next = following(window, i, 1)
+    if len(next) != 1 or not next[0].is_instruction("pop", None):
+        return False
+    source, dest = line.args[0], next[0].args[0]
+    if "$15" in (source, dest):
+        return False
+    if source == dest:
+        line.delete()
+    else:
+        line.replace("mov", source, dest)
+    next[0].delete()
+    return True
+
+def rule_push_mov_pop(window, i):
+    # push $a / mov x $c / pop $b -> mov $a $b / mov x $c, if the middle instruction doesn't use $b
+    line = window[i]
+    if not line.is_instruction("push", None):
+        return False
+    next = following(window, i, 2)
+    if len(next) != 2 or not next[1].is_instruction("pop", None):
+        return False
+    source, dest = line.args[0], next[1].args[0]
+    used = registers(next[0])
+    if used == None or "$15" in (source, dest, *used[0], *used[1]) or dest in used[0] + used[1]:
+        return False
+    line.replace("mov", source, dest)
+    next[1].delete()
+    return True
+
+def rule_self_mov(window, i):
+    # mov $a $a -> (nothing)
+    line = window[i]
+    if line.is_instruction("mov", None, None) and line.args[0] == line.args[1] and is_register(line.args[0]):
+        line.delete()
+        return True
+    return False
+
+def rule_dead_mov(window, i):
+    # mov x $a / <instruction that overwrites $a> -> <instruction>
+    line = window[i]
+    if not line.is_instruction("mov", None, None) or line.args[1] == "$15":
+        return False
+    next = following(window, i, 1)
+    if len(next) == 1 and overwrites(next[0], line.args[1]):
+        line.delete()
+        return True
+    return False
+
+def rule_mov_back(window, i):
+    # mov $a $b / mov $b $a -> mov $a $b
+    line = window[i]
+    if not line.is_instruction("mov", None, None) or not is_register(line.args[0]):
+        return False
+    next = following(window, i, 1)
+    if len(next) == 1 and next[0].is_instruction("mov", line.args[1], line.args[0]):
+        next[0].delete()
+        return True
+    return False
+
+def rule_identity(window, i):
+    # add 0 $a, sub 0 $a, add $0 $a... -> (nothing)
+    line = window[i]
+    if line.kind == "instruction" and line.op in ("add", "sub", "or", "xor", "shl", "shr") and len(line.args) == 2:
+        if line.args[0] in ("0", "0x0", "$0"):
+            line.delete()
+            return True
+    return False
+
+def rule_jump_next(window, i):
+    # j #label / #label: -> #label:
+    line = window[i]
+    if line.kind != "instruction" or line.op not in ("j", "jt", "jf") or line.args[0][0] != "#":
+        return False
+    for j in range(i + 1, len(window)):
+        next = window[j]
+        if next.deleted:
+            continue
+        if next.kind != "label":
+            return False
+        if next.op == line.args[0]:
+            line.delete()
+            return True
+    return False
+
+def rule_pop_chain(window, i):
+    # pop $0 / pop $0 / pop $0 -> add 12 $15
+    line = window[i]
+    if not line.is_instruction("pop", "$0"):
+        return False
+    # Only the start of the chain is rewritten
+    for j in range(i - 1, -1, -1):
+        previous = window[j]
+        if not previous.deleted:
+            if previous.is_instruction("pop", "$0"):
+                return False
+            break
+    pops = [line]
+    for next in following(window, i, len(window)):
+        if not next.is_instruction("pop", "$0"):
+            break
+        pops.append(next)
+    if len(pops) < MIN_POPS:
+        return False
+    line.replace("add", str(len(pops) * 4), "$15")
+    for pop in pops[1:]:
+        pop.delete()
+    return True
+
+def rule_unreachable(window, i):
+    # ret / <instructions> -> ret
+    line = window[i]
+    if not (line.is_instruction("ret") or line.is_instruction("iret") or line.is_instruction("j", None)):
+        return False
+    next = following(window, i, len(window))
+    for dead in next:
+        dead.delete()
+    return len(next) > 0
+
+RULES = {
+    "push-pop": rule_push_pop,
+    "push-mov-pop": rule_push_mov_pop,
+    "self-mov": rule_self_mov,
+    "dead-mov": rule_dead_mov,
+    "mov-back": rule_mov_back,
+    "identity": rule_identity,
+    "jump-next": rule_jump_next,
+    "pop-chain": rule_pop_chain,
+    "unreachable": rule_unreachable,
+}
+
+class Peephole:
+    def __init__(self, rules=None):
+        self.rules = {name: RULES[name] for name in (RULES.keys() if rules == None else rules)}
+        self.stats = {name: 0 for name in self.rules}
+
+    @staticmethod
+    def split(code):
+        lines = []
+        asm = False
+        for text in code.split("\n"):
+            if text.strip() == ASM_BEGIN:
+                asm = True
+            elif text.strip() == ASM_END:
+                asm = False
+            lines.append(Line(text, asm=asm))
+        return lines
+
+    def optimize(self, code):
+        lines = self.split(code)
+        # Comments and directives that don't generate code are ignored by the rules
+        window = [line for line in lines if line.kind not in ("comment", "silent")]
+
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(window)):
+                for name, rule in self.rules.items():
+                    if not window[i].deleted and rule(window, i):
+                        self.stats[name] += 1
+                        changed = True
+            window = [line for line in window if not line.deleted]
+
+        return "\n".join([line.text for line in lines if not line.deleted])
+
+    def report(self):
+        lines = []
+        for name, count in self.stats.items():
+            lines.append(f"{name:<13} {count}")
+        lines.append(f"{'total':<13} {sum(self.stats.values())}")
+        return "\n".join(lines)
+
+def parse_rules(rules, disable):
+    names = list(RULES.keys()) if rules == None else [name for name in rules.split(",") if name]
+    if disable != None:
+        names = [name for name in names if name not in disable.split(",")]
+    for name in names:
+        if name not in RULES:
+            raise click.BadParameter(f"unknown rule '{name}', available rules: {', '.join(RULES.keys())}")
+    return names
+
+@click.command()
+@click.argument("file", type=click.File("r"), required=True)
+@click.option("--output", "-o", type=click.File("w"), default="-", help="Output file to write to.")
+@click.option("--rules", default=None, help="Comma separated list of rules to run (default: all).")
+@click.option("--disable", default=None, help="Comma separated list of rules to skip.")
+@click.option("--stats", is_flag=True, default=False, help="Prints how many times each rule was applied.")
+def run(file, output, rules, disable, stats):
+    peephole = Peephole(parse_rules(rules, disable))
+    output.write(peephole.optimize(file.read()))
+
+    if stats:
+        click.echo(peephole.report(), err=True)
+
+if __name__ == "__main__":
+    run(None, None, None, None, None)
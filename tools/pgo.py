@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import click
+
+VERSION = 1
+
+# A `cond` branch taken less often than this is moved after the end of its function
+COLD_RATIO = 0.5
+
+# Calls to a function run at least this many times are inlined, if the function is small enough
+INLINE_MIN_CALLS = 16
+
+# Maximum amount of nodes in the body of an inlined function
+INLINE_MAX_NODES = 64
+
+class Profile:
+    # Execution counts of KL source positions, collected by `profiler.py --pgo` from a build with
+    # debug info. `kl.py -g` marks where the code of the nodes used by the optimizations starts, so
+    # the count of a node is how many times its first instruction ran
+    def __init__(self, counts=None, functions=None, instructions=0):
+        self.counts = counts or {} # "file:line:column" -> count
+        self.functions = functions or {} # Function name -> {"calls": ..., "instructions": ...}
+        self.instructions = instructions
+
+    @classmethod
+    def collect(cls, counts, debug_info):
+        # Builds a profile from address -> count
+        positions = {}
+        for address, file, line, column in debug_info.positions():
+            if column != 0:
+                positions.setdefault(f"{file}:{line}:{column}", set()).add(address)
+        # Inlined functions have the same position at more than one address
+        points = {key: sum(counts.get(address, 0) for address in addresses) for key, addresses in positions.items()}
+
+        functions = {name: {"calls": counts.get(start, 0), "instructions": 0} for name, start, _ in debug_info.functions}
+        for address, count in counts.items():
+            function = debug_info.function(address)
+            if function != None:
+                functions[function[0]]["instructions"] += count
+
+        return cls(points, functions, sum(counts.values()))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            raise ValueError(f"unsupported profile version {data.get('version')}")
+        return cls(data["counts"], data["functions"], data["instructions"])
+
+    def save(self, path):
+        data = {
+            "version": VERSION,
+            "instructions": self.instructions,
+            "functions": self.functions,
+            "counts": self.counts,
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+    def count(self, path, node):
+        # None when the position isn't in the profile, like code added after profiling
+        return self.counts.get(f"{path}:{node.line}:{node.col}")
+
+    def heat(self, name):
+        # Instructions run inside a function, None if it isn't in the profile
+        function = self.functions.get(name)
+        return function["instructions"] if function != None else None
+
+def build(files, optimize=False, profile=None):
+    # Builds a boot image in memory with debug info, returns the assembler. The tools are imported
+    # here since kl.py imports this module and doesn't need them
+    import kl
+    import assembler
+    import backend
+
+    modules = {}
+    for file in files:
+        if file.endswith(".kl"):
+            compiler = kl.compile_file(file, debug=True, profile=profile)
+            code = compiler.code
+            if optimize:
+                code = backend.Optimizer().optimize(code)
+            modules[file + ".out"] = code
+
+    def parse(file):
+        if file in modules:
+            return assembler.parser.parse(modules[file])
+        return assembler.parse_file(file)
+
+    units = [file + ".out" if file.endswith(".kl") else file for file in files]
+    return assembler.build(units, parse=parse, verbose=False)
+
+def execute(code, max_instructions=None, profiling=False):
+    import emulator
+    import profiler
+
+    machine = profiler.ProfilingEmulator() if profiling else emulator.Emulator()
+    machine.load(bytes(code))
+    start = time.perf_counter()
+    machine.run(max_instructions)
+    return machine, time.perf_counter() - start
+
+@click.command()
+@click.argument("files", required=True, nargs=-1)
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Runs the optimizer of backend.py on compiled modules.")
+@click.option("--profile-output", "-p", type=click.Path(), default=None, help="Writes the collected profile to a file.")
+@click.option("--max-instructions", "-n", type=int, default=None, help="Stops each run after this many instructions.")
+def run(files, optimize, profile_output, max_instructions):
+    """Builds FILES (same list as the assembler, .kl files are compiled first), profiles the image,
+    builds it again with the profile and compares the instructions run by both images."""
+    import kl
+    import emulator
+
+    try:
+        baseline = build(files, optimize)
+        debug_info = baseline.debug_info()
+        machine, _ = execute(baseline.code, max_instructions, profiling=True)
+        profile = Profile.collect(machine.counts, debug_info)
+        if profile_output != None:
+            profile.save(profile_output)
+
+        optimized = build(files, optimize, profile)
+    except kl.CompileError as e:
+        click.echo(kl.format_error(e), err=True)
+        exit(1)
+    except emulator.CpuException as e:
+        click.echo(f"ERROR: {type(e).__name__} at {debug_info.describe(e.ip)}", err=True)
+        exit(1)
+
+    results = []
+    for name, image in (("baseline", baseline), ("profiled", optimized)):
+        machine, elapsed = execute(image.code, max_instructions)
+        results.append(machine)
+        state = "halted" if machine.halted else "stopped"
+        click.echo(f"{name:<9} {len(image.code):>6} bytes {machine.instructions:>10} instructions "
+                   f"in {elapsed:.3f}s ({state} at 0x{machine.ip:X})")
+
+    before, after = results[0].instructions, results[1].instructions
+    if before:
+        click.echo(f"{before - after} fewer instructions ({(before - after) / before * 100:.2f}%)")
+
+    # Everything after both images (the framebuffer and any other memory they wrote) has to match
+    end = emulator.BOOT_ADDRESS + max(len(baseline.code), len(optimized.code))
+    if results[0].memory[end:] != results[1].memory[end:] or results[0].halted != results[1].halted:
+        click.echo("ERROR: the profiled image doesn't give the same results", err=True)
+        exit(1)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import time
+import click
+import struct
+import emulator
+from emulator import MASK, U32, CpuException, ProtectionFault, decode_instruction
+from debuginfo import DebugInfo
+import pgo
+
+# Instructions that enter or leave a frame. Interrupts are detected when the emulator stops
+# somewhere else than where the last step ended
+KINDS = {
+    "call": "call", "calli": "call", "bal": "call", "bali": "call", "syscall": "call",
+    "ret": "ret", "iret": "ret",
+}
+
+# Frames followed when unwinding the stack of a sample, deeper stacks are cut
+MAX_DEPTH = 64
+
+class ProfilingEmulator(emulator.Emulator):
+    # Counts every instruction by address and by call stack. The call stack is made of the
+    # addresses that were called (or jumped to by an interrupt), starting with the boot address
+    def __init__(self, *args, **kwargs):
+        self.counts = {} # Address -> times executed
+        self.stacks = {} # Call stack -> instructions executed with it
+        self.kinds = {} # Address -> "call", "ret" or None, filled when decoding
+        self.stack = () # Current call stack
+        self.returns = [] # Address each frame of the current stack returns to
+        self.expected = None # Where the last step stopped
+        super().__init__(*args, **kwargs)
+
+    def decode(self, ip):
+        entry = super().decode(ip)
+        self.kinds[ip] = KINDS.get(decode_instruction(self.memory, ip)[0])
+        return entry
+
+    def enter(self, address, return_address):
+        self.stack += (address,)
+        self.returns.append(return_address)
+
+    def leave(self, address):
+        # Returns that don't match a frame (like a `ret` used as a jump) don't change the stack
+        if address not in self.returns:
+            return
+        while self.returns:
+            self.stack = self.stack[:-1]
+            if self.returns.pop() == address:
+                break
+
+    def account(self, amount):
+        if amount > 0:
+            self.stacks[self.stack] = self.stacks.get(self.stack, 0) + amount
+
+    def step(self, count=emulator.UPDATE_INTERVAL):
+        # Same as Emulator.step, but it also updates the counters
+        if not self.stack:
+            self.stack = (self.ip,)
+        elif self.ip != self.expected:
+            self.enter(self.ip, self.expected)
+
+        cache = self.cache
+        decode = self.decode
+        kinds = self.kinds
+        counts = self.counts
+        ip = self.ip
+        executed = 0
+        changed = 0 # Value of `executed` when the stack last changed
+        try:
+            for executed in range(1, count + 1):
+                try:
+                    handler, a, b, next = cache[ip]
+                except KeyError:
+                    handler, a, b, next = decode(ip)
+                new = handler(a, b, next)
+                counts[ip] = counts.get(ip, 0) + 1
+                kind = kinds[ip]
+                if kind != None:
+                    self.account(executed - changed)
+                    changed = executed
+                    if kind == "call":
+                        self.enter(new, next)
+                    else:
+                        self.leave(new)
+                if new == ip:
+                    self.halted = not self.interrupts_enabled
+                    break
+                ip = new
+            else:
+                executed = count
+        except (IndexError, struct.error):
+            self.finish(ip, executed - 1, changed)
+            raise ProtectionFault(ip)
+        except CpuException:
+            self.finish(ip, executed - 1, changed)
+            raise
+        self.finish(ip, executed, changed)
+        return executed
+
+    def finish(self, ip, executed, changed):
+        self.account(executed - changed)
+        self.ip = ip
+        self.expected = ip
+        self.instructions += executed
+
+class Sampler(emulator.Device):
+    # Samples the instruction pointer and the call stack every `interval` device updates (so every
+    # `interval * UPDATE_INTERVAL` instructions), weighted by the instructions run since the last
+    # sample. The stack is unwound through the frame pointer ($12) used by KL functions
+    def __init__(self, interval=1, debug_info=None):
+        self.interval = interval
+        self.debug_info = debug_info
+        self.countdown = interval
+        self.last = 0 # Instructions run when the last sample was taken
+        self.counts = {}
+        self.stacks = {}
+        self.samples = 0
+
+    def update_device(self, emulator):
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.interval
+        self.sample(emulator)
+
+    def read(self, emulator, address):
+        try:
+            return U32.unpack_from(emulator.memory, address)[0]
+        except struct.error:
+            return None
+
+    def is_ret(self, emulator, ip):
+        try:
+            return decode_instruction(emulator.memory, ip)[0] == "ret"
+        except CpuException:
+            return False
+
+    def unwind(self, emulator):
+        # Return addresses of the current stack, innermost first
+        registers = emulator.registers
+        returns = []
+        # At the start and the end of a KL function the frame pointer still belongs to the caller,
+        # so the return address has to be read from the stack pointer. The epilogue isn't always at
+        # the end of the function, cold code can follow it, so its `ret` is found by decoding
+        function = self.debug_info.function(emulator.ip) if self.debug_info != None else None
+        if function != None:
+            _, start, _ = function
+            offset = {start: 0, start + 2: 4}.get(emulator.ip)
+            if offset == None and self.is_ret(emulator, emulator.ip):
+                offset = 0
+            if offset != None:
+                address = self.read(emulator, (registers[15] + offset) & MASK)
+                if address != None:
+                    returns.append(address)
+
+        frame = registers[12]
+        while frame != 0 and len(returns) < MAX_DEPTH:
+            address = self.read(emulator, frame + 4)
+            next = self.read(emulator, frame)
+            if address == None or next == None:
+                break
+            returns.append(address)
+            # Frames are always further up the stack, anything else is garbage
+            if next <= frame:
+                break
+            frame = next
+        return returns
+
+    def sample(self, emulator):
+        weight = emulator.instructions - self.last
+        self.last = emulator.instructions
+        if weight <= 0:
+            return
+        # The call stack is made of addresses inside each function, the innermost one is the
+        # instruction pointer itself
+        stack = (*reversed(self.unwind(emulator)), emulator.ip)
+        self.counts[emulator.ip] = self.counts.get(emulator.ip, 0) + weight
+        self.stacks[stack] = self.stacks.get(stack, 0) + weight
+        self.samples += 1
+
+class Profile:
+    # Reports for address -> instructions counts and call stack -> instructions counts. Each address
+    # of a call stack can be anywhere in its function
+    def __init__(self, counts, stacks, debug_info=None):
+        self.counts = counts
+        self.stacks = stacks
+        self.debug_info = debug_info
+        self.total = sum(counts.values())
+        self.names = {}
+
+    def name(self, address):
+        name = self.names.get(address)
+        if name == None:
+            if self.debug_info == None:
+                name = f"0x{address:X}"
+            else:
+                # Code outside of functions, like init.asm
+                name = self.debug_info.name(address) or "[unknown]"
+            self.names[address] = name
+        return name
+
+    def describe(self, address):
+        return self.debug_info.describe(address) if self.debug_info != None else f"0x{address:X}"
+
+    def percent(self, amount):
+        return f"{amount / self.total * 100 if self.total else 0:6.2f}%"
+
+    def functions(self):
+        # Function name -> [self instructions, total instructions]
+        functions = {}
+        for stack, count in self.stacks.items():
+            # Recursive functions are only counted once per stack
+            for name in {self.name(address) for address in stack}:
+                functions.setdefault(name, [0, 0])[1] += count
+            functions[self.name(stack[-1])][0] += count
+        return functions
+
+    def flat(self, top=20):
+        lines = [f"Flat profile ({self.total} instructions)", "",
+                 "  self %      self   total %     total  function"]
+        functions = sorted(self.functions().items(), key=lambda item: (-item[1][0], -item[1][1]))
+        for name, (own, total) in functions[:top]:
+            lines.append(f"{self.percent(own)} {own:>9} {self.percent(total)} {total:>9}  {name}")
+
+        if self.debug_info != None:
+            source = {}
+            for address, count in self.counts.items():
+                line = self.debug_info.line(address)
+                if line != None:
+                    source[line] = source.get(line, 0) + count
+            lines += ["", "Hot lines", "", "       %     count  line"]
+            for (file, line), count in sorted(source.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"{self.percent(count)} {count:>9}  {file}:{line}")
+
+        lines += ["", "Hot addresses", "", "       %     count  address"]
+        for address, count in sorted(self.counts.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f"{self.percent(count)} {count:>9}  {self.describe(address)}")
+        return "\n".join(lines)
+
+    def call_graph(self, top=20):
+        # Callers and callees of each function, weighted by the instructions run inside the callee
+        callers = {}
+        callees = {}
+        for stack, count in self.stacks.items():
+            names = [self.name(address) for address in stack]
+            for caller, callee in {(names[i], names[i + 1]) for i in range(len(names) - 1)}:
+                if caller == callee:
+                    continue
+                callers.setdefault(callee, {}).setdefault(caller, 0)
+                callers[callee][caller] += count
+                callees.setdefault(caller, {}).setdefault(callee, 0)
+                callees[caller][callee] += count
+
+        lines = [f"Call graph ({self.total} instructions)"]
+        functions = sorted(self.functions().items(), key=lambda item: -item[1][1])
+        for name, (own, total) in functions[:top]:
+            lines += ["", f"{name}: total {total} ({self.percent(total).strip()}), self {own} ({self.percent(own).strip()})"]
+            for caller, count in sorted(callers.get(name, {}).items(), key=lambda item: -item[1]):
+                lines.append(f"    called by {caller:<40} {count:>9}")
+            for callee, count in sorted(callees.get(name, {}).items(), key=lambda item: -item[1]):
+                lines.append(f"    calls     {callee:<40} {count:>9}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        # One line per call stack, like "main;graphics::draw-string;graphics::draw-character 1234"
+        stacks = {}
+        for stack, count in self.stacks.items():
+            names = []
+            for address in stack:
+                name = self.name(address)
+                # Jumps inside the same function don't make new frames
+                if not names or names[-1] != name:
+                    names.append(name)
+            key = ";".join(names)
+            stacks[key] = stacks.get(key, 0) + count
+        return "".join(f"{key} {count}\n" for key, count in sorted(stacks.items()))
+
+@click.command()
+@click.argument("file", type=click.Path(exists=True), required=True)
+@click.option("--memory-size", "-m", default=emulator.MEMORY_SIZE, help="Memory size in bytes (default 128M).")
+@click.option("--max-instructions", "-n", type=int, default=None, help="Stops after this many instructions.")
+@click.option("--sample", "-s", "interval", type=int, default=None,
+              help=f"Samples every N * {emulator.UPDATE_INTERVAL} instructions instead of counting every instruction.")
+@click.option("--translate", "-t", is_flag=True, default=False, help="Uses the translating emulator when sampling.")
+@click.option("--call-graph", "-c", is_flag=True, default=False, help="Prints the call graph after the flat profile.")
+@click.option("--collapsed", type=click.File("w"), default=None, help="Writes collapsed stacks for flame graphs to a file.")
+@click.option("--top", default=20, help="Amount of entries in each table.")
+@click.option("--pgo", "pgo_output", type=click.Path(), default=None, help="Writes a profile for kl.py --profile to a file.")
+def run(file, memory_size, max_instructions, interval, translate, call_graph, collapsed, top, pgo_output):
+    """Profiles a boot image. Uses <FILE>.dbg for symbols and source lines when it exists."""
+    debug_info = DebugInfo.find(file)
+
+    if pgo_output != None and (interval != None or debug_info == None):
+        click.echo("ERROR: --pgo needs exact counts and debug info", err=True)
+        exit(1)
+
+    if interval == None:
+        if translate:
+            click.echo("ERROR: --translate can only be used with --sample", err=True)
+            exit(1)
+        profiled = ProfilingEmulator(memory_size)
+    else:
+        if interval < 1:
+            click.echo("ERROR: sampling interval must be at least 1", err=True)
+            exit(1)
+        if translate:
+            from translator import TranslatingEmulator
+            profiled = TranslatingEmulator(memory_size)
+        else:
+            profiled = emulator.Emulator(memory_size)
+        sampler = Sampler(interval, debug_info)
+        profiled.attach(sampler)
+    profiled.load(file)
+
+    start = time.perf_counter()
+    try:
+        profiled.run(max_instructions)
+    except CpuException as e:
+        location = debug_info.describe(e.ip) if debug_info != None else f"0x{e.ip:X}"
+        click.echo(f"ERROR: {type(e).__name__} at {location}", err=True)
+    elapsed = time.perf_counter() - start
+
+    if interval == None:
+        profile = Profile(profiled.counts, profiled.stacks, debug_info)
+        mode = "exact"
+    else:
+        # The instructions after the last sample are counted as part of the current stack
+        sampler.sample(profiled)
+        profile = Profile(sampler.counts, sampler.stacks, debug_info)
+        mode = f"{sampler.samples} samples"
+    click.echo(f"{profiled.instructions} instructions in {elapsed:.3f}s ({mode})", err=True)
+
+    click.echo(profile.flat(top))
+    if call_graph:
+        click.echo()
+        click.echo(profile.call_graph(top))
+    if collapsed != None:
+        collapsed.write(profile.collapsed())
+    if pgo_output != None:
+        pgo.Profile.collect(profiled.counts, debug_info).save(pgo_output)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import os
+import gc
+import json
+import math
+import time
+import shutil
+import tempfile
+import tracemalloc
+import click
+
+import kl
+import assembler
+import backend
+
+VERSION = 1
+
+# Growth exponent (slope of log time or log memory against log size) above which a stage is reported
+# as superlinear. Linear stages measure around 1.0, quadratic ones approach 2.0
+MAX_EXPONENT = 1.3
+
+# Points faster than this are mostly noise and aren't used to fit the exponent, in seconds
+MIN_TIME = 0.005
+
+# Stages are timed up to this many times and the best time is kept, but a run slower than
+# LONG_RUN seconds is trusted on its own
+REPEAT = 3
+LONG_RUN = 0.5
+
+# Width and height of the text plots
+PLOT_WIDTH = 60
+PLOT_HEIGHT = 16
+
+def kl_functions(size):
+    # `size` functions with a few locals, each calling the previous one
+    lines = []
+    for i in range(size):
+        lines.append(f"(fn uint32 f{i} ((uint32 a) (uint32 b))")
+        lines.append("    (local uint32 c (+ a b))")
+        lines.append("    (cond (> c 100) (")
+        lines.append("        (set-var c (- c 100))")
+        lines.append("    ))")
+        lines.append(f"    (return {f'(f{i - 1} c a)' if i > 0 else 'c'})")
+        lines.append(")")
+    lines.append("(fn void main ()")
+    lines.append(f"    (f{size - 1} 1 2)")
+    lines.append(")")
+    return {"main.kl": "\n".join(lines) + "\n"}
+
+def kl_nesting(size):
+    # One function with `size` nested loops and conditions. Not indented, so the source grows
+    # linearly with the depth
+    lines = ["(fn void main ()", "(local uint32 x)"]
+    for i in range(size):
+        if i % 2 == 0:
+            lines.append(f"(while (< x {i + 10})")
+        else:
+            lines.append(f"(cond (== x {i}) (")
+        lines.append("(set-var x (+ x 1))")
+    for i in reversed(range(size)):
+        lines.append(")" if i % 2 == 0 else "))")
+    lines.append(")")
+    return {"main.kl": "\n".join(lines) + "\n"}
+
+def kl_data(size):
+    # Tables with `size` values in total and a function reading them
+    lines = []
+    tables = max(1, size // 1000)
+    for table in range(tables):
+        count = size // tables
+        lines.append(f"(static uint32 table{table} (")
+        for row in range(0, count, 16):
+            values = " ".join(str((table * count + row + i) * 2654435761 % 0x100000000) for i in range(min(16, count - row)))
+            lines.append(f"    {values}")
+        lines.append("))")
+    lines.append("(fn uint32 main ()")
+    lines.append(f"    (return (elem-32 &table{tables - 1} 1))")
+    lines.append(")")
+    return {"main.kl": "\n".join(lines) + "\n"}
+
+def kl_imports(size):
+    # `size` modules in their own namespace, all imported and called by main.kl
+    files = {}
+    for i in range(size):
+        files[f"module{i}.kl"] = (
+            f"(@namespace module{i})\n"
+            f"(static uint32 counter)\n"
+            f"(fn uint32 get ((uint32 x))\n"
+            f"    (set-var counter (+ counter x))\n"
+            f"    (return counter)\n"
+            f")\n"
+        )
+    lines = [f'(import "module{i}.kl")' for i in range(size)]
+    lines.append("(fn void main ()")
+    lines.append("    (local uint32 total)")
+    lines += [f"    (set-var total (+ total (module{i}::get {i})))" for i in range(size)]
+    lines.append(")")
+    files["main.kl"] = "\n".join(lines) + "\n"
+    return files
+
+def asm_symbols(size):
+    # Assembly with `size` exported labels, each referenced from code and from a table
+    lines = [".export #main", "#main:"]
+    for i in range(size):
+        lines.append(f".export #symbol{i}")
+        lines.append(f"#symbol{i}:")
+        lines.append(f"    mov #symbol{(i * 7) % size} $1")
+        lines.append(f"    add {i} $1")
+    lines.append("#table:")
+    for i in range(0, size, 8):
+        lines.append("    .dword " + ", ".join(f"#symbol{j}" for j in range(i, min(i + 8, size))))
+    lines.append("    ret")
+    return {"main.asm": "\n".join(lines) + "\n"}
+
+GENERATORS = {
+    "functions": (kl_functions, [50, 100, 200, 400]),
+    "nesting": (kl_nesting, [50, 100, 200, 400]),
+    "data": (kl_data, [5000, 10000, 20000, 40000]),
+    "imports": (kl_imports, [25, 50, 100, 200]),
+    "symbols": (asm_symbols, [500, 1000, 2000, 4000]),
+}
+
+def generate(kind, size, directory):
+    # Writes the program to a directory, returns its files with the main one first
+    files = GENERATORS[kind][0](size)
+    for name, text in files.items():
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(text)
+    return sorted(files, key=lambda name: not name.startswith("main."))
+
+def stages(files, optimize):
+    # (name, function) of each toolchain stage. Each function takes the results of the previous
+    # stage for every file, the first one takes the source code
+    def parse(sources):
+        return [kl.parse(source) for source in sources]
+
+    def compile(trees):
+        code = []
+        for file, tree in zip(files, trees):
+            compiler = kl.Compiler(path=file)
+            try:
+                compiler.compile(tree)
+            except kl.CompileError as e:
+                e.path = compiler.path
+                raise
+            code.append(compiler.code)
+        return code
+
+    def optimize_code(code):
+        return [backend.Optimizer().optimize(text) for text in code]
+
+    def parse_asm(code):
+        return [assembler.parser.parse(text) for text in code]
+
+    def link(trees):
+        trees = dict(zip(files, trees))
+        return assembler.build(files, parse=trees.get, verbose=False).code
+
+    if files[0].endswith(".asm"):
+        return [("asm-parse", parse_asm), ("assemble", link)]
+    result = [("parse", parse), ("compile", compile)]
+    if optimize:
+        result.append(("optimize", optimize_code))
+    return result + [("asm-parse", parse_asm), ("assemble", link)]
+
+def measure(files, optimize, memory):
+    # Stage name -> {"time": seconds, "memory": peak bytes allocated}. Peak memory is measured in a
+    # second pass since tracing allocations makes everything several times slower
+    results = {}
+    value = []
+    for file in files:
+        with open(file, "r") as f:
+            value.append(f.read())
+    for name, function in stages(files, optimize):
+        best = None
+        for _ in range(REPEAT):
+            gc.collect()
+            start = time.perf_counter()
+            output = function(value)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best == None else min(best, elapsed)
+            if elapsed > LONG_RUN:
+                break
+        results[name] = {"time": best}
+
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            function(value)
+            results[name]["memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        value = output
+    return results
+
+def exponent(points):
+    # Least squares slope of log(value) against log(size)
+    if len(points) < 2:
+        return None
+    xs = [math.log(size) for size, _ in points]
+    ys = [math.log(value) for _, value in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+def plot(series, title, unit):
+    # Log-log text plot of stage name -> [(size, value)], one letter per stage
+    points = [(size, value) for values in series.values() for size, value in values if value > 0]
+    if not points:
+        return []
+    low_x, high_x = math.log(min(p[0] for p in points)), math.log(max(p[0] for p in points))
+    low_y, high_y = math.log(min(p[1] for p in points)), math.log(max(p[1] for p in points))
+    grid = [[" "] * PLOT_WIDTH for _ in range(PLOT_HEIGHT)]
+    legend = []
+    for letter, (name, values) in zip("abcdefghijklmnopqrstuvwxyz", series.items()):
+        legend.append(f"{letter} = {name}")
+        for size, value in values:
+            if value <= 0:
+                continue
+            x = round((math.log(size) - low_x) / ((high_x - low_x) or 1) * (PLOT_WIDTH - 1))
+            y = round((math.log(value) - low_y) / ((high_y - low_y) or 1) * (PLOT_HEIGHT - 1))
+            grid[PLOT_HEIGHT - 1 - y][x] = letter
+    lines = [f"{title} (log-log, {unit}: {math.exp(low_y):.3g} to {math.exp(high_y):.3g}, "
+             f"size: {min(p[0] for p in points)} to {max(p[0] for p in points)})"]
+    lines += ["|" + "".join(row) for row in grid]
+    lines.append("+" + "-" * PLOT_WIDTH)
+    lines.append("  " + ", ".join(legend))
+    return lines
+
+def parse_sizes(text):
+    try:
+        sizes = [int(size) for size in text.split(",") if size.strip()]
+    except ValueError:
+        raise click.BadParameter("sizes must be comma separated integers")
+    if any(size < 1 for size in sizes):
+        raise click.BadParameter("sizes must be positive")
+    return sizes
+
+@click.group()
+def cli():
+    pass
+
+@cli.command("generate")
+@click.argument("kind", type=click.Choice(list(GENERATORS)), required=True)
+@click.argument("size", type=int, required=True)
+@click.option("--directory", "-C", type=click.Path(file_okay=False), default=".", help="Directory to write the files to.")
+def generate_command(kind, size, directory):
+    """Writes a synthetic program of the given KIND and SIZE."""
+    os.makedirs(directory, exist_ok=True)
+    files = generate(kind, size, directory)
+    click.echo(f"Wrote {len(files)} files to {directory}, main file is {files[0]}")
+
+@cli.command()
+@click.argument("kinds", nargs=-1)
+@click.option("--sizes", "-s", default=None, help="Comma separated sizes, instead of the default of each kind.")
+@click.option("--scale", type=float, default=1.0, help="Multiplies every size.")
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Also measures the optimizer of backend.py.")
+@click.option("--no-memory", is_flag=True, default=False, help="Skips measuring peak memory.")
+@click.option("--max-exponent", type=float, default=MAX_EXPONENT, help=f"Growth exponent reported as superlinear (default {MAX_EXPONENT}).")
+@click.option("--plot/--no-plot", "show_plot", default=True, help="Prints log-log plots of time and memory.")
+@click.option("--output", "-o", type=click.Path(), default=None, help="Writes every measurement to a JSON file.")
+def scale(kinds, sizes, scale, optimize, no_memory, max_exponent, show_plot, output):
+    """Builds programs of every KIND (all by default) at growing sizes, prints how time and peak
+    memory of each toolchain stage grow, and fails if a stage grows faster than --max-exponent."""
+    for kind in kinds:
+        if kind not in GENERATORS:
+            click.echo(f"ERROR: unknown kind '{kind}', expected one of {', '.join(GENERATORS)}", err=True)
+            exit(1)
+    chosen_sizes = parse_sizes(sizes) if sizes != None else None
+
+    report = {"version": VERSION, "kinds": {}}
+    superlinear = []
+    old_directory = os.getcwd()
+    for kind in kinds or GENERATORS:
+        kind_sizes = [max(1, round(size * scale)) for size in (chosen_sizes or GENERATORS[kind][1])]
+        measurements = {} # Stage -> [(size, time, memory)]
+        for size in kind_sizes:
+            directory = tempfile.mkdtemp(prefix="synth-")
+            try:
+                # Imports are relative to the working directory
+                os.chdir(directory)
+                files = generate(kind, size, directory)
+                results = measure(files, optimize, not no_memory)
+            except kl.CompileError as e:
+                click.echo(kl.format_error(e), err=True)
+                exit(1)
+            finally:
+                os.chdir(old_directory)
+                shutil.rmtree(directory)
+            for stage, result in results.items():
+                measurements.setdefault(stage, []).append((size, result["time"], result.get("memory")))
+
+        click.echo(f"{kind}:")
+        header = "  stage      " + "".join(f"{size:>12}" for size in kind_sizes) + "    time exp  memory exp"
+        click.echo(header)
+        report["kinds"][kind] = {}
+        for stage, values in measurements.items():
+            time_exponent = exponent([(size, value) for size, value, _ in values if value >= MIN_TIME])
+            memory_exponent = exponent([(size, value) for size, _, value in values if value])
+            report["kinds"][kind][stage] = {
+                "sizes": [size for size, _, _ in values],
+                "time": [value for _, value, _ in values],
+                "memory": [value for _, _, value in values],
+                "time_exponent": time_exponent,
+                "memory_exponent": memory_exponent,
+            }
+            flags = []
+            for what, value in (("time", time_exponent), ("memory", memory_exponent)):
+                if value != None and value > max_exponent:
+                    flags.append(what)
+                    superlinear.append(f"{kind}/{stage} {what} grows with exponent {value:.2f}")
+            cells = "".join(f"{value * 1000:10.1f}ms" for _, value, _ in values)
+            exponents = "".join(f"{value:>12.2f}" if value != None else f"{'-':>12}" for value in (time_exponent, memory_exponent))
+            click.echo(f"  {stage:<11}{cells}{exponents}{'  SUPERLINEAR' if flags else ''}")
+
+        if show_plot:
+            click.echo()
+            for line in plot({stage: [(size, value) for size, value, _ in values] for stage, values in measurements.items()}, f"{kind} time", "s"):
+                click.echo("  " + line)
+            if not no_memory:
+                click.echo()
+                for line in plot({stage: [(size, value) for size, _, value in values] for stage, values in measurements.items()}, f"{kind} peak memory", "bytes"):
+                    click.echo("  " + line)
+        click.echo()
+
+    if output != None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    for line in superlinear:
+        click.echo(f"SUPERLINEAR: {line}", err=True)
+    if superlinear:
+        exit(1)
+
+if __name__ == "__main__":
+    cli()
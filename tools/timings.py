@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import contextlib
+import click
+
+VERSION = 1
+
+class Timings:
+    # Wall and CPU time spent in each phase of a tool, and counters of the work it did. Phases can
+    # be nested, a phase only gets the time not spent in the phases inside it so the times add up
+    # to the total. Phases are meant to be big steps like parsing a file, not single nodes
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {} # Name -> [wall time, CPU time, times entered]
+        self.counters = {}
+        self.stack = [] # [wall time, CPU time] spent in phases inside each open phase
+        self.start = (time.perf_counter(), time.process_time())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        inner = [0.0, 0.0]
+        self.stack.append(inner)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1][0] += wall
+                self.stack[-1][1] += cpu
+            entry = self.phases.setdefault(name, [0.0, 0.0, 0])
+            entry[0] += wall - inner[0]
+            entry[1] += cpu - inner[1]
+            entry[2] += 1
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_json(self, tool):
+        return {
+            "version": VERSION,
+            "tool": tool,
+            "total": {"wall": time.perf_counter() - self.start[0], "cpu": time.process_time() - self.start[1]},
+            "phases": {name: {"wall": wall, "cpu": cpu, "calls": calls} for name, (wall, cpu, calls) in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+# Used by tools when timings weren't asked for
+NO_TIMINGS = Timings(enabled=False)
+
+def report(data):
+    # Human readable table of the results of to_json
+    total = data["total"]["wall"]
+    lines = [f"{data['tool']}: {total * 1000:.1f}ms wall, {data['total']['cpu'] * 1000:.1f}ms CPU"]
+    lines.append(f"  {'phase':<16} {'wall':>10} {'cpu':>10} {'calls':>6} {'share':>6}")
+    for name, phase in sorted(data["phases"].items(), key=lambda item: -item[1]["wall"]):
+        share = phase["wall"] / total * 100 if total else 0
+        lines.append(f"  {name:<16} {phase['wall'] * 1000:>8.1f}ms {phase['cpu'] * 1000:>8.1f}ms {phase['calls']:>6} {share:>5.1f}%")
+    for name, amount in data["counters"].items():
+        lines.append(f"  {name:<16} {amount:>10}")
+    return "\n".join(lines)
+
+def finish(timings, tool, show, output):
+    # Prints and saves the results like the --timings and --timings-json options of the tools
+    if not timings.enabled:
+        return
+    data = timings.to_json(tool)
+    if show:
+        click.echo(report(data), err=True)
+    if output != None:
+        with open(output, "w") as f:
+            json.dump(data, f, indent=1)
+
+@click.command()
+@click.argument("files", type=click.Path(exists=True), required=True, nargs=-1)
+def run(files):
+    """Prints results written with --timings-json by kl.py, assembler.py or compiler.py."""
+    for file in files:
+        with open(file, "r") as f:
+            data = json.load(f)
+        if data.get("version") != VERSION:
+            click.echo(f"ERROR: unsupported timings version {data.get('version')} in {file}", err=True)
+            exit(1)
+        click.echo(report(data))
+
+if __name__ == "__main__":
+    run()
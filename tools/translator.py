@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+import struct
+import emulator
+from emulator import MASK, U16, U32, CpuException, ProtectionFault, DivisionByZero, decode_instruction
+
+# Blocks end after this many instructions even without a branch
+MAX_BLOCK_SIZE = 128
+
+# Instructions ending a block
+TERMINATORS = {
+    "j", "jt", "jf", "b", "bt", "bf", "call", "bal", "ji", "jti", "jfi", "bi", "bti", "bfi", "calli", "bali",
+    "ret", "iret", "syscall",
+}
+
+# Branches that can jump back to the start of their block, which is then compiled as a loop
+LOOPS = {"ji": None, "bi": None, "jti": "cmp", "bti": "cmp", "jfi": "not cmp", "bfi": "not cmp"}
+
+# Conditional branches to a known address don't end a block, only their taken side leaves it. A loop
+# with its exit test at the top then fits in one block and runs inside one function call
+SIDE_EXITS = {"jti": "cmp", "bti": "cmp", "jfi": "not cmp", "bfi": "not cmp"}
+
+# Blocks are interpreted this many times before they're translated, compiling a block costs about as
+# much as interpreting it a few hundred times
+HOT_THRESHOLD = 16
+
+class Idle(Exception):
+    # Raised by blocks that end with a jump to itself
+    def __init__(self, ip):
+        self.ip = ip
+
+class Block:
+    def __init__(self, start, end, length, exits):
+        self.start = start
+        self.end = end
+        self.length = length
+        self.exits = exits # Addresses of the exits known when compiling -> index in `links`
+        self.links = [None] * len(exits) # Blocks chained to each exit
+        self.callers = [] # (block, index) of the links to this block
+        self.valid = True
+        self.function = None
+        self.source = None
+
+class Generator:
+    # Generates the source of a block function. Registers are kept in locals and written back at every
+    # exit, the function takes the amount of instructions it's allowed to run and returns the next
+    # block if it's chained or the address to continue at
+    def __init__(self, instructions, io_range):
+        self.instructions = instructions
+        self.start = instructions[0][0]
+        self.length = len(instructions)
+        self.io_start, self.io_end = io_range
+        self.lines = []
+        self.indent = 0
+        self.used = set()
+        self.written = set()
+        self.exits = {}
+        self.index = 0
+        self.addresses = {instruction[0] for instruction in instructions}
+        # Forward branches to a later instruction of the block skip the code in between with an `if`,
+        # (address they skip to, index of the first instruction skipped) of the ones still open
+        self.regions = []
+        # Values pushed by this block that are still on top of the stack, pops read them without
+        # going through memory. This assumes the stack isn't in an I/O area
+        self.stack = []
+        self.temporaries = 0
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def reg(self, n):
+        if n == 0:
+            return "0"
+        self.used.add(n)
+        return f"r{n}"
+
+    def dest(self, n):
+        # Writes to $0 are discarded
+        if n == 0:
+            return "_"
+        if n == 15:
+            self.stack = []
+        self.used.add(n)
+        self.written.add(n)
+        return f"r{n}"
+
+    def compare(self, expression):
+        self.used.add("cmp")
+        self.written.add("cmp")
+        self.emit(f"cmp = {expression}")
+
+    def condition(self, expression):
+        self.used.add("cmp")
+        return expression
+
+    def is_io(self, address):
+        return self.io_start <= address <= self.io_end
+
+    def load(self, size, dest, address):
+        fast = {1: "memory[{}]", 2: "unpack16(memory, {})[0]", 4: "unpack32(memory, {})[0]"}[size]
+        if isinstance(address, int):
+            self.emit(f"{dest} = " + (f"read_io({address}, {size})" if self.is_io(address) else fast.format(address)))
+            return
+        self.emit(f"a = {address}")
+        if self.io_end >= 0:
+            self.emit(f"{dest} = read_io(a, {size}) if {self.io_start} <= a <= {self.io_end} else {fast.format('a')}")
+        else:
+            self.emit(f"{dest} = {fast.format('a')}")
+
+    def store(self, size, address, value, resume):
+        mask = {1: " & 0xFF", 2: " & 0xFFFF", 4: ""}[size]
+        fast = {1: "memory[a] = {}", 2: "pack16(memory, a, {})", 4: "pack32(memory, a, {})"}[size]
+        self.emit(f"a = {address}")
+        if isinstance(address, int) and self.is_io(address):
+            self.emit(f"write_io(a, {value}{mask}, {size})")
+        elif not isinstance(address, int) and self.io_end >= 0:
+            self.emit(f"if {self.io_start} <= a <= {self.io_end}:")
+            self.emit(f"    write_io(a, {value}{mask}, {size})")
+            self.emit("else:")
+            self.emit("    " + fast.format(value + mask))
+        else:
+            self.emit(fast.format(value + mask))
+        # The rest of the block might have been overwritten
+        self.emit("if a in code_bytes:")
+        self.indent += 1
+        self.emit(f"invalidate(a, {size})")
+        self.leave(str(resume), self.index + 1)
+        self.indent -= 1
+
+    def push(self, value, resume=None):
+        # `resume` is where to continue if the push overwrites code, calls continue at their target
+        self.emit("r15 = (r15 - 4) & 0xFFFFFFFF")
+        self.used.add(15)
+        self.written.add(15)
+        self.store(4, "r15", value, resume or self.instructions[self.index][4])
+        if value[0] == "r":
+            # The register might change before the pop
+            temporary = f"s{self.temporaries}"
+            self.temporaries += 1
+            self.emit(f"{temporary} = {value}")
+            value = temporary
+        self.stack.append(value)
+
+    def pop(self, dest):
+        self.used.add(15)
+        self.written.add(15)
+        if self.stack:
+            self.emit(f"{dest} = {self.stack.pop()}")
+        else:
+            self.load(4, dest, "r15")
+        self.emit("r15 = (r15 + 4) & 0xFFFFFFFF")
+
+    def leave(self, target, executed=None):
+        # Writes back the registers and returns, `executed` is how many instructions of the block ran
+        self.emit("@writeback")
+        if executed != None and executed != self.length:
+            self.emit(f"counter[0] -= {self.length - executed}")
+        self.emit(f"return {target}")
+
+    def exit_static(self, target, executed=None):
+        # A jump to itself only counts once, same as in Emulator.step
+        ip = self.instructions[self.index][0]
+        if target == ip:
+            self.emit("@writeback")
+            if executed != None and executed != self.length:
+                self.emit(f"counter[0] -= {self.length - executed}")
+            self.emit(f"raise idle({ip})")
+        else:
+            index = self.exits.setdefault(target, len(self.exits))
+            self.leave(f"links[{index}] or {target}", executed)
+
+    def exit_dynamic(self, target):
+        if target != "t":
+            self.emit(f"t = {target}")
+        ip = self.instructions[self.index][0]
+        self.emit(f"if t == {ip}:")
+        self.emit("    @writeback")
+        self.emit(f"    raise idle({ip})")
+        # Returning the block directly saves a lookup in the dispatcher
+        self.leave("lookup(t) or t")
+
+    def branch(self, condition, taken, next, static):
+        exit = self.exit_static if static else self.exit_dynamic
+        if condition == None:
+            exit(taken)
+            return
+        self.emit(f"if {self.condition(condition)}:")
+        self.indent += 1
+        exit(taken)
+        self.indent -= 1
+        self.exit_static(next)
+
+    def instruction(self, ip, name, a, b, next):
+        reg, dest = self.reg, self.dest
+
+        if name in ("add", "sub", "and", "or", "xor", "shl", "shr", "mov") and b == 0:
+            return
+        if name in ("addi", "subi", "andi", "ori", "xori", "shli", "shri", "movi") and a == 0:
+            return
+
+        if name in ("div", "divi") or name.startswith(("st", "ld", "push", "pop", "call", "ret", "bal", "iret", "syscall")):
+            self.emit(f"pc = {ip}")
+        if name.startswith("st"):
+            # Might overwrite the values on the stack
+            self.stack = []
+
+        if name == "nop":
+            pass
+        elif name == "add":
+            self.emit(f"{dest(b)} = ({reg(b)} + {reg(a)}) & 0xFFFFFFFF")
+        elif name == "sub":
+            self.emit(f"{dest(b)} = ({reg(b)} - {reg(a)}) & 0xFFFFFFFF")
+        elif name == "mul":
+            self.emit(f"t = {reg(b)} * {reg(a)}")
+            self.emit(f"{dest(14)} = t >> 32")
+            self.emit(f"{dest(13)} = t & 0xFFFFFFFF")
+        elif name == "div":
+            self.emit(f"{dest(14)}, {dest(13)} = divmod({reg(b)}, {reg(a)})")
+        elif name in ("and", "or", "xor"):
+            operator = {"and": "&", "or": "|", "xor": "^"}[name]
+            self.emit(f"{dest(b)} = {reg(b)} {operator} {reg(a)}")
+        elif name == "shl":
+            self.emit(f"{dest(b)} = ({reg(b)} << {reg(a)}) & 0xFFFFFFFF if {reg(a)} < 32 else 0")
+        elif name == "shr":
+            self.emit(f"{dest(b)} = {reg(b)} >> {reg(a)}")
+        elif name in ("stb", "stw", "std"):
+            self.store({"stb": 1, "stw": 2, "std": 4}[name], reg(b), reg(a), next)
+        elif name in ("ldb", "ldw", "ldd"):
+            self.load({"ldb": 1, "ldw": 2, "ldd": 4}[name], dest(b), reg(a))
+        elif name == "addi":
+            self.emit(f"{dest(a)} = ({reg(a)} + {b}) & 0xFFFFFFFF")
+        elif name == "subi":
+            self.emit(f"{dest(a)} = ({reg(a)} - {b}) & 0xFFFFFFFF")
+        elif name == "muli":
+            self.emit(f"t = {reg(a)} * {b}")
+            self.emit(f"{dest(14)} = t >> 32")
+            self.emit(f"{dest(13)} = t & 0xFFFFFFFF")
+        elif name == "divi":
+            self.emit(f"{dest(14)}, {dest(13)} = divmod({reg(a)}, {b})")
+        elif name in ("andi", "ori", "xori"):
+            operator = {"andi": "&", "ori": "|", "xori": "^"}[name]
+            self.emit(f"{dest(a)} = {reg(a)} {operator} {b}")
+        elif name == "shli":
+            self.emit(f"{dest(a)} = ({reg(a)} << {b}) & 0xFFFFFFFF" if b < 32 else f"{dest(a)} = 0")
+        elif name == "shri":
+            self.emit(f"{dest(a)} = {reg(a)} >> {b}")
+        elif name in ("stbi", "stwi", "stdi"):
+            self.store({"stbi": 1, "stwi": 2, "stdi": 4}[name], b, reg(a), next)
+        elif name in ("ldbi", "ldwi", "lddi"):
+            self.load({"ldbi": 1, "ldwi": 2, "lddi": 4}[name], dest(a), b)
+        elif name in ("stbii", "stwii", "stdii"):
+            self.store({"stbii": 1, "stwii": 2, "stdii": 4}[name], b, str(a), next)
+        elif name in ("cgtq", "cltq", "ceq", "cnq", "cgt", "clt"):
+            operator = {"cgtq": ">=", "cltq": "<=", "ceq": "==", "cnq": "!=", "cgt": ">", "clt": "<"}[name]
+            self.compare(f"{reg(a)} {operator} {reg(b)}")
+        elif name in ("cgtqi", "cltqi", "ceqi", "cnqi", "cgti", "clti"):
+            operator = {"cgtqi": ">=", "cltqi": "<=", "ceqi": "==", "cnqi": "!=", "cgti": ">", "clti": "<"}[name]
+            self.compare(f"{reg(a)} {operator} {b}")
+        elif name == "mov":
+            self.emit(f"{dest(b)} = {reg(a)}")
+        elif name == "movi":
+            self.emit(f"{dest(a)} = {b}")
+        elif name == "push":
+            self.push(reg(a))
+        elif name == "pushi":
+            self.push(str(a))
+        elif name == "pop":
+            self.pop(dest(a))
+        elif name == "cli":
+            self.emit("cpu.interrupts_enabled = False")
+        elif name == "sti":
+            self.emit("cpu.interrupts_enabled = True")
+        elif name in ("j", "jt", "jf"):
+            self.branch({"j": None, "jt": "cmp", "jf": "not cmp"}[name], reg(a), next, static=False)
+        elif name in ("b", "bt", "bf"):
+            self.branch({"b": None, "bt": "cmp", "bf": "not cmp"}[name], f"({b} + {reg(a)}) & 0xFFFFFFFF", next, static=False)
+        elif name in SIDE_EXITS and ip < a and a in self.addresses and (not self.regions or a <= self.regions[-1][0]):
+            self.emit(f"if not ({self.condition(SIDE_EXITS[name])}):")
+            self.indent += 1
+            self.emit("pass")
+            self.regions.append((a, self.index + 1))
+        elif name in SIDE_EXITS and self.index < self.length - 1:
+            self.emit(f"if {self.condition(SIDE_EXITS[name])}:")
+            self.indent += 1
+            self.exit_static(a, self.index + 1)
+            self.indent -= 1
+        elif name in ("ji", "bi", "jti", "bti", "jfi", "bfi"):
+            self.branch(LOOPS[name], a, next, static=True)
+        elif name == "call":
+            self.emit(f"t = {reg(a)}")
+            self.push(str(next), "t")
+            self.exit_dynamic("t")
+        elif name in ("calli", "bali"):
+            self.push(str(next), a)
+            self.exit_static(a)
+        elif name == "bal":
+            target = f"({b} + {reg(a)}) & 0xFFFFFFFF"
+            self.push(str(next), target)
+            self.exit_dynamic(target)
+        elif name == "ret":
+            self.pop("t")
+            self.exit_dynamic("t")
+        elif name in ("iret", "syscall"):
+            # These change the flags or the whole CPU state, so the emulator handles them
+            self.emit("@writeback")
+            self.emit(f"return handlers[{repr(name)}](None, None, {next})")
+
+    def generate(self):
+        last = self.instructions[-1]
+        loop = last[1] in LOOPS and last[2] == self.start and self.length > 1
+
+        self.indent = 3 if loop else 2
+        for self.index, (ip, name, a, b, next) in enumerate(self.instructions):
+            while self.regions and self.regions[-1][0] == ip:
+                # The instructions of the region only ran if the branch wasn't taken
+                _, first = self.regions.pop()
+                self.indent -= 1
+                self.emit("else:")
+                self.emit(f"    counter[0] -= {self.index - first}")
+                self.stack = []
+            if loop and self.index == self.length - 1:
+                # Jumping back to the start continues the loop while the budget allows it
+                condition = LOOPS[name]
+                if condition != None:
+                    self.emit(f"if {self.condition(condition)}:")
+                    self.indent += 1
+                self.emit(f"if budget > {self.length}:")
+                self.emit(f"    budget -= {self.length}")
+                self.emit(f"    counter[0] += {self.length}")
+                self.emit("    continue")
+                self.exit_static(self.start)
+                if condition != None:
+                    self.indent -= 1
+                    self.exit_static(next)
+            else:
+                self.instruction(ip, name, a, b, next)
+        if last[1] not in TERMINATORS:
+            self.exit_static(last[4])
+
+        registers = sorted(n for n in self.used if n != "cmp")
+        writeback = [f"r[{n}] = r{n}" for n in sorted(n for n in self.written if n != "cmp")]
+        if "cmp" in self.written:
+            writeback.append("cpu.cmp = cmp")
+
+        lines = ["def block(budget):"]
+        lines += [f"    r{n} = r[{n}]" for n in registers]
+        if "cmp" in self.used:
+            lines.append("    cmp = cpu.cmp")
+        lines.append(f"    pc = {self.start}")
+        lines.append("    try:")
+        if loop:
+            lines.append("        while True:")
+        for line in self.lines:
+            if line.strip() == "@writeback":
+                indent = line[:len(line) - len(line.lstrip())]
+                lines += [indent + statement for statement in writeback] or [indent + "pass"]
+            else:
+                lines.append(line)
+        lines.append("    except (IndexError, struct_error, ZeroDivisionError, CpuException) as e:")
+        lines += ["        " + statement for statement in writeback]
+        lines.append(f"        counter[0] -= {self.length} - indices[pc]")
+        lines.append("        raise fault(e, pc)")
+        return "\n".join(lines) + "\n"
+
+def fault(e, ip):
+    if isinstance(e, CpuException):
+        return e
+    if isinstance(e, ZeroDivisionError):
+        return DivisionByZero(ip)
+    return ProtectionFault(ip)
+
+class TranslatingEmulator(emulator.Emulator):
+    def __init__(self, *args, **kwargs):
+        self.blocks = {} # Address -> compiled block
+        self.block_bytes = {} # Address -> blocks with an instruction in it
+        self.counter = [0] # Instructions run by blocks in addition to their length, see Generator
+        self.heat = {} # Address -> times a block starting there was entered before being translated
+        self.breakpoints = set() # Addresses always run through decode(), like in harness.Machine
+        self.translated = 0
+        super().__init__(*args, **kwargs)
+
+    def translate(self, ip):
+        # With coverage, blocks stop at every branch so they only mark instructions that run
+        side_exits = SIDE_EXITS if self.coverage == None else {}
+        instructions = []
+        address = ip
+        while len(instructions) < MAX_BLOCK_SIZE:
+            if instructions and address in self.breakpoints:
+                break
+            try:
+                name, a, b, next = decode_instruction(self.memory, address)
+            except CpuException:
+                # The invalid instruction raises when it's the start of a block
+                if not instructions:
+                    raise
+                break
+            instructions.append((address, name, a, b, next))
+            address = next
+            if name in TERMINATORS and (name not in side_exits or a == ip):
+                break
+
+        generator = Generator(instructions, self.io_range)
+        source = generator.generate()
+        block = Block(ip, address, len(instructions), generator.exits)
+        block.source = source
+
+        namespace = {
+            "memory": self.memory,
+            "r": self.registers,
+            "cpu": self,
+            "unpack16": U16.unpack_from,
+            "unpack32": U32.unpack_from,
+            "pack16": U16.pack_into,
+            "pack32": U32.pack_into,
+            "read_io": self.read_io,
+            "write_io": self.write_io,
+            "code_bytes": self.code_bytes,
+            "invalidate": self.invalidate,
+            "handlers": self.handlers,
+            "counter": self.counter,
+            "links": block.links,
+            "lookup": self.blocks.get,
+            "indices": {instruction[0]: i for i, instruction in enumerate(instructions)},
+            "idle": Idle,
+            "fault": fault,
+            "struct_error": struct.error,
+            "CpuException": CpuException,
+        }
+        exec(compile(source, f"<block 0x{ip:X}>", "exec"), namespace)
+        block.function = namespace["block"]
+
+        self.blocks[ip] = block
+        self.code_bytes.update(range(ip - 3, address))
+        if self.coverage != None:
+            # Blocks are translated when they are entered and run to their end, unless they fault or
+            # rewrite code
+            for instruction in instructions:
+                self.coverage.mark(instruction[0])
+        for byte in range(ip, address):
+            self.block_bytes.setdefault(byte, []).append(block)
+        self.translated += 1
+        return block
+
+    def enter(self, ip):
+        # Translates the block starting at an address once it's hot, returns None while it should
+        # still be interpreted
+        heat = self.heat.get(ip, 0) + 1
+        if heat < HOT_THRESHOLD or ip in self.breakpoints:
+            self.heat[ip] = heat
+            return None
+        return self.translate(ip)
+
+    def remove_block(self, block):
+        block.valid = False
+        if self.blocks.get(block.start) is block:
+            del self.blocks[block.start]
+        for byte in range(block.start, block.end):
+            owners = self.block_bytes[byte]
+            owners.remove(block)
+            if not owners:
+                del self.block_bytes[byte]
+        for caller, index in block.callers:
+            if caller.links[index] is block:
+                caller.links[index] = None
+        for index, target in enumerate(block.links):
+            if target != None:
+                target.callers.remove((block, index))
+                block.links[index] = None
+
+    def invalidate(self, address, size):
+        super().invalidate(address, size)
+        if size > emulator.LARGE_WRITE:
+            stale = {block for block in self.blocks.values() if block.start < address + size and block.end > address}
+        else:
+            stale = {block for byte in range(address, address + size) for block in self.block_bytes.get(byte, ())}
+        for block in stale:
+            self.remove_block(block)
+        self.invalidated += len(stale)
+
+    def flush(self):
+        super().flush()
+        for block in self.blocks.values():
+            block.valid = False
+            block.links[:] = [None] * len(block.links)
+        self.blocks.clear()
+        self.block_bytes.clear()
+
+    def step(self, count=emulator.UPDATE_INTERVAL):
+        # Same as Emulator.step, but can run up to a block more than `count` instructions
+        blocks = self.blocks
+        enter = self.enter
+        cache = self.cache
+        decode = self.decode
+        counter = self.counter
+        executed = 0
+        ip = self.ip
+        try:
+            block = blocks.get(ip) or enter(ip)
+            while executed < count:
+                if block is None:
+                    # Cold code goes through the decoded instruction cache until a jump is taken
+                    try:
+                        handler, a, b, next = cache[ip]
+                    except KeyError:
+                        handler, a, b, next = decode(ip)
+                    new = handler(a, b, next)
+                    executed += 1
+                    if new != next:
+                        if new == ip:
+                            self.halted = not self.interrupts_enabled
+                            break
+                        block = blocks.get(new) or enter(new)
+                    ip = new
+                    continue
+
+                try:
+                    result = block.function(count - executed)
+                except Idle as e:
+                    executed += block.length
+                    ip = e.ip
+                    self.halted = not self.interrupts_enabled
+                    break
+                except CpuException as e:
+                    executed += block.length
+                    ip = e.ip
+                    raise
+                executed += block.length
+
+                if result.__class__ is int:
+                    ip = result
+                    next = blocks.get(result) or enter(result)
+                    index = block.exits.get(result)
+                    if next != None and index != None and block.valid:
+                        block.links[index] = next
+                        next.callers.append((block, index))
+                    block = next
+                else:
+                    block = result
+            else:
+                if block != None:
+                    ip = block.start
+        except (IndexError, struct.error):
+            raise ProtectionFault(ip)
+        finally:
+            self.ip = ip
+            self.instructions += executed + counter[0]
+            counter[0] = 0
+        return executed
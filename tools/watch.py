@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import signal
+import threading
+import click
+import lark
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+import kl
+import assembler
+import backend
+from debuginfo import EXTENSION
+
+def key_path(directory, port):
+    return os.path.join(directory, f".watch-{port}.key")
+
+def create_key(path):
+    # Random key of a server, only readable by its user. Messages are pickled, so whoever knows the
+    # key can run code as that user
+    key = os.urandom(32)
+    if os.path.lexists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+class Builder:
+    def __init__(self, files, output, comment=False, type_checking="loose", optimize=False, debug=False):
+        self.files = files # Same file list as the assembler, .kl files are compiled first
+        self.output = output
+        self.comment = comment
+        self.type_checking = type_checking
+        self.optimize = optimize
+        self.debug = debug
+
+        self.import_cache = {} # Shared by every compiler, see kl.Compiler.import_definitions
+        self.modules = {} # Compiled .kl files: path -> {"mtimes": ..., "code": ...}
+        self.trees = {} # Parsed assembly files: path -> (source, tree)
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def watched(self):
+        # Files whose modification should trigger a rebuild
+        paths = set(file for file in self.files if file[0] != "@")
+        for module in self.modules.values():
+            paths.update(module["mtimes"].keys())
+        return paths
+
+    def snapshot(self):
+        return {path: self.mtime(path) for path in self.watched()}
+
+    def is_stale(self, file):
+        module = self.modules.get(file)
+        if module is None:
+            return True
+        return any(self.mtime(path) != mtime for path, mtime in module["mtimes"].items())
+
+    def compile(self, file):
+        compiler = kl.compile_file(file, comment=self.comment, type_checking=self.type_checking, import_cache=self.import_cache, debug=self.debug)
+
+        code = compiler.code
+        if self.optimize:
+            code = backend.Optimizer().optimize(code)
+
+        # Import paths are relative to the working directory, same as the file itself
+        self.modules[file] = {
+            "mtimes": {path: self.mtime(path) for path in [file] + compiler.imports},
+            "code": code,
+        }
+        with open(file + ".out", "w") as f:
+            f.write(code)
+
+    def parse(self, file):
+        if file.endswith(".kl.out") and file[:-4] in self.modules:
+            source = self.modules[file[:-4]]["code"]
+        else:
+            with open(file, "r") as f:
+                source = f.read()
+
+        cached = self.trees.get(file)
+        if cached is None or cached[0] != source:
+            cached = (source, assembler.parser.parse(source))
+            self.trees[file] = cached
+        return cached[1]
+
+    def build(self):
+        start = time.perf_counter()
+        result = {"ok": False, "compiled": [], "errors": [], "output": self.output}
+
+        try:
+            for file in self.files:
+                if file.endswith(".kl") and self.is_stale(file):
+                    self.compile(file)
+                    result["compiled"].append(file)
+
+            units = [file + ".out" if file.endswith(".kl") else file for file in self.files]
+            built = assembler.build(units, parse=self.parse, verbose=False)
+            code = built.code
+            with open(self.output, "wb") as f:
+                f.write(code)
+            if self.debug:
+                built.debug_info().save(self.output + EXTENSION)
+
+            result["ok"] = True
+            result["size"] = len(code)
+        except kl.CompileError as e:
+            # Forget the module so it gets compiled again even if only an import changes
+            self.modules.pop(e.path, None)
+            result["errors"].append(kl.format_error(e))
+        except (lark.exceptions.LarkError, OSError) as e:
+            result["errors"].append(f"ERROR: {e}")
+
+        result["time"] = time.perf_counter() - start
+        return result
+
+def report(result):
+    for error in result["errors"]:
+        click.echo(error, err=True)
+
+    if result["ok"]:
+        compiled = ", ".join(result["compiled"]) or "nothing"
+        click.echo(f"Built {result['output']} ({result['size']} bytes) in {result['time'] * 1000:.1f}ms, compiled {compiled}")
+    else:
+        click.echo(f"Build failed in {result['time'] * 1000:.1f}ms", err=True)
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.argument("files", required=True, nargs=-1)
+@click.option("--output", "-o", required=True, help="Output binary to write to.")
+@click.option("--directory", "-C", type=click.Path(exists=True, file_okay=False), default=".", help="Directory the file names are relative to.")
+@click.option("--comment", is_flag=True, default=False, help="Adds comment lines to the generated assembly code")
+@click.option("--type-checking", default="loose", help="Type checking mode [strict/loose/off]")
+@click.option("--optimize", "-O", is_flag=True, default=False, help="Runs the optimizer of backend.py on compiled modules.")
+@click.option("--debug", "-g", is_flag=True, default=False, help=f"Compiles with .loc and .func directives and writes debug info to <output>{EXTENSION}.")
+@click.option("--port", default=6510, help="Local port to accept build requests on.")
+@click.option("--interval", default=0.05, help="Seconds between checks for modified files.")
+def serve(files, output, directory, comment, type_checking, optimize, debug, port, interval):
+    """Keeps compiled modules in memory and rebuilds FILES whenever a source file changes."""
+    # Imports in .kl files are relative to the working directory, same as boot/build.py
+    os.chdir(directory)
+
+    builder = Builder(files, output, comment=comment, type_checking=type_checking, optimize=optimize, debug=debug)
+    lock = threading.Lock()
+
+    with lock:
+        report(builder.build())
+    mtimes = builder.snapshot()
+
+    def accept(listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, OSError, AuthenticationError):
+                continue
+            # A client that goes away or sends garbage only loses its own request
+            try:
+                with conn:
+                    request = conn.recv()
+                    if request == "build":
+                        with lock:
+                            conn.send(builder.build())
+            except Exception:
+                continue
+
+    key_file = key_path(".", port)
+    listener = Listener(("localhost", port), authkey=create_key(key_file))
+    threading.Thread(target=accept, args=(listener,), daemon=True).start()
+    click.echo(f"Watching {len(mtimes)} files, accepting build requests on port {port}")
+
+    # Stopping with SIGTERM also runs the cleanup below
+    signal.signal(signal.SIGTERM, lambda *_: exit(0))
+    try:
+        while True:
+            time.sleep(interval)
+            with lock:
+                current = builder.snapshot()
+                if current != mtimes:
+                    report(builder.build())
+                    # Files modified during the build still differ from `current` and trigger another build
+                    mtimes = {**builder.snapshot(), **current}
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(key_file)
+
+@cli.command()
+@click.option("--port", default=6510, help="Port the build server is listening on.")
+@click.option("--directory", "-C", type=click.Path(exists=True, file_okay=False), default=".", help="Directory the server was started in.")
+def build(port, directory):
+    """Requests a build from a running server."""
+    try:
+        with open(key_path(directory, port), "rb") as f:
+            key = f.read()
+        conn = Client(("localhost", port), authkey=key)
+    except (FileNotFoundError, ConnectionRefusedError):
+        click.echo(f"ERROR: no build server running on port {port}", err=True)
+        exit(1)
+    except AuthenticationError:
+        click.echo(f"ERROR: the server on port {port} wasn't started in {directory}", err=True)
+        exit(1)
+
+    with conn:
+        conn.send("build")
+        result = conn.recv()
+
+    report(result)
+    if not result["ok"]:
+        exit(1)
+
+if __name__ == "__main__":
+    cli()